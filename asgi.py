@@ -0,0 +1,6 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+"""
+from service import init_async_app
+
+app = init_async_app()
@@ -0,0 +1,31 @@
+"""
+Gunicorn Configuration
+
+Gunicorn reads this file from the directory it is started in. The hooks
+keep the metrics that the workers share in PROMETHEUS_MULTIPROC_DIR right.
+
+Every worker runs GUNICORN_THREADS requests at once, so that admission
+control has requests of several route classes to choose between and an
+event stream does not take the whole worker.
+"""
+import os
+from service import config as service_config
+from service.common.metrics import clear_metrics, worker_exited
+
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+
+def on_starting(_server):
+    """Removes the metrics that the workers of an earlier run left behind"""
+    clear_metrics()
+
+
+def when_ready(server):
+    """Warns that admission control is on while every worker runs one request at a time"""
+    if service_config.ADMISSION_CONTROL and server.cfg.threads <= 1:
+        server.log.warning("ADMISSION_CONTROL never turns a request away with one thread per worker, set --threads")
+
+
+def child_exit(_server, worker):
+    """Drops the live gauges of a worker that exited"""
+    worker_exited(worker.pid)
@@ -19,6 +19,10 @@ from flask import Flask
 from flask_redis import FlaskRedis
 from service import config
 from service.common import log_handlers
+from service.common.admission import AdmissionController
+from service.common.circuit_breaker import breaker_options
+from service.common.json_provider import init_json
+from service.common.profiling import Profiler
 
 # Globally accessible libraries
 # redis = FlaskRedis()
@@ -31,6 +35,7 @@ def init_app():
     """Initialize the core application."""
     app = Flask(__name__)
     app.config.from_object(config)
+    init_json(app)
 
     # Initialize Plugins
     # redis.init_app(app)
@@ -40,10 +45,17 @@ def init_app():
 
         # pylint: disable=import-outside-toplevel, unused-import
         from service import routes, models
-        from service.common import error_handlers
+        from service.common import error_handlers, cli_commands
+
+        app.register_blueprint(error_handlers.errors)
 
         # Set up logging for production
-        log_handlers.init_logging(app, "gunicorn.error")
+        log_handlers.init_logging(
+            app,
+            "gunicorn.error",
+            queue_size=app.config["LOG_QUEUE_SIZE"],
+            sample_rates=log_handlers.parse_sample_rates(app.config["LOG_SAMPLE_RATES"]),
+        )
 
         app.logger.info(70 * "*")
         app.logger.info("  H I T   C O U N T E R   S E R V I C E  ".center(70, "*"))
@@ -51,12 +63,132 @@ def init_app():
 
         app.logger.info("Service initialized!")
 
+        # Profile a sample of the requests when there is a place for the profiles
+        if app.config["PROFILE_DIR"]:
+            profiler = Profiler(
+                app.config["PROFILE_DIR"],
+                rate=app.config["PROFILE_RATE"],
+                interval=app.config["PROFILE_INTERVAL"],
+                mode=app.config["PROFILE_MODE"],
+                sample_interval=app.config["PROFILE_SAMPLE_INTERVAL"],
+                redis_fn=lambda: models.Counter.redis,
+            )
+            profiler.start()
+            app.extensions["profiler"] = profiler
+            app.logger.info("Profiling %s of the requests into %s", profiler.rate, profiler.directory)
+
+        # Turn requests away once a worker runs as many as it can serve quickly
+        if app.config["ADMISSION_CONTROL"]:
+            app.extensions["admission"] = AdmissionController(
+                {
+                    "read": app.config["ADMISSION_READ_LIMIT"],
+                    "write": app.config["ADMISSION_WRITE_LIMIT"],
+                    "listing": app.config["ADMISSION_LISTING_LIMIT"],
+                },
+                max_queue=app.config["ADMISSION_MAX_QUEUE"],
+                target=app.config["ADMISSION_TARGET"],
+                interval=app.config["ADMISSION_INTERVAL"],
+            )
+            app.logger.info("Admission control enabled")
+
         # Initialize the database
         try:
             app.logger.info("Initializing the Redis database")
-            models.Counter.connect(app.config['DATABASE_URI'])
+            if app.config["CIRCUIT_BREAKER"]:
+                models.Counter.enable_circuit_breaker(**breaker_options(app.config))
+            models.Counter.connect(
+                app.config["DATABASE_URI"],
+                virtual_nodes=app.config["REDIS_VIRTUAL_NODES"],
+                max_connections=app.config["REDIS_MAX_CONNECTIONS"],
+                pool_timeout=app.config["REDIS_POOL_TIMEOUT"],
+                socket_timeout=app.config["REDIS_SOCKET_TIMEOUT"],
+                socket_connect_timeout=app.config["REDIS_SOCKET_CONNECT_TIMEOUT"],
+                socket_keepalive=app.config["REDIS_SOCKET_KEEPALIVE"],
+                health_check_interval=app.config["REDIS_HEALTH_CHECK_INTERVAL"],
+            )
             app.logger.info("Connected!")
+            models.Counter.stripe_selection = app.config["STRIPE_SELECTION"]
+            models.Counter.top_size = app.config["COUNTERS_TOP_SIZE"]
+            models.Counter.buckets = app.config["COUNTERS_BUCKETS"]
+            models.Counter.rates = app.config["RATES_ENABLED"]
+            if app.config["CACHE_ENABLED"]:
+                models.Counter.enable_cache(
+                    app.config["CACHE_MAX_SIZE"], app.config["CACHE_TTL"], app.config["CHANGES_CHANNEL"]
+                )
+            if app.config["STALE_READS"]:
+                models.Counter.enable_stale_reads(app.config["STALE_MAX_SIZE"], app.config["STALE_MAX_AGE"])
+            if app.config["EVENTS_ENABLED"]:
+                models.Counter.enable_events(app.config["CHANGES_CHANNEL"])
+            if app.config["WRITE_BEHIND"]:
+                models.Counter.enable_write_behind(
+                    app.config["WRITE_BEHIND_INTERVAL"], app.config["WRITE_BEHIND_MAX_PENDING"]
+                )
         except models.DatabaseConnectionError as err:
             app.logger.error(str(err))
 
         return app
+
+
+############################################################
+# Initialize the Quart instance for ASGI servers
+############################################################
+def init_async_app():
+    """Initialize the asynchronous application
+
+    Serves the same REST API with Quart and redis.asyncio so that each
+    ASGI worker runs one event loop for thousands of requests in flight
+    """
+    # pylint: disable=import-outside-toplevel
+    from quart import Quart
+    from service.async_models import AsyncCounter
+    from service.async_routes import api
+    from service.models import DatabaseConnectionError
+
+    app = Quart(__name__)
+    app.config.from_object(config)
+    init_json(app)
+    app.register_blueprint(api)
+
+    # Set up logging for production
+    log_handlers.init_logging(
+        app,
+        "hypercorn.error",
+        queue_size=app.config["LOG_QUEUE_SIZE"],
+        sample_rates=log_handlers.parse_sample_rates(app.config["LOG_SAMPLE_RATES"]),
+    )
+    app.logger.info("  H I T   C O U N T E R   S E R V I C E   ( A S Y N C )  ".center(70, "*"))
+
+    @app.before_serving
+    async def connect():
+        """Connects to Redis on the event loop of the worker"""
+        try:
+            app.logger.info("Initializing the Redis database")
+            if app.config["CIRCUIT_BREAKER"]:
+                AsyncCounter.enable_circuit_breaker(**breaker_options(app.config))
+            await AsyncCounter.connect(
+                app.config["DATABASE_URI"],
+                virtual_nodes=app.config["REDIS_VIRTUAL_NODES"],
+                max_connections=app.config["REDIS_MAX_CONNECTIONS"],
+                pool_timeout=app.config["REDIS_POOL_TIMEOUT"],
+                channel=app.config["CHANGES_CHANNEL"] if app.config["CACHE_ENABLED"] or app.config["EVENTS_ENABLED"] else "",
+                socket_timeout=app.config["REDIS_SOCKET_TIMEOUT"],
+                socket_connect_timeout=app.config["REDIS_SOCKET_CONNECT_TIMEOUT"],
+                socket_keepalive=app.config["REDIS_SOCKET_KEEPALIVE"],
+                health_check_interval=app.config["REDIS_HEALTH_CHECK_INTERVAL"],
+            )
+            AsyncCounter.stripe_selection = app.config["STRIPE_SELECTION"]
+            AsyncCounter.top_size = app.config["COUNTERS_TOP_SIZE"]
+            AsyncCounter.buckets = app.config["COUNTERS_BUCKETS"]
+            AsyncCounter.rates = app.config["RATES_ENABLED"]
+            if app.config["EVENTS_ENABLED"]:
+                AsyncCounter.enable_events()
+            app.logger.info("Connected!")
+        except DatabaseConnectionError as err:
+            app.logger.error(str(err))
+
+    @app.after_serving
+    async def disconnect():
+        """Closes the Redis connections of the worker"""
+        await AsyncCounter.disconnect()
+
+    return app
@@ -0,0 +1,546 @@
+######################################################################
+# Copyright 2016, 2024 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Asynchronous Counter Model
+
+The same counters as service.models.Counter stored the same way and
+changed by the same Lua scripts, but read and written with redis.asyncio
+so that one event loop can wait on many Redis replies at once
+"""
+# pylint: disable=duplicate-code
+import os
+import time
+import logging
+from redis.asyncio import ConnectionPool, BlockingConnectionPool
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.common.sharding import AsyncShardedRedis, split_uris
+from service.common.buckets import group_by_bucket
+from service.common.circuit_breaker import CircuitBreaker
+from service.common.rollups import queue_rollups, window_keys
+from service.common.events import EventHub
+from service.common.metrics import AsyncMeteredRedis
+from service.common.notifications import AsyncChangeListener
+from service.models import (
+    DatabaseConnectionError,
+    LUA_SCRIPTS,
+    INDEX_KEY,
+    TOP_KEY,
+    GENERATION_KEY,
+    STRIPES_MARKER,
+    entity_tag,
+    script_keys,
+    script_args,
+    queue_read,
+    read_results,
+    lex_range,
+    stripe_keys,
+    stripe_count,
+    pick_stripe,
+    striped_keys,
+    counter_values,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCounter:  # pylint: disable=too-many-public-methods
+    """An integer counter that is persisted in Redis using asyncio
+
+    Instances are only made by the finder and create methods and hold
+    the value that was read or written when they were made
+    """
+
+    redis = None
+    scripts = {}
+    breaker_options = None
+    channel = ""
+    listener = None
+    events = None
+    stripe_counts = {}
+    stripe_selection = "random"
+    top_size = 1000
+    buckets = 0
+    rates = False
+
+    def __init__(self, name: str, count: int, version=None):
+        """Constructor"""
+        self.name = name
+        self.count = int(count)
+        self.version = version
+
+    def serialize(self):
+        """Converts a counter into a dictionary"""
+        return {"name": self.name, "counter": self.count}
+
+    @property
+    def etag(self):
+        """Returns a tag that changes whenever the counter does like Counter.etag"""
+        return entity_tag(self.version, self.count)
+
+    ######################################################################
+    #  A T O M I C   O P E R A T I O N S
+    ######################################################################
+
+    @classmethod
+    async def create(cls, name: str, value: int = 0, stripes: int = 1):
+        """Creates a counter unless it already exists
+
+        Returns:
+            the new AsyncCounter or None if the counter already exists
+        """
+        if stripes > 1:
+            return await cls._create_striped(name, value, stripes)
+        count = await cls._run("create", name, value)
+        return None if count is None else cls(name, count)
+
+    @classmethod
+    async def increment_existing(cls, name: str, amount: int = 1):
+        """Increments a counter only if it already exists
+
+        Returns:
+            the new value of the counter or None if it does not exist
+        """
+        stripes = cls.stripe_counts.get(name)
+        if stripes:
+            count = await cls._increment_striped(name, stripes, amount)
+            if count is not None:
+                return count
+            cls.stripe_counts.pop(name, None)
+        return await cls._run("increment", name, amount)
+
+    @classmethod
+    async def remove(cls, name: str) -> bool:
+        """Removes a counter and returns True if it existed"""
+        return await cls._run("delete", name)
+
+    @classmethod
+    async def batch(cls, operations: list) -> list:
+        """Runs many counter operations in a single pipeline
+
+        See Counter.batch() for the operations and their results
+        """
+        try:
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                for operation, name, number in operations:
+                    await cls.scripts[operation](
+                        keys=cls._keys(operation, name), args=cls._args(operation, name, number), client=pipe
+                    )
+                for operation, name, number in operations:
+                    if operation == "increment":
+                        cls._queue_rollups(pipe, name, number)
+                results = (await pipe.execute())[:len(operations)]
+            return [
+                await cls._result(operation, name, number, result)
+                for (operation, name, number), result in zip(operations, results)
+            ]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+    @classmethod
+    async def import_counters(cls, counters: list, overwrite: bool = False) -> list:
+        """Sets the values of many counters like Counter.import_counters()"""
+        operation = "set" if overwrite else "create"
+        try:
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                for name, value in counters:
+                    await cls.scripts[operation](
+                        keys=cls._keys(operation, name), args=cls._args(operation, name, value), client=pipe
+                    )
+                results = await pipe.execute()
+            written = []
+            for (name, _), result in zip(counters, results):
+                if overwrite:
+                    cls.stripe_counts.pop(name, None)
+                    if stripe_count(result):
+                        await cls._delete_many(stripe_keys(name, stripe_count(result)))
+                written.append(overwrite or result is not None)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return written
+
+    @classmethod
+    async def _run(cls, operation: str, name: str, number: int = 0):
+        """Runs the Lua script of one operation on a counter"""
+        try:
+            if operation == "increment" and cls.rates:
+                async with cls.redis.pipeline(transaction=False) as pipe:
+                    await cls.scripts[operation](
+                        keys=cls._keys(operation, name), args=cls._args(operation, name, number), client=pipe
+                    )
+                    cls._queue_rollups(pipe, name, number)
+                    result = (await pipe.execute())[0]
+            else:
+                result = await cls.scripts[operation](keys=cls._keys(operation, name), args=cls._args(operation, name, number))
+            return await cls._result(operation, name, number, result)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+    @classmethod
+    async def _result(cls, operation: str, name: str, number: int, result):
+        """Converts the result of a script the way Counter does"""
+        if operation == "delete":
+            cls.stripe_counts.pop(name, None)
+            if stripe_count(result):
+                await cls._delete_many(stripe_keys(name, stripe_count(result)))
+            return result is not None
+        if operation == "increment" and stripe_count(result):
+            cls.stripe_counts[name] = stripe_count(result)
+            return await cls._increment_striped(name, stripe_count(result), number, rollup=False)
+        return (await cls._counter_values([name], [result]))[0]
+
+    ######################################################################
+    #  S T R I P E D   C O U N T E R S
+    ######################################################################
+
+    @classmethod
+    async def _create_striped(cls, name: str, value: int, stripes: int):
+        """Creates a counter whose increments are spread over many keys"""
+        try:
+            created = await cls.scripts["create"](
+                keys=cls._keys("create", name),
+                args=script_args("create", name, f"{STRIPES_MARKER}{stripes}", buckets=cls.buckets),
+            )
+            if not created:
+                return None
+            await cls._write_many(dict(zip(stripe_keys(name, stripes), [value] + [0] * (stripes - 1))))
+            await cls._changed(name, value)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls.stripe_counts[name] = stripes
+        return cls(name, value)
+
+    @classmethod
+    async def _increment_striped(cls, name: str, stripes: int, amount: int, rollup: bool = True):
+        """Increments one stripe and adds up all of them in one round trip"""
+        keys = stripe_keys(name, stripes)
+        stripe = keys[pick_stripe(stripes, cls.stripe_selection)]
+        try:
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                await cls.scripts["increment"](
+                    keys=cls._keys("increment", stripe),
+                    args=script_args("increment", stripe, amount, buckets=cls.buckets),
+                    client=pipe,
+                )
+                queue_read(pipe, keys, cls.buckets)
+                if rollup:
+                    cls._queue_rollups(pipe, name, amount)
+                results = await pipe.execute()
+            count, values = results[0], read_results(keys, results[1:], cls.buckets)
+            if count is None:
+                return None
+            count = counter_values([f"{STRIPES_MARKER}{stripes}"], values)[0]
+            await cls._changed(name, count)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return count
+
+    @classmethod
+    async def _counter_values(cls, names: list, values: list) -> list:
+        """Converts values read from Redis adding up the stripes of striped counters"""
+        keys = striped_keys(names, values)
+        return counter_values(values, await cls._read_many(keys))
+
+    @classmethod
+    async def _changed(cls, name: str, value: int):
+        """Ranks, versions and publishes the new value of a striped counter like Counter._changed()"""
+        await cls.scripts["changed"](keys=cls._keys("changed", name), args=cls._args("changed", name, value))
+
+    ######################################################################
+    #  R A T E S
+    ######################################################################
+
+    @classmethod
+    def _queue_rollups(cls, pipe, name: str, amount: int):
+        """Queues adding an increment to the rollups of a counter like Counter._queue_rollups()"""
+        if cls.rates:
+            queue_rollups(pipe, name, amount, time.time())
+
+    @classmethod
+    async def rate(cls, name: str, window: int) -> int:
+        """Returns the number of increments of a counter in the last window seconds like Counter.rate()"""
+        keys = window_keys(name, window, time.time())
+        try:
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                pipe.mget(keys)
+                values = (await pipe.execute())[0]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return sum(int(value or 0) for value in values)
+
+    ######################################################################
+    #  S T O R A G E   L A Y O U T
+    ######################################################################
+
+    @classmethod
+    def _keys(cls, operation: str, name: str) -> list:
+        """Returns the keys of the Lua script for an operation on a counter"""
+        return script_keys(operation, name, cls.buckets)
+
+    @classmethod
+    def _args(cls, operation: str, name: str, number: int = 0) -> list:
+        """Returns the arguments of the Lua script for an operation on a counter"""
+        return script_args(operation, name, number, cls.channel, cls.top_size, cls.buckets)
+
+    @classmethod
+    async def _read_many(cls, names: list) -> list:
+        """Reads the raw values of counters in one round trip like Counter._read_many()"""
+        if not names:
+            return []
+        async with cls.redis.pipeline(transaction=False) as pipe:
+            queue_read(pipe, names, cls.buckets)
+            return read_results(names, await pipe.execute(), cls.buckets)
+
+    @classmethod
+    async def _write_many(cls, values: dict):
+        """Sets the raw values of counters like Counter._write_many()"""
+        if not cls.buckets:
+            await cls.redis.mset(values)
+            return
+        names = list(values)
+        async with cls.redis.pipeline(transaction=False) as pipe:
+            for key, positions in group_by_bucket(names, cls.buckets).items():
+                pipe.hset(key, mapping={names[position]: values[names[position]] for position in positions})
+            await pipe.execute()
+
+    @classmethod
+    async def _delete_many(cls, names: list):
+        """Deletes counters like Counter._delete_many()"""
+        if not cls.buckets:
+            await cls.redis.delete(*names)
+            return
+        async with cls.redis.pipeline(transaction=False) as pipe:
+            for key, positions in group_by_bucket(names, cls.buckets).items():
+                pipe.hdel(key, *[names[position] for position in positions])
+            await pipe.execute()
+
+    ######################################################################
+    #  F I N D E R   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def find(cls, name: str):
+        """Finds a counter with the name and its version or returns None"""
+        try:
+            found = await cls.scripts["find"](keys=cls._keys("find", name), args=cls._args("find", name))
+            if found is None:
+                return None
+            value, version = found
+            count = (await cls._counter_values([name], [value]))[0]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, count, version)
+
+    @classmethod
+    async def generation(cls) -> str:
+        """Returns a tag that changes whenever any counter changes like Counter.generation()"""
+        try:
+            if isinstance(cls.redis, AsyncShardedRedis):
+                generations = await cls.redis.fan_out(lambda client: client.get(GENERATION_KEY))
+            else:
+                generations = [await cls.redis.get(GENERATION_KEY)]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return ".".join(generation or "0" for generation in generations)
+
+    @classmethod
+    async def find_many(cls, names: list) -> list:
+        """Finds many counters like Counter.find_many()"""
+        try:
+            values = await cls._counter_values(names, await cls._read_many(names))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return [None if value is None else cls(name, value) for name, value in zip(names, values)]
+
+    @classmethod
+    async def pages(cls, limit: int = 1000, prefix: str = ""):
+        """Yields all of the counters one page at a time like Counter.pages()"""
+        after = ""
+        while True:
+            after, page = await cls.page(after, limit, prefix)
+            if page:
+                yield page
+            if not after:
+                break
+
+    @classmethod
+    async def page(cls, after: str = "", limit: int = 1000, prefix: str = ""):
+        """Returns a page of counters and the name to start the next page after
+
+        See Counter.page() for how the index is read
+        """
+        try:
+            names = await cls.redis.zrangebylex(INDEX_KEY, *lex_range(prefix, after), start=0, num=limit)
+            counters = await cls._fetch_all(names)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return (names[-1] if len(names) == limit else ""), counters
+
+    @classmethod
+    async def all(cls):
+        """Returns all of the counters in the order of their names"""
+        return [counter async for page in cls.pages() for counter in page]
+
+    @classmethod
+    async def top(cls, k: int = 10) -> list:
+        """Returns the k highest counters from the highest down like Counter.top()"""
+        try:
+            ranked = await cls.redis.zrevrange(TOP_KEY, 0, k - 1, withscores=True)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return [{"name": name, "counter": int(score)} for name, score in ranked]
+
+    @classmethod
+    async def _fetch_all(cls, names: list) -> list:
+        """Fetches the values of the names like Counter._fetch_all()"""
+        values = await cls._counter_values(names, await cls._read_many(names))
+        return [
+            {"name": name, "counter": value}
+            for name, value in zip(names, values)
+            if value is not None
+        ]
+
+    @classmethod
+    async def remove_all(cls):
+        """Removes all of the keys in the database"""
+        cls.stripe_counts.clear()
+        try:
+            await cls.redis.flushall()
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+    ######################################################################
+    #  C H A N G E   E V E N T S
+    ######################################################################
+
+    @classmethod
+    def enable_events(cls):
+        """Passes the changes of counters to Server-Sent Events streams like Counter.enable_events()
+
+        Call this on the event loop after connecting with a channel. The
+        channel is subscribed to on every shard in a task of the loop.
+        """
+        cls.events = EventHub()
+        clients = cls.redis.clients if isinstance(cls.redis, AsyncShardedRedis) else [cls.redis]
+        cls.listener = AsyncChangeListener(lambda: clients, cls.channel)
+        cls.listener.add_handler(cls.events.dispatch, cls.events.reset)
+        cls.listener.start()
+        logger.info("Streaming counter changes from %s", cls.channel)
+
+    @classmethod
+    async def disable_events(cls):
+        """Stops passing changes to Server-Sent Events streams"""
+        if cls.listener:
+            await cls.listener.stop()
+        cls.listener = None
+        cls.events = None
+
+    ######################################################################
+    #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def test_connection(cls):
+        """Test connection by pinging the host"""
+        success = False
+        try:
+            await cls.redis.ping()
+            logger.info("Connection established")
+            success = True
+        except RedisConnectionError:
+            logger.warning("Connection Error!")
+        return success
+
+    @classmethod
+    async def connect(
+        cls, database_uri=None, max_connections=None, pool_timeout=None, channel="", virtual_nodes=160, **options
+    ):  # pylint: disable=too-many-arguments
+        """Established database connection on the running event loop
+
+        Arguments:
+            database_uri: a uri to the Redis database, or a list or comma
+                separated string of uris to shard the counters across
+            max_connections: the most connections the pool will open
+            pool_timeout: seconds to wait for a free connection or None
+            channel: the pub/sub channel to publish changes on or ""
+            virtual_nodes: the number of points of each shard on the hash ring
+            options: socket_timeout and the other Redis connection options
+
+        Raises:
+            DatabaseConnectionError: Could not connect
+        """
+        database_uri = database_uri or os.getenv("DATABASE_URI")
+        if not database_uri:
+            msg = "DATABASE_URI is missing from environment."
+            logger.error(msg)
+            raise DatabaseConnectionError(msg)
+
+        logger.info("Attempting to connecting to Redis...")
+        options = {"encoding": "utf-8", "decode_responses": True, **options}
+        if max_connections:
+            options["max_connections"] = max_connections
+        clients = []
+        for uri in split_uris(database_uri):
+            if pool_timeout:
+                pool = BlockingConnectionPool.from_url(uri, timeout=pool_timeout, **options)
+            else:
+                pool = ConnectionPool.from_url(uri, **options)
+            clients.append(AsyncMeteredRedis(connection_pool=pool))
+        if cls.breaker_options is not None:
+            for client in clients:
+                client.breaker = CircuitBreaker(**cls.breaker_options)
+        if len(clients) == 1:
+            cls.redis = clients[0]
+        else:
+            cls.redis = AsyncShardedRedis(clients, split_uris(database_uri), virtual_nodes)
+
+        if not await cls.test_connection():
+            # if you end up here, redis instance is down.
+            await cls.disconnect()
+            logger.fatal("*** FATAL ERROR: Could not connect to the Redis Service")
+            raise DatabaseConnectionError("Could not connect to the Redis Service")
+
+        cls.channel = channel
+        cls.scripts = {
+            name: cls.redis.register_script(script)
+            for name, script in LUA_SCRIPTS.items()
+        }
+        logger.info("Successfully connected to Redis")
+        return cls.redis
+
+    @classmethod
+    def enable_circuit_breaker(cls, **options):
+        """Fails the commands to a Redis node fast while it is down or too slow
+
+        Like Counter.enable_circuit_breaker, for the clients made by the next connect()
+        """
+        cls.breaker_options = options
+
+    @classmethod
+    def disable_circuit_breaker(cls):
+        """Sends every command to Redis again after the next connect()"""
+        cls.breaker_options = None
+
+    @classmethod
+    async def disconnect(cls):
+        """Closes the connections of the pool"""
+        await cls.disable_events()
+        if cls.redis is None:
+            return
+        if hasattr(cls.redis, "aclose"):
+            await cls.redis.aclose()
+        else:  # redis-py before 5.0.1
+            await cls.redis.close()
+        cls.redis = None
@@ -0,0 +1,654 @@
+######################################################################
+# Copyright (c) 2015, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Asynchronous Counter Service
+
+The same REST API as service.routes served by Quart on an event loop so
+that a worker is not blocked while it waits on Redis. The routes live on
+a blueprint because Quart has no application context at import time.
+"""
+# pylint: disable=duplicate-code
+import json
+from quart import Blueprint, Response, g, jsonify, abort, request, url_for
+from quart import current_app as app
+from werkzeug.exceptions import HTTPException
+from service.common import status  # HTTP Status Codes
+from service.common.helpers import (
+    parse_int,
+    parse_items,
+    parse_item_counts,
+    parse_sources,
+    plan_batch,
+    finish_batch,
+    EXPORT_FORMATS,
+    export_header,
+    export_chunk,
+    ImportParser,
+    ImportReport,
+)
+from service.common.error_handlers import ERROR_TITLES, error_body, error_headers
+from service.common.json_provider import JsonTemplate
+from service.common.events import AsyncSubscription, KEEPALIVE, format_events, resync_names
+from service.common.metrics import start_request, record_request, generate_metrics, count_errors
+from service.common.tracing import start_trace, stop_trace
+from service.common.rollups import parse_window
+from service.common.sketches import sketch_dimensions
+from service.async_models import AsyncCounter
+from service.sketch_models import AsyncUniqueCounter, AsyncFrequencySketch
+from service.models import DatabaseConnectionError
+
+api = Blueprint("api", __name__)
+
+# the index document with everything but its link encoded once
+INDEX = JsonTemplate({"name": "Counter Service REST API", "version": "1.0"}, "paths")
+
+
+######################################################################
+# GET INDEX
+######################################################################
+@api.route("/")
+async def index():
+    """Root URL response"""
+    app.logger.info("Request for Root URL")
+    return Response(
+        INDEX.render(paths=url_for(".list_counters", _external=True)),
+        status=status.HTTP_200_OK,
+        mimetype="application/json",
+    )
+
+
+######################################################################
+# GET METRICS
+######################################################################
+@api.route("/metrics", methods=["GET"])
+async def metrics():
+    """Returns the metrics of every worker like service.routes"""
+    data, content_type = generate_metrics()
+    return Response(data, status=status.HTTP_200_OK, content_type=content_type)
+
+
+@api.before_app_request
+async def start_timer():
+    """Notes when a request started and starts tracing its Redis commands"""
+    g.request_start = start_request()
+    if app.config["REDIS_TRACING"]:
+        start_trace()
+
+
+@api.after_app_request
+async def count_request(response):
+    """Counts every request by route and status, errors included"""
+    if "request_start" in g:
+        rule = request.url_rule.rule if request.url_rule else None
+        record_request(request.method, rule, response.status_code, g.request_start)
+    return response
+
+
+@api.after_app_request
+async def send_trace(response):
+    """Sends the Redis round trips of a traced request in a Server-Timing header"""
+    trace = stop_trace()
+    if trace is not None:
+        response.headers.add("Server-Timing", trace.server_timing())
+        if app.config["REDIS_TRACE_LOG"]:
+            app.logger.info("Redis trace of %s %s: %s", request.method, request.path, json.dumps(trace.serialize()))
+    return response
+
+
+############################################################
+#           R E S T   A P I   M E T H O D S
+############################################################
+
+
+############################################################
+# List counters
+############################################################
+@api.route("/counters", methods=["GET"])
+async def list_counters():
+    """List counters one page at a time like service.routes"""
+    app.logger.info("Request to list all counters...")
+
+    prefix = request.args.get("prefix", "")
+    after = request.args.get("after", "")
+    limit = get_int_arg(
+        "limit", app.config["COUNTERS_PAGE_SIZE"], 1, app.config["COUNTERS_MAX_PAGE_SIZE"]
+    )
+
+    etag = await AsyncCounter.generation()
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    after, counters = await AsyncCounter.page(after, limit, prefix)
+
+    headers = {"ETag": f'"{etag}"'}
+    if after:
+        args = {"prefix": prefix} if prefix else {}
+        next_url = url_for(".list_counters", after=after, limit=limit, _external=True, **args)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+
+    app.logger.info("Returning %d counters...", len(counters))
+    return jsonify(counters), status.HTTP_200_OK, headers
+
+
+############################################################
+# Top counters
+############################################################
+@api.route("/counters/_top", methods=["GET"])
+async def top_counters():
+    """List the k highest counters from the highest down like service.routes"""
+    app.logger.info("Request to list the top counters...")
+    k = get_int_arg("k", 10, 1, max(app.config["COUNTERS_TOP_SIZE"], 1))
+
+    counters = await AsyncCounter.top(k)
+
+    app.logger.info("Returning %d counters...", len(counters))
+    return jsonify(counters), status.HTTP_200_OK
+
+
+############################################################
+# Export counters
+############################################################
+@api.route("/counters/_export", methods=["GET"])
+async def export_counters():
+    """Stream every counter as NDJSON or CSV like service.routes"""
+    app.logger.info("Request to export all counters...")
+
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        error(status.HTTP_400_BAD_REQUEST, f"Invalid value for 'format': {export_format}")
+    limit = get_int_arg(
+        "limit", app.config["COUNTERS_PAGE_SIZE"], 1, app.config["COUNTERS_MAX_PAGE_SIZE"]
+    )
+
+    pages = AsyncCounter.pages(limit, request.args.get("prefix", ""))
+    first = await anext(pages, [])
+
+    async def generate():
+        yield export_header(export_format)
+        yield export_chunk(first, export_format)
+        async for page in pages:
+            yield export_chunk(page, export_format)
+
+    return app.response_class(
+        generate(),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=counters.{export_format}"},
+    )
+
+
+############################################################
+# Import counters
+############################################################
+@api.route("/counters/_import", methods=["POST"])
+async def import_counters():
+    """Load counters from a streamed body of NDJSON or CSV like service.routes"""
+    app.logger.info("Request to import counters...")
+    import_format, overwrite, parser = start_import()
+
+    async for chunk in request.body:
+        for batch in parser.feed(chunk):
+            parser.report.add(await AsyncCounter.import_counters(batch, overwrite))
+    for batch in parser.close():
+        parser.report.add(await AsyncCounter.import_counters(batch, overwrite))
+
+    report = parser.report.serialize()
+    app.logger.info(
+        "Imported %d counters from %s at %.1f counters/second",
+        report["imported"], import_format, report["counters_per_second"],
+    )
+    return jsonify(report), status.HTTP_200_OK
+
+
+############################################################
+# Batch counters
+############################################################
+@api.route("/counters/_batch", methods=["POST"])
+async def batch_counters():
+    """Run many counter operations in one request like service.routes"""
+    app.logger.info("Request to run a batch of counter operations...")
+    check_content_type("application/json")
+
+    try:
+        results, operations = plan_batch(await request.get_json(), app.config["BATCH_MAX_OPERATIONS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    values = await AsyncCounter.batch([operation for _, operation in operations])
+    finish_batch(results, operations, values)
+
+    app.logger.info("Ran %d of %d batch operations", len(operations), len(results))
+    return jsonify(results), status.HTTP_200_OK
+
+
+############################################################
+# Stream the changes of many counters
+############################################################
+@api.route("/counters/_events", methods=["GET"])
+async def stream_counters():
+    """Stream the values of many counters whenever they change like service.routes"""
+    names = request.args.getlist("name")
+    app.logger.info("Request to stream %d counters...", len(names))
+    if not 0 < len(names) <= app.config["EVENTS_MAX_COUNTERS"]:
+        error(status.HTTP_400_BAD_REQUEST, f"Pass 1 to {app.config['EVENTS_MAX_COUNTERS']} 'name' parameters")
+
+    return await stream_events(names)
+
+
+############################################################
+# Add items to a unique counter
+############################################################
+@api.route("/counters/_unique/<name>", methods=["POST"])
+async def add_unique_items(name):
+    """Add items to a unique counter like service.routes"""
+    app.logger.info("Request to add items to unique counter: '%s'...", name)
+    check_content_type("application/json")
+    try:
+        items = parse_items(await request.get_json(), app.config["SKETCH_MAX_ITEMS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    counter = await AsyncUniqueCounter.add(name, items)
+
+    app.logger.info("Unique counter '%s' estimates %d items", name, counter.estimate)
+    return jsonify(counter.serialize()), status.HTTP_200_OK
+
+
+############################################################
+# Merge unique counters
+############################################################
+@api.route("/counters/_unique/<name>/_merge", methods=["POST"])
+async def merge_unique_counters(name):
+    """Add every item of other unique counters to a unique counter"""
+    app.logger.info("Request to merge into unique counter: '%s'...", name)
+    check_content_type("application/json")
+    try:
+        sources = parse_sources(await request.get_json(), app.config["SKETCH_MAX_ITEMS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    counter = await AsyncUniqueCounter.merge(name, sources)
+    if counter is None:
+        error(status.HTTP_404_NOT_FOUND, f"Unique counters {', '.join(sources)} must all exist")
+
+    app.logger.info("Unique counter '%s' estimates %d items", name, counter.estimate)
+    return jsonify(counter.serialize()), status.HTTP_200_OK
+
+
+############################################################
+# Read a unique counter
+############################################################
+@api.route("/counters/_unique/<name>", methods=["GET"])
+async def read_unique_counter(name):
+    """Read the estimated number of distinct items of a unique counter"""
+    app.logger.info("Request to Read unique counter: '%s'...", name)
+
+    counter = await AsyncUniqueCounter.find(name)
+    if not counter:
+        error(status.HTTP_404_NOT_FOUND, f"Unique counter '{name}' does not exist")
+
+    return jsonify(counter.serialize())
+
+
+############################################################
+# Delete a unique counter
+############################################################
+@api.route("/counters/_unique/<name>", methods=["DELETE"])
+async def delete_unique_counter(name):
+    """Delete a unique counter"""
+    app.logger.info("Request to Delete unique counter: '%s'...", name)
+
+    if await AsyncUniqueCounter.remove(name):
+        app.logger.info("Unique counter '%s' deleted", name)
+
+    return "", status.HTTP_204_NO_CONTENT
+
+
+############################################################
+# Create a frequency sketch
+############################################################
+@api.route("/counters/_frequency/<name>", methods=["POST"])
+async def create_frequency_sketch(name):
+    """Create a frequency sketch like service.routes"""
+    app.logger.info("Request to Create frequency sketch: '%s'...", name)
+    width, depth = get_sketch_args()
+
+    sketch = await AsyncFrequencySketch.create(name, width, depth)
+    if sketch is None:
+        error(status.HTTP_409_CONFLICT, f"Frequency sketch '{name}' already exists")
+
+    location_url = url_for(".read_frequency_sketch", name=name, _external=True)
+    app.logger.info("Frequency sketch '%s' created with %d x %d counters", name, depth, width)
+    return (
+        jsonify(sketch.serialize()),
+        status.HTTP_201_CREATED,
+        {"Location": location_url},
+    )
+
+
+############################################################
+# Add items to a frequency sketch
+############################################################
+@api.route("/counters/_frequency/<name>", methods=["PUT"])
+async def add_frequency_items(name):
+    """Add counts of items to a frequency sketch like service.routes"""
+    app.logger.info("Request to add items to frequency sketch: '%s'...", name)
+    check_content_type("application/json")
+    try:
+        items = parse_item_counts(await request.get_json(), app.config["SKETCH_MAX_ITEMS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    sketch = await AsyncFrequencySketch.add(name, items)
+    if sketch is None:
+        error(status.HTTP_404_NOT_FOUND, f"Frequency sketch '{name}' does not exist")
+
+    app.logger.info("Added %d items to frequency sketch '%s'", len(items), name)
+    return jsonify(sketch.serialize())
+
+
+############################################################
+# Read a frequency sketch
+############################################################
+@api.route("/counters/_frequency/<name>", methods=["GET"])
+async def read_frequency_sketch(name):
+    """Read a frequency sketch and the estimates of the ``item`` parameters"""
+    app.logger.info("Request to Read frequency sketch: '%s'...", name)
+    items = request.args.getlist("item")[:app.config["SKETCH_MAX_ITEMS"]]
+
+    sketch = await AsyncFrequencySketch.find(name, items)
+    if not sketch:
+        error(status.HTTP_404_NOT_FOUND, f"Frequency sketch '{name}' does not exist")
+
+    return jsonify(sketch.serialize())
+
+
+############################################################
+# Delete a frequency sketch
+############################################################
+@api.route("/counters/_frequency/<name>", methods=["DELETE"])
+async def delete_frequency_sketch(name):
+    """Delete a frequency sketch"""
+    app.logger.info("Request to Delete frequency sketch: '%s'...", name)
+
+    if await AsyncFrequencySketch.remove(name):
+        app.logger.info("Frequency sketch '%s' deleted", name)
+
+    return "", status.HTTP_204_NO_CONTENT
+
+
+############################################################
+# Read counters
+############################################################
+@api.route("/counters/<name>", methods=["GET"])
+async def read_counters(name):
+    """Read a counter"""
+    app.logger.info("Request to Read counter: '%s'...", name)
+
+    counter = await AsyncCounter.find(name)
+
+    if not counter:
+        error(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    cached = not_modified(counter.etag)
+    if cached:
+        return cached
+
+    app.logger.info("Returning: %d...", counter.count)
+    return jsonify(counter.serialize()), status.HTTP_200_OK, {"ETag": f'"{counter.etag}"'}
+
+
+############################################################
+# Read the rate of a counter
+############################################################
+@api.route("/counters/<name>/rate", methods=["GET"])
+async def read_rate(name):
+    """Read how many times a counter was incremented in a window of time
+
+    ``window`` is a number of seconds or a length like ``30s``, ``5m``,
+    ``1h`` or ``1d`` of at most a day. The increments are added up from
+    at most 60 rollups, so this costs the same however busy the counter is.
+    """
+    app.logger.info("Request for the rate of counter: '%s'...", name)
+
+    if not AsyncCounter.rates:
+        error(status.HTTP_501_NOT_IMPLEMENTED, "Rates are not kept, set RATES_ENABLED to keep them")
+    window = get_window_arg()
+    if not await AsyncCounter.find(name):
+        error(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    count = await AsyncCounter.rate(name, window)
+    app.logger.info("Counter '%s' was incremented %d times in %ds", name, count, window)
+    return jsonify(name=name, window=window, count=count, per_second=round(count / window, 3))
+
+
+############################################################
+# Stream the changes of a counter
+############################################################
+@api.route("/counters/<name>/events", methods=["GET"])
+async def stream_counter(name):
+    """Stream the value of a counter whenever it changes like service.routes"""
+    app.logger.info("Request to stream counter: '%s'...", name)
+
+    return await stream_events([name], must_exist=True)
+
+
+############################################################
+# Create counter
+############################################################
+@api.route("/counters/<name>", methods=["POST"])
+async def create_counters(name):
+    """Create a counter"""
+    app.logger.info("Request to Create counter: '%s'...", name)
+
+    stripes = get_int_arg("stripes", 1, 1, app.config["COUNTERS_MAX_STRIPES"])
+    counter = await AsyncCounter.create(name, stripes=stripes)
+    if counter is None:
+        error(status.HTTP_409_CONFLICT, f"Counter '{name}' already exists")
+
+    location_url = url_for(".read_counters", name=name, _external=True)
+    app.logger.info("Counter '%s' created", name)
+    return (
+        jsonify(counter.serialize()),
+        status.HTTP_201_CREATED,
+        {"Location": location_url},
+    )
+
+
+############################################################
+# Update counters
+############################################################
+@api.route("/counters/<name>", methods=["PUT"])
+async def update_counters(name):
+    """Update a counter"""
+    app.logger.info("Request to Update counter: '%s'...", name)
+
+    count = await AsyncCounter.increment_existing(name)
+    if count is None:
+        error(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Counter '%s' updated to %d", name, count)
+    return jsonify(name=name, counter=count)
+
+
+############################################################
+# Delete counters
+############################################################
+@api.route("/counters/<name>", methods=["DELETE"])
+async def delete_counters(name):
+    """Delete a counter"""
+    app.logger.info("Request to Delete counter: '%s'...", name)
+
+    if await AsyncCounter.remove(name):
+        app.logger.info("Counter '%s' deleted", name)
+
+    return "", status.HTTP_204_NO_CONTENT
+
+
+######################################################################
+# Error Handlers
+######################################################################
+# The same JSON bodies and headers that service.common.error_handlers sends back
+
+
+@api.app_errorhandler(DatabaseConnectionError)
+@count_errors
+async def request_validation_error(error_):
+    """Handles Value Errors from bad data, with Retry-After while the circuit is open"""
+    return error_response(status.HTTP_503_SERVICE_UNAVAILABLE, error_)
+
+
+@api.app_errorhandler(HTTPException)
+@count_errors
+async def http_error(error_):
+    """Handles the HTTP errors that have a JSON body"""
+    if error_.code not in ERROR_TITLES:
+        return error_
+    return error_response(error_.code, error_)
+
+
+def error_response(status_code, error_):
+    """Logs an error and returns its JSON body"""
+    message = str(error_)
+    if status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+        app.logger.error(message)
+    else:
+        app.logger.warning(message)
+    return Response(
+        error_body(status_code, message),
+        status=status_code,
+        headers=error_headers(error_),
+        mimetype="application/json",
+    )
+
+
+############################################################
+#         U T I L I T Y   F U N C T I O N S
+############################################################
+
+
+def error(status_code, reason):
+    """Logs the error and then aborts"""
+    app.logger.error(reason)
+    abort(status_code, reason)
+
+
+def not_modified(etag: str):
+    """Returns 304_NOT_MODIFIED if the client already has the entity with the tag or None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def get_int_arg(name, default, minimum=0, maximum=None):
+    """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+    try:
+        return parse_int(request.args.get(name, default), name, minimum, maximum)
+    except ValueError as err:
+        return error(status.HTTP_400_BAD_REQUEST, str(err))
+
+
+def get_window_arg():
+    """Returns the window query parameter in seconds or aborts with 400_BAD_REQUEST"""
+    try:
+        return parse_window(request.args.get("window", "1m"))
+    except ValueError as err:
+        return error(status.HTTP_400_BAD_REQUEST, str(err))
+
+
+def get_sketch_args():
+    """Returns the width and depth of a sketch with the error and confidence parameters or aborts"""
+    try:
+        return sketch_dimensions(
+            request.args.get("error", app.config["SKETCH_ERROR"]),
+            request.args.get("confidence", app.config["SKETCH_CONFIDENCE"]),
+        )
+    except ValueError as err:
+        return error(status.HTTP_400_BAD_REQUEST, str(err))
+
+
+async def read_values(names: list) -> dict:
+    """Returns the values of counters by name with None for the missing ones"""
+    counters = await AsyncCounter.find_many(names)
+    return {name: counter.count if counter else None for name, counter in zip(names, counters)}
+
+
+async def stream_events(names: list, must_exist: bool = False):
+    """Returns a response that streams the values of counters whenever they change"""
+    hub = AsyncCounter.events
+    if hub is None:
+        error(status.HTTP_501_NOT_IMPLEMENTED, "Events are not streamed, set EVENTS_ENABLED to stream them")
+    subscription = AsyncSubscription(names, app.config["EVENTS_WINDOW"])
+    hub.add(subscription)
+    try:
+        first = await read_values(names)
+    except DatabaseConnectionError:
+        hub.remove(subscription)
+        raise
+    if must_exist and first[names[0]] is None:
+        hub.remove(subscription)
+        error(status.HTTP_404_NOT_FOUND, f"Counter '{names[0]}' does not exist")
+    keepalive = app.config["EVENTS_KEEPALIVE"]
+
+    async def generate():
+        try:
+            yield format_events(first)
+            while True:
+                changes = await subscription.get(keepalive)
+                changes.update(await read_values(resync_names(changes)))
+                yield format_events(changes) if changes else KEEPALIVE
+        finally:
+            hub.remove(subscription)
+
+    response = app.response_class(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # the stream stays open for as long as the client wants it
+    response.timeout = None
+    return response
+
+
+def start_import():
+    """Returns the format, mode and parser of an import or aborts"""
+    formats = {mimetype: name for name, mimetype in EXPORT_FORMATS.items()}
+    if request.mimetype not in formats:
+        error(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            f"Content-Type must be one of {', '.join(formats)}",
+        )
+    mode = request.args.get("mode", "skip")
+    if mode not in ("skip", "overwrite"):
+        error(status.HTTP_400_BAD_REQUEST, f"Invalid value for 'mode': {mode}")
+    batch_size = get_int_arg(
+        "batch_size", app.config["IMPORT_BATCH_SIZE"], 1, app.config["IMPORT_MAX_BATCH_SIZE"]
+    )
+    report = ImportReport(app.config["IMPORT_MAX_ERRORS"])
+    import_format = formats[request.mimetype]
+    return import_format, mode == "overwrite", ImportParser(import_format, batch_size, report)
+
+
+def check_content_type(content_type):
+    """Checks that the media type is correct"""
+    if request.mimetype != content_type:
+        error(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            f"Content-Type must be {content_type}",
+        )
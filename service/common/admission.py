@@ -0,0 +1,165 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Control
+
+This module keeps a worker from taking on more requests than it can
+serve quickly, so that the requests it does take keep a short latency
+during a spike instead of every request queueing until clients time out.
+
+Requests are sorted into reads, writes and listings, and each class has
+a limit on the requests of a worker that run at once. A request over the
+limit waits in a short queue for one to finish, and is turned away when
+the queue is full or it waited too long.
+
+How long a request may wait follows CoDel: while some request got in
+with less than ``target`` seconds of waiting in the last ``interval``,
+the queue is draining and a request may wait up to ``interval``. Once
+every request in an interval waited longer than ``target``, the queue is
+standing and a request only waits up to ``target``, which sheds the load
+that the worker cannot keep up with until the queue drains again.
+"""
+import time
+import threading
+from service.common.metrics import REQUESTS_SHED, labelled
+
+READ = "read"
+WRITE = "write"
+LISTING = "listing"
+ROUTE_CLASSES = [READ, WRITE, LISTING]
+
+# the routes that read many counters at once
+LISTING_ENDPOINTS = {"list_counters", "top_counters", "export_counters"}
+
+# the routes that are never turned away, the event streams because they stay open
+EXEMPT_ENDPOINTS = {"index", "metrics", "read_profiling", "update_profiling", "stream_counters", "stream_counter"}
+
+
+def route_class(endpoint: str, method: str):
+    """Returns the class of the requests of a route, or None if they are never limited"""
+    if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if endpoint in LISTING_ENDPOINTS:
+        return LISTING
+    if method in ("GET", "HEAD"):
+        return READ
+    return WRITE
+
+
+class Limiter:  # pylint: disable=too-many-instance-attributes
+    """Lets a number of requests run at once and queues a few more
+
+    Arguments:
+        limit: the most requests that run at once
+        max_queue: the most requests that wait for one of them to finish
+        target: the seconds of waiting that a request may take while the queue stands
+        interval: the seconds over which the shortest wait is taken, and
+            the longest a request may wait while the queue drains
+    """
+
+    def __init__(self, limit: int, max_queue: int = 0, target: float = 0.005, interval: float = 0.1):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.target = target
+        self.interval = interval
+        self.in_flight = 0
+        self.waiting = 0
+        self.standing = False
+        self._shortest_wait = float("inf")
+        self._interval_end = time.monotonic() + interval
+        self._ready = threading.Condition()
+
+    def acquire(self) -> bool:
+        """Waits for a request to be let in and returns False if it is turned away"""
+        with self._ready:
+            if self.in_flight < self.limit and not self.waiting:
+                self.in_flight += 1
+                self._observe(0.0)
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            timeout = self.target if self.standing else self.interval
+            start = time.monotonic()
+            self.waiting += 1
+            try:
+                admitted = self._ready.wait_for(lambda: self.in_flight < self.limit, timeout)
+            finally:
+                self.waiting -= 1
+            self._observe(time.monotonic() - start)
+            if admitted:
+                self.in_flight += 1
+            return admitted
+
+    def release(self):
+        """Lets the next waiting request in after one finished"""
+        with self._ready:
+            self.in_flight -= 1
+            self._ready.notify()
+
+    def status(self) -> dict:
+        """Returns the requests that run and wait and whether the queue stands"""
+        with self._ready:
+            return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting, "standing": self.standing}
+
+    def _observe(self, wait: float):
+        """Keeps the shortest wait and decides once an interval if the queue stands"""
+        now = time.monotonic()
+        self._shortest_wait = min(self._shortest_wait, wait)
+        if now >= self._interval_end:
+            self.standing = self._shortest_wait > self.target
+            self._shortest_wait = float("inf")
+            self._interval_end = now + self.interval
+
+
+class AdmissionController:
+    """Limits the requests of each route class that a worker runs at once
+
+    Arguments:
+        limits: the limit of each route class, where a class that is left
+            out or is 0 is not limited
+        max_queue: the most requests of each class that wait
+        target: see Limiter
+        interval: see Limiter
+    """
+
+    def __init__(self, limits: dict, max_queue: int = 16, target: float = 0.005, interval: float = 0.1):
+        unknown = set(limits) - set(ROUTE_CLASSES)
+        if unknown:
+            raise ValueError(f"route classes must be {', '.join(ROUTE_CLASSES)}")
+        self.limiters = {
+            name: Limiter(limit, max_queue, target, interval)
+            for name, limit in limits.items()
+            if limit
+        }
+
+    def admit(self, name: str) -> bool:
+        """Lets a request of a route class in, or counts and turns it away"""
+        limiter = self.limiters.get(name)
+        if limiter is None or limiter.acquire():
+            return True
+        labelled(REQUESTS_SHED, name).inc()
+        return False
+
+    def release(self, name: str):
+        """Notes that a request that was let in finished"""
+        limiter = self.limiters.get(name)
+        if limiter is not None:
+            limiter.release()
+
+    def status(self) -> dict:
+        """Returns the status of the limiter of every route class"""
+        return {name: limiter.status() for name, limiter in self.limiters.items()}
@@ -0,0 +1,137 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Hash Buckets
+
+This module maps counter names to small Redis hashes.
+
+A Redis key costs far more memory than the 8 bytes of a counter value,
+so counters can instead be kept as fields of a fixed number of hashes.
+While a hash holds fewer fields than ``hash-max-listpack-entries``
+(``hash-max-ziplist-entries`` before Redis 7), 128 by default, Redis
+stores it as one compact listpack and every counter only costs its
+name and value. The number of buckets should be about the number of
+counters divided by 100 so that the buckets stay under that threshold.
+"""
+import zlib
+import redis
+
+BUCKET_PREFIX = "counters/bucket/"
+
+
+def bucket_key(name: str, buckets: int) -> str:
+    """Returns the key of the hash that holds a counter"""
+    return f"{BUCKET_PREFIX}{zlib.crc32(name.encode('utf-8')) % buckets}"
+
+
+def is_bucket_key(key: str) -> bool:
+    """Returns True if the key is the key of a bucket"""
+    return key.startswith(BUCKET_PREFIX)
+
+
+def group_by_bucket(names: list, buckets: int) -> dict:
+    """Groups the positions of the names by the key of their bucket"""
+    groups = {}
+    for position, name in enumerate(names):
+        groups.setdefault(bucket_key(name, buckets), []).append(position)
+    return groups
+
+
+def ungroup(groups: dict, results: list, size: int) -> list:
+    """Puts the results of HMGETs of grouped names back in the order of the names"""
+    values = [None] * size
+    for positions, bucket_values in zip(groups.values(), results):
+        for position, value in zip(positions, bucket_values):
+            values[position] = value
+    return values
+
+
+def move_to_bucket(source, target, key: str, bucket: str, retries: int = 3) -> bool:
+    """Moves a counter from a string key into a field of its bucket
+
+    The key is watched while it is copied so that it is only removed if it
+    did not change in the meantime, and the copy is tried again instead. A
+    field that already exists in the bucket is left alone.
+
+    Arguments:
+        source: the Redis node of the key
+        target: the Redis node of the bucket
+        key: the key of the counter, which is also its field
+        bucket: the key of the bucket
+    """
+    for _ in range(retries):
+        with source.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                value = pipe.get(key)
+                if value is None:
+                    return True
+                if not target.hsetnx(bucket, key, value):
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                target.hdel(bucket, key)
+    return False
+
+
+def measure_storage(client, counters: int = 10000, per_bucket: int = 100) -> dict:
+    """Measures the bytes per counter of one key per counter and of buckets
+
+    The same counters are written both ways under keys that counters can
+    never have, the memory of every key is added up with MEMORY USAGE and
+    the keys are removed again. MEMORY USAGE leaves out the entry of each
+    key in the keyspace itself, which adds a few dozen bytes to every key.
+
+    Arguments:
+        client: a Redis client connected to a real Redis server
+        counters: the number of counters to write
+        per_bucket: the number of counters in each bucket
+    """
+    names = [f"counter{index}" for index in range(counters)]
+    keys = [f"benchmark/key/{name}" for name in names]
+    buckets = max(counters // per_bucket, 1)
+    bucket_keys = [f"benchmark/bucket/{index}" for index in range(buckets)]
+    try:
+        for start in range(0, counters, 1000):
+            client.mset({key: index for index, key in enumerate(keys[start:start + 1000], start)})
+        pipe = client.pipeline(transaction=False)
+        for index, name in enumerate(names):
+            pipe.hset(bucket_keys[zlib.crc32(name.encode("utf-8")) % buckets], name, index)
+        pipe.execute()
+        key_bytes = _memory_usage(client, keys)
+        bucket_bytes = _memory_usage(client, bucket_keys)
+    finally:
+        for start in range(0, counters, 1000):
+            client.delete(*keys[start:start + 1000])
+        client.delete(*bucket_keys)
+    return {
+        "counters": counters,
+        "buckets": buckets,
+        "key_bytes_per_counter": round(key_bytes / counters, 1),
+        "bucket_bytes_per_counter": round(bucket_bytes / counters, 1),
+    }
+
+
+def _memory_usage(client, keys: list) -> int:
+    """Adds up the memory of the keys with one pipeline"""
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key, samples=0)
+    return sum(usage or 0 for usage in pipe.execute())
@@ -0,0 +1,111 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+LRU Cache
+
+This module contains a small in-process cache that evicts the least
+recently used entries when it is full and expires entries after a time
+to live so that a missed invalidation can only leave it stale for a while.
+Its hits, misses and evictions are also counted in service.common.metrics
+for GET /metrics.
+"""
+import time
+import threading
+from collections import OrderedDict
+from service.common.metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    CACHE_EVICTIONS,
+    CACHE_EXPIRATIONS,
+    CACHE_INVALIDATIONS,
+)
+
+
+class LRUCache:
+    """A thread safe least recently used cache with expiring entries
+
+    Arguments:
+        max_size: the most entries to keep before evicting the oldest
+        ttl: seconds that an entry stays valid after it is set
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 1.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the value for the key or None if it is missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                CACHE_MISSES.inc()
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                CACHE_EXPIRATIONS.inc()
+                CACHE_MISSES.inc()
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            CACHE_HITS.inc()
+            return value
+
+    def set(self, key, value):
+        """Stores the value evicting the least recently used entries"""
+        with self._lock:
+            self._data[key] = (value, self.clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+                CACHE_EVICTIONS.inc()
+
+    def invalidate(self, key):
+        """Removes the key from the cache"""
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+                CACHE_INVALIDATIONS.inc()
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Returns the size of the cache and its hit, miss and eviction counts"""
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
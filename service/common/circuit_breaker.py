@@ -0,0 +1,208 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Circuit Breaker
+
+This module stops a worker from sending commands to a Redis node that is
+down or too slow, so that requests fail right away instead of each one
+waiting out the socket timeouts while the worker can serve nothing else.
+
+A breaker is closed while the node is healthy and keeps the outcome of
+its last calls. A call fails when the connection fails or times out, or
+when it takes longer than ``slow_seconds``. Once at least ``min_calls``
+calls were made and ``failure_rate`` of them failed, the breaker opens
+and every call raises CircuitOpenError without touching the network.
+
+After a while the breaker is half open and lets a single call through as
+a probe. The breaker closes again if the probe succeeds and opens again
+if it fails, for twice as long each time up to ``max_open_seconds``. The
+time is picked at random between half and all of it, so that the workers
+do not all probe a recovering node at once.
+"""
+import math
+import time
+import random
+import logging
+import threading
+from collections import deque
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from service.common.metrics import CIRCUIT_OPENED, CIRCUIT_REJECTED
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(RedisConnectionError):
+    """Raised instead of calling a Redis node whose circuit is open
+
+    Arguments:
+        retry_after: seconds until the breaker lets a probe through
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Redis is unavailable, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:  # pylint: disable=too-many-instance-attributes
+    """Fails the calls to a Redis node fast while it fails or is too slow
+
+    Arguments:
+        failure_rate: the share of failed calls that opens the circuit
+        slow_seconds: calls that take longer count as failed
+        window: the number of recent calls that the failure rate is taken over
+        min_calls: the fewest calls in the window before it can open
+        open_seconds: how long the circuit stays open the first time
+        max_open_seconds: the longest the circuit stays open after failed probes
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        failure_rate: float = 0.5,
+        slow_seconds: float = 1.0,
+        window: int = 20,
+        min_calls: int = 10,
+        open_seconds: float = 1.0,
+        max_open_seconds: float = 30.0,
+        clock=time.monotonic,
+    ):
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.retry_at = 0.0
+        self._outcomes = deque(maxlen=window)
+        self._openings = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        """Calls a function that talks to Redis unless the circuit is open
+
+        Raises:
+            CircuitOpenError: the circuit is open
+        """
+        self.before()
+        failed, start = False, time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except (RedisConnectionError, RedisTimeoutError):
+            failed = True
+            raise
+        finally:
+            self.record(failed, time.perf_counter() - start)
+
+    async def call_async(self, function, *args, **kwargs):
+        """Awaits a coroutine function that talks to Redis like call()"""
+        self.before()
+        failed, start = False, time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except (RedisConnectionError, RedisTimeoutError):
+            failed = True
+            raise
+        finally:
+            self.record(failed, time.perf_counter() - start)
+
+    def before(self):
+        """Lets a call through or raises CircuitOpenError
+
+        Once an open circuit has waited long enough it turns half open and
+        only the first call after that goes through as the probe
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = self.clock()
+            if self.state == OPEN and now >= self.retry_at:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(self.retry_at - now, 0.0)
+        CIRCUIT_REJECTED.inc()
+        raise CircuitOpenError(retry_after)
+
+    def record(self, failed: bool, seconds: float):
+        """Records the outcome of a call and opens or closes the circuit"""
+        failed = failed or seconds > self.slow_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self._close()
+            elif self.state == CLOSED:
+                self._outcomes.append(failed)
+                if len(self._outcomes) >= self.min_calls and sum(self._outcomes) >= self.failure_rate * len(self._outcomes):
+                    self._open()
+
+    def status(self) -> dict:
+        """Returns the state of the circuit and the failures in its window"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "failures": sum(self._outcomes),
+                "retry_after": max(self.retry_at - self.clock(), 0.0) if self.state != CLOSED else 0.0,
+            }
+
+    def _open(self):
+        """Opens the circuit for a jittered time that doubles with every opening"""
+        seconds = min(self.open_seconds * 2**self._openings, self.max_open_seconds)
+        seconds = random.uniform(seconds / 2, seconds)
+        self._openings += 1
+        self.state = OPEN
+        self.retry_at = self.clock() + seconds
+        self._outcomes.clear()
+        self._probing = False
+        CIRCUIT_OPENED.inc()
+        logger.warning("Opened the circuit to Redis for %.1fs", seconds)
+
+    def _close(self):
+        """Closes the circuit after a probe succeeded"""
+        self.state = CLOSED
+        self._openings = 0
+        self._outcomes.clear()
+        logger.info("Closed the circuit to Redis")
+
+
+def breaker_options(config) -> dict:
+    """Returns the options of the circuit breakers from the CIRCUIT_ settings of an app"""
+    return {
+        "failure_rate": config["CIRCUIT_FAILURE_RATE"],
+        "slow_seconds": config["CIRCUIT_SLOW_SECONDS"],
+        "window": config["CIRCUIT_WINDOW"],
+        "min_calls": config["CIRCUIT_MIN_CALLS"],
+        "open_seconds": config["CIRCUIT_OPEN_SECONDS"],
+        "max_open_seconds": config["CIRCUIT_MAX_OPEN_SECONDS"],
+    }
+
+
+def retry_after(error: Exception):
+    """Returns the Retry-After header for an error caused by an open circuit, or None"""
+    cause = error if isinstance(error, CircuitOpenError) else error.__cause__
+    if not isinstance(cause, CircuitOpenError):
+        return None
+    return str(max(math.ceil(cause.retry_after), 1))
@@ -0,0 +1,120 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Flask CLI Command Extensions
+"""
+import click
+from flask import current_app as app  # Import Flask application
+from service.common.buckets import measure_storage
+from service.common.json_provider import measure_json
+from service.common.sharding import ShardedRedis
+from service.models import Counter
+
+
+######################################################################
+# Command to move counters to their shards after adding Redis nodes
+# Usage:
+#   flask rebalance [--dry-run]
+######################################################################
+@app.cli.command("rebalance")
+@click.option("--dry-run", is_flag=True, help="Only count the counters that would move")
+def rebalance(dry_run):
+    """
+    Moves every counter to the Redis node that owns it. Run this after
+    adding a uri to DATABASE_URI so that the counters on the old nodes
+    can be found on their new node.
+    """
+    totals = Counter.rebalance(dry_run)
+    verb = "Would move" if dry_run else "Moved"
+    click.echo(
+        f"{verb} {totals['moved']} of {totals['scanned']} keys, {totals['conflicts']} conflicts"
+    )
+
+
+######################################################################
+# Command to add counters created before the name index to it
+# Usage:
+#   flask reindex
+######################################################################
+@app.cli.command("reindex")
+def reindex():
+    """
+    Adds every counter to the index of counter names that listings are
+    read from and removes the names of counters that are gone. Run this
+    once on a database with counters from before the index existed.
+    """
+    totals = Counter.reindex()
+    click.echo(f"Indexed {totals['indexed']} counters, removed {totals['removed']} names")
+
+
+######################################################################
+# Command to move counters kept in keys of their own into hash buckets
+# Usage:
+#   flask migrate-buckets
+######################################################################
+@app.cli.command("migrate-buckets")
+def migrate_buckets():
+    """
+    Moves every counter that has a key of its own into its hash bucket.
+    Run this after setting COUNTERS_BUCKETS on a database with counters
+    so that they can be found in their buckets.
+    """
+    if not Counter.buckets:
+        raise click.ClickException("Set COUNTERS_BUCKETS to the number of buckets first")
+    totals = Counter.migrate_to_buckets()
+    click.echo(
+        f"Moved {totals['moved']} of {totals['scanned']} keys into {Counter.buckets} buckets, "
+        f"{totals['conflicts']} conflicts"
+    )
+
+
+######################################################################
+# Command to compare the memory of a key per counter and of buckets
+# Usage:
+#   flask storage-benchmark [--counters 10000] [--per-bucket 100]
+######################################################################
+@app.cli.command("storage-benchmark")
+@click.option("--counters", default=10000, show_default=True, help="The number of counters to write")
+@click.option("--per-bucket", default=100, show_default=True, help="The number of counters in each bucket")
+def storage_benchmark(counters, per_bucket):
+    """
+    Writes the same counters as keys of their own and into hash buckets
+    and prints the bytes that each counter takes in Redis both ways. It
+    needs a real Redis server because it uses MEMORY USAGE.
+    """
+    client = Counter.redis.clients[0] if isinstance(Counter.redis, ShardedRedis) else Counter.redis
+    result = measure_storage(client, counters, per_bucket)
+    click.echo(f"{result['counters']} counters in {result['buckets']} buckets")
+    click.echo(f"Key per counter: {result['key_bytes_per_counter']} bytes per counter")
+    click.echo(f"Hash buckets:    {result['bucket_bytes_per_counter']} bytes per counter")
+
+
+######################################################################
+# Command to compare the CPU time of the JSON providers
+# Usage:
+#   flask json-benchmark [--responses 10000]
+######################################################################
+@app.cli.command("json-benchmark")
+@click.option("--responses", default=10000, show_default=True, help="The number of responses of each kind to build")
+def json_benchmark(responses):
+    """
+    Builds the same responses with the JSON provider of Flask and with
+    orjson and prints the CPU microseconds that each response takes.
+    """
+    click.echo(f"{'Response':<14}{'flask':>10}{'orjson':>10}")
+    for name, times in measure_json(app._get_current_object(), responses).items():
+        click.echo(f"{name:<14}{times['flask']:>8.2f}us{times['orjson']:>8.2f}us")
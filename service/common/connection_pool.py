@@ -0,0 +1,160 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Connection Pools
+
+This module contains Redis connection pools that keep track of how much
+they are used so that workers can be sized against the capacity of Redis.
+The same figures are also counted in service.common.metrics for GET /metrics.
+"""
+import time
+import threading
+import redis
+from service.common.metrics import (
+    POOL_IN_USE,
+    POOL_CREATED,
+    POOL_CHECKOUTS,
+    POOL_WAIT_SECONDS,
+    POOL_TIMEOUTS,
+    POOL_CONNECT_ERRORS,
+)
+
+# the errors of redis-py pools that had no free connection, as opposed to
+# the connection errors of a Redis server that is down or refuses them
+EXHAUSTED_MESSAGES = ("Too many connections", "No connection available")
+
+
+def is_exhausted(error: Exception) -> bool:
+    """Returns True if an error says that a pool had no free connection"""
+    return str(error).startswith(EXHAUSTED_MESSAGES)
+
+
+class PoolStatsMixin:
+    """Counts the connections that a Redis connection pool hands out"""
+
+    def __init__(self, *args, **kwargs):
+        self._stats_lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connect_errors = 0
+        self.wait_seconds = 0.0
+        self._checked_out = set()
+        super().__init__(*args, **kwargs)
+
+    def make_connection(self):
+        """Creates a new connection and counts it"""
+        connection = super().make_connection()
+        with self._stats_lock:
+            self.created += 1
+        POOL_CREATED.inc()
+        return connection
+
+    def get_connection(self, *args, **kwargs):
+        """Checks out a connection and counts how long it took to get
+
+        A pool that had no free connection counts a timeout, and one that
+        could not connect to Redis counts a connect error
+        """
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError) as err:
+            self._count_error(err)
+            raise
+        wait = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self._checked_out.add(id(connection))
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        POOL_CHECKOUTS.inc()
+        POOL_WAIT_SECONDS.inc(wait)
+        POOL_IN_USE.inc()
+        return connection
+
+    def _count_error(self, error: Exception):
+        """Counts a failed checkout as a timeout or a connect error"""
+        exhausted = is_exhausted(error)
+        with self._stats_lock:
+            if exhausted:
+                self.timeouts += 1
+            else:
+                self.connect_errors += 1
+        if exhausted:
+            POOL_TIMEOUTS.inc()
+        else:
+            POOL_CONNECT_ERRORS.inc()
+
+    def release(self, connection):
+        """Returns a connection to the pool
+
+        redis-py also releases a connection that failed to connect before
+        it was handed out, so only the connections that were counted as
+        checked out are counted as returned
+        """
+        super().release(connection)
+        with self._stats_lock:
+            if id(connection) not in self._checked_out:
+                return
+            self._checked_out.discard(id(connection))
+            self.in_use -= 1
+        POOL_IN_USE.dec()
+
+    def stats(self) -> dict:
+        """Returns the utilization of the pool"""
+        with self._stats_lock:
+            return {
+                "max_connections": self.max_connections,
+                "created": self.created,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connect_errors": self.connect_errors,
+                "wait_seconds": round(self.wait_seconds, 6),
+            }
+
+
+class ConnectionPool(PoolStatsMixin, redis.ConnectionPool):
+    """A connection pool that fails right away when it is exhausted"""
+
+
+class BlockingConnectionPool(PoolStatsMixin, redis.BlockingConnectionPool):
+    """A connection pool that waits for a free connection when it is exhausted"""
+
+
+def create_pool(database_uri: str, max_connections: int = None, pool_timeout: float = None, **options):
+    """Creates a connection pool for a Redis database uri
+
+    Arguments:
+        database_uri: a uri to the Redis database
+        max_connections: the most connections the pool will open
+        pool_timeout: seconds to wait for a free connection when all of
+            them are in use, or None to fail right away
+        options: socket_timeout, socket_connect_timeout, socket_keepalive,
+            health_check_interval and the other Redis connection options
+    """
+    options = {"encoding": "utf-8", "decode_responses": True, **options}
+    if max_connections:
+        options["max_connections"] = max_connections
+    if pool_timeout:
+        return BlockingConnectionPool.from_url(database_uri, timeout=pool_timeout, **options)
+    return ConnectionPool.from_url(database_uri, **options)
@@ -17,75 +17,133 @@
 """
 Error Handlers
 
-This module contains error handlers functions to send back errors as json
+This module contains error handlers functions to send back errors as json.
+The JSON bodies of the errors are also sent back by service.async_routes
 """
-from flask import jsonify
+from flask import Blueprint
 from flask import current_app as app
 from service.common import status
+from service.common.circuit_breaker import retry_after
+from service.common.json_provider import JsonTemplate
+from service.common.metrics import count_errors
 from service.models import DatabaseConnectionError
 
 ######################################################################
 # Error Handlers
 ######################################################################
 
+# the error handlers, which init_app() registers with the app
+errors = Blueprint("errors", __name__)
 
-@app.errorhandler(DatabaseConnectionError)
+
+@errors.app_errorhandler(DatabaseConnectionError)
 def request_validation_error(error):
-    """Handles Value Errors from bad data"""
+    """Handles Value Errors from bad data
+
+    The error is counted by service_unavailable
+    """
     return service_unavailable(error)
 
 
-@app.errorhandler(status.HTTP_404_NOT_FOUND)
+@errors.app_errorhandler(status.HTTP_400_BAD_REQUEST)
+@count_errors
+def bad_request(error):
+    """Handles bad requests with 400_BAD_REQUEST"""
+    message = str(error)
+    app.logger.warning(message)
+    return error_response(status.HTTP_400_BAD_REQUEST, message)
+
+
+@errors.app_errorhandler(status.HTTP_401_UNAUTHORIZED)
+@count_errors
+def unauthorized(error):
+    """Handles requests without the right credentials with 401_UNAUTHORIZED"""
+    message = str(error)
+    app.logger.warning(message)
+    return error_response(status.HTTP_401_UNAUTHORIZED, message)
+
+
+@errors.app_errorhandler(status.HTTP_404_NOT_FOUND)
+@count_errors
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
     message = str(error)
     app.logger.warning(message)
-    return (
-        jsonify(status=status.HTTP_404_NOT_FOUND, error="Not Found", message=message),
-        status.HTTP_404_NOT_FOUND,
-    )
+    return error_response(status.HTTP_404_NOT_FOUND, message)
 
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@errors.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@count_errors
 def method_not_supported(error):
     """Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED"""
     message = str(error)
     app.logger.warning(message)
-    return (
-        jsonify(
-            status=status.HTTP_405_METHOD_NOT_ALLOWED,
-            error="Method not Allowed",
-            message=message,
-        ),
-        status.HTTP_405_METHOD_NOT_ALLOWED,
-    )
+    return error_response(status.HTTP_405_METHOD_NOT_ALLOWED, message)
+
+
+@errors.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@count_errors
+def mediatype_not_supported(error):
+    """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
+    message = str(error)
+    app.logger.warning(message)
+    return error_response(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, message)
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@errors.app_errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@count_errors
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
     message = str(error)
     app.logger.error(message)
-    return (
-        jsonify(
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            error="Internal Server Error",
-            message=message,
-        ),
-        status.HTTP_500_INTERNAL_SERVER_ERROR,
-    )
+    return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, message)
 
 
-@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+@errors.app_errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+@count_errors
 def service_unavailable(error):
-    """Handles unexpected server error with 503_SERVICE_UNAVAILABLE"""
+    """Handles unexpected server error with 503_SERVICE_UNAVAILABLE, see error_headers()"""
     message = str(error)
     app.logger.error(message)
-    return (
-        jsonify(
-            status=status.HTTP_503_SERVICE_UNAVAILABLE,
-            error="Service is unavailable",
-            message=message,
-        ),
-        status.HTTP_503_SERVICE_UNAVAILABLE,
-    )
+    response = error_response(status.HTTP_503_SERVICE_UNAVAILABLE, message)
+    response.headers.update(error_headers(error))
+    return response
+
+
+######################################################################
+# Error Envelopes
+######################################################################
+
+# the errors that are sent back with a JSON body and their titles
+ERROR_TITLES = {
+    status.HTTP_400_BAD_REQUEST: "Bad Request",
+    status.HTTP_401_UNAUTHORIZED: "Unauthorized",
+    status.HTTP_404_NOT_FOUND: "Not Found",
+    status.HTTP_405_METHOD_NOT_ALLOWED: "Method not Allowed",
+    status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: "Unsupported media type",
+    status.HTTP_500_INTERNAL_SERVER_ERROR: "Internal Server Error",
+    status.HTTP_503_SERVICE_UNAVAILABLE: "Service is unavailable",
+}
+
+# the body of every error with everything but its message encoded once
+ERROR_TEMPLATES = {code: JsonTemplate({"status": code, "error": title}, "message") for code, title in ERROR_TITLES.items()}
+
+
+def error_body(status_code, message) -> bytes:
+    """Returns the JSON body of an error from its template"""
+    return ERROR_TEMPLATES[status_code].render(message=message)
+
+
+def error_headers(error: Exception) -> dict:
+    """Returns the headers of an error response
+
+    While the circuit to Redis is open, or a request was turned away by
+    admission control, Retry-After tells the client when to try again
+    """
+    seconds = retry_after(error) or getattr(error, "retry_after", None)
+    return {"Retry-After": str(seconds)} if seconds else {}
+
+
+def error_response(status_code, message):
+    """Returns the JSON response of an error from its template"""
+    return app.response_class(error_body(status_code, message), status=status_code, mimetype="application/json")
@@ -0,0 +1,169 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Events
+
+This module fans the counter changes of the one pub/sub subscription of a
+worker out to the Server-Sent Events streams of its clients.
+
+Every stream has a subscription that only keeps the latest value of each
+counter it watches. A stream waits for the first change, then for a short
+window, and sends every counter that changed in the meantime once, so a
+hot counter costs a stream at most one event per window however often it
+is incremented, and a slow client never holds more than one value per
+counter.
+"""
+import json
+import time
+import asyncio
+import threading
+
+# the value of a counter whose changes could have been missed and must be read again
+RESYNC = object()
+
+# a comment that keeps idle streams open and finds clients that went away
+KEEPALIVE = ": keepalive\n\n"
+
+
+class EventHub:
+    """Passes counter changes to the subscriptions that watch them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._watchers = {}
+
+    def __len__(self) -> int:
+        """Returns the number of subscriptions"""
+        return len(self._subscriptions)
+
+    def add(self, subscription, limit: int = 0) -> bool:
+        """Starts passing the changes of its counters to a subscription
+
+        Returns False without adding it when the hub already has ``limit``
+        subscriptions, where 0 is no limit
+        """
+        with self._lock:
+            if limit and len(self._subscriptions) >= limit:
+                return False
+            self._subscriptions.add(subscription)
+            for name in subscription.names:
+                self._watchers.setdefault(name, set()).add(subscription)
+            return True
+
+    def remove(self, subscription):
+        """Stops passing changes to a subscription"""
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            for name in subscription.names:
+                watchers = self._watchers.get(name, set())
+                watchers.discard(subscription)
+                if not watchers:
+                    self._watchers.pop(name, None)
+
+    def dispatch(self, name: str, value):
+        """Passes the change of a counter to every subscription that watches it"""
+        with self._lock:
+            watchers = list(self._watchers.get(name, ()))
+        for subscription in watchers:
+            subscription.put(name, value)
+
+    def reset(self):
+        """Tells every subscription to read its counters again after changes were missed"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            for name in subscription.names:
+                subscription.put(name, RESYNC)
+
+
+class Subscription:
+    """The changes to some counters that one stream has not sent yet
+
+    Arguments:
+        names: the names of the counters to watch
+        window: seconds to gather changes for before they are sent
+    """
+
+    def __init__(self, names, window: float = 0.2):
+        self.names = frozenset(names)
+        self.window = window
+        self._changes = {}
+        self._ready = threading.Condition()
+
+    def put(self, name: str, value):
+        """Records the latest value of a counter"""
+        with self._ready:
+            self._changes[name] = value
+            self._ready.notify()
+
+    def get(self, timeout: float) -> dict:
+        """Waits up to timeout seconds for changes and returns them by name
+
+        Once there is a change, the changes of another window are gathered
+        with it. Returns an empty dict if nothing changed.
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._changes, timeout):
+                return {}
+        time.sleep(self.window)
+        with self._ready:
+            changes, self._changes = self._changes, {}
+        return changes
+
+
+class AsyncSubscription(Subscription):
+    """A Subscription that a stream waits on in an event loop
+
+    Changes must be put from the event loop of the stream.
+    """
+
+    def __init__(self, names, window: float = 0.2):
+        super().__init__(names, window)
+        self._event = asyncio.Event()
+
+    def put(self, name: str, value):
+        """Records the latest value of a counter"""
+        self._changes[name] = value
+        self._event.set()
+
+    async def get(self, timeout: float) -> dict:  # pylint: disable=invalid-overridden-method
+        """Waits up to timeout seconds for changes and returns them by name"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+        await asyncio.sleep(self.window)
+        self._event.clear()
+        changes, self._changes = self._changes, {}
+        return changes
+
+
+def resync_names(changes: dict) -> list:
+    """Returns the names of the counters in changes that must be read again"""
+    return [name for name, value in changes.items() if value is RESYNC]
+
+
+def format_events(changes: dict) -> str:
+    """Formats the values of counters as one Server-Sent Event each
+
+    The value is None, sent as null, when the counter does not exist
+    """
+    return "".join(
+        f"event: counter\ndata: {json.dumps({'name': name, 'counter': value})}\n\n"
+        for name, value in changes.items()
+    )
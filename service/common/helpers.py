@@ -0,0 +1,344 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Helpers
+
+This module contains the functions that check request arguments and batch
+operations, turn batch results into per operation statuses and format
+exports. They do not depend on a web framework so that the synchronous and
+asynchronous services can share them.
+"""
+import io
+import csv
+import json
+import time
+import codecs
+from service.common import status
+from service.models import BATCH_OPERATIONS
+
+# Redis keeps counters as signed 64 bit integers
+MIN_COUNTER = -(2**63)
+MAX_COUNTER = 2**63 - 1
+
+
+def parse_int(text, name: str, minimum: int = 0, maximum: int = None) -> int:
+    """Returns a query parameter as an integer within bounds
+
+    Raises:
+        ValueError: the parameter is not an integer within the bounds
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        value = None
+    if value is None or value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"Invalid value for '{name}': {text}")
+    return value
+
+
+def is_counter_value(value) -> bool:
+    """Returns True if a value is an integer that Redis can keep in a counter"""
+    return isinstance(value, int) and not isinstance(value, bool) and MIN_COUNTER <= value <= MAX_COUNTER
+
+
+def plan_batch(items, max_operations: int):
+    """Checks the operations of a batch request
+
+    Returns:
+        a list with a 400 result for every invalid item and None for the
+        others, and the (position, operation) of every valid item
+
+    Raises:
+        ValueError: the body is not a list of at most max_operations items
+    """
+    if not isinstance(items, list):
+        raise ValueError("Batch must be a list of operations")
+    if len(items) > max_operations:
+        raise ValueError(f"Batch has more than {max_operations} operations")
+    results = [None] * len(items)
+    operations = []
+    for position, item in enumerate(items):
+        try:
+            operations.append((position, parse_operation(item)))
+        except ValueError as err:
+            results[position] = {"status": status.HTTP_400_BAD_REQUEST, "error": str(err)}
+    return results, operations
+
+
+def finish_batch(results: list, operations: list, values: list) -> list:
+    """Fills in the results of the operations that were run"""
+    for (position, (operation, name, _)), value in zip(operations, values):
+        results[position] = batch_result(operation, name, value)
+    return results
+
+
+def parse_operation(item):
+    """Returns a batch item as an (operation, name, number) tuple
+
+    Raises:
+        ValueError: the item is not a valid operation
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Operation must be an object")
+    operation = item.get("op")
+    if operation not in BATCH_OPERATIONS:
+        raise ValueError(f"Unknown operation: {operation}")
+    name = item.get("name")
+    if not isinstance(name, str) or not name or "/" in name:
+        raise ValueError("Operation must have a counter name without a '/'")
+    if operation == "create":
+        number = item.get("value", 0)
+    else:
+        number = item.get("amount", 1)
+    if not isinstance(number, int) or isinstance(number, bool):
+        raise ValueError(f"Operation on '{name}' must have an integer value")
+    if not is_counter_value(number):
+        raise ValueError(f"Operation on '{name}' must have a value between {MIN_COUNTER} and {MAX_COUNTER}")
+    return operation, name, number
+
+
+def batch_result(operation, name, value):
+    """Returns the status and result of one batch operation"""
+    result = {"op": operation, "name": name}
+    if operation == "delete":
+        result["status"] = status.HTTP_204_NO_CONTENT
+    elif value is not None:
+        result["status"] = status.HTTP_201_CREATED if operation == "create" else status.HTTP_200_OK
+        result["counter"] = value
+    elif operation == "create":
+        result["status"] = status.HTTP_409_CONFLICT
+        result["error"] = f"Counter '{name}' already exists"
+    else:
+        result["status"] = status.HTTP_404_NOT_FOUND
+        result["error"] = f"Counter '{name}' does not exist"
+    return result
+
+
+######################################################################
+#  S K E T C H E S
+######################################################################
+
+# the counters of a frequency sketch are unsigned 32 bit integers
+MAX_ITEM_COUNT = 2**32 - 1
+
+
+def parse_items(data, max_items: int) -> list:
+    """Returns the "items" of a request body to add to a unique counter
+
+    Raises:
+        ValueError: the items are not a list of at most max_items strings
+    """
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+        raise ValueError("Body must have a list of string 'items'")
+    if len(items) > max_items:
+        raise ValueError(f"Body has more than {max_items} items")
+    return items
+
+
+def parse_sources(data, max_items: int) -> list:
+    """Returns the "sources" of a request body to merge into a unique counter
+
+    Raises:
+        ValueError: the sources are not a list of 1 to max_items names
+    """
+    sources = data.get("sources") if isinstance(data, dict) else None
+    if not isinstance(sources, list) or not sources or not all(isinstance(source, str) for source in sources):
+        raise ValueError("Body must have a list of the names of the 'sources'")
+    if len(sources) > max_items:
+        raise ValueError(f"Body has more than {max_items} sources")
+    return sources
+
+
+def parse_item_counts(data, max_items: int) -> dict:
+    """Returns the "items" of a request body to add to a frequency sketch
+
+    The items are either an object of the count to add for each item or
+    a list of items that adds 1 for every time an item is in it.
+
+    Raises:
+        ValueError: the items are not valid or there are more than max_items
+    """
+    items = data.get("items") if isinstance(data, dict) else None
+    if isinstance(items, list):
+        counts = {}
+        for item in parse_items(data, max_items):
+            counts[item] = counts.get(item, 0) + 1
+        return counts
+    if not isinstance(items, dict):
+        raise ValueError("Body must have an object or a list of 'items'")
+    if len(items) > max_items:
+        raise ValueError(f"Body has more than {max_items} items")
+    for item, count in items.items():
+        if not isinstance(count, int) or isinstance(count, bool) or not 0 < count <= MAX_ITEM_COUNT:
+            raise ValueError(f"Count of '{item}' must be an integer from 1 to {MAX_ITEM_COUNT}")
+    return items
+
+
+######################################################################
+#  E X P O R T S
+######################################################################
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_header(export_format: str) -> str:
+    """Returns the first line of an export"""
+    if export_format == "csv":
+        return export_chunk([{"name": "name", "counter": "counter"}], export_format)
+    return ""
+
+
+def export_chunk(counters: list, export_format: str) -> str:
+    """Formats a page of counters as lines of NDJSON or CSV"""
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows((counter["name"], counter["counter"]) for counter in counters)
+        return buffer.getvalue()
+    return "".join(json.dumps(counter) + "\n" for counter in counters)
+
+
+######################################################################
+#  I M P O R T S
+######################################################################
+
+
+class ImportParser:
+    """Parses a streamed body of NDJSON or CSV counters into batches
+
+    The body is fed in chunks of bytes as it arrives and only a partial
+    line and one unfinished batch are kept between chunks. Lines are
+    NDJSON objects like {"name": "foo", "counter": 5} or CSV rows like
+    foo,5, so the output of an export can be imported again.
+    """
+
+    def __init__(self, import_format: str, batch_size: int, report):
+        self.import_format = import_format
+        self.batch_size = batch_size
+        self.report = report
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+        self._batch = []
+
+    def feed(self, chunk: bytes) -> list:
+        """Parses a chunk of the body and returns the batches it completed"""
+        lines = (self._partial + self._decoder.decode(chunk)).split("\n")
+        self._partial = lines.pop()
+        return self._parse(lines)
+
+    def close(self) -> list:
+        """Parses the rest of the body and returns the last batches"""
+        rest = self._partial + self._decoder.decode(b"", final=True)
+        batches = self._parse([rest]) if rest else []
+        self._partial = ""
+        if self._batch:
+            batches.append(self._batch)
+            self._batch = []
+        return batches
+
+    def _parse(self, lines: list) -> list:
+        batches = []
+        for line in lines:
+            self.report.lines += 1
+            line = line.strip()
+            if not line or (self.import_format == "csv" and line == "name,counter"):
+                continue
+            try:
+                self._batch.append(parse_import_line(line, self.import_format))
+            except ValueError as err:
+                self.report.error(self.report.lines, str(err))
+                continue
+            if len(self._batch) >= self.batch_size:
+                batches.append(self._batch)
+                self._batch = []
+        return batches
+
+
+def parse_json_line(line: str) -> tuple:
+    """Returns the name and integer value of a counter from one NDJSON line"""
+    try:
+        item = json.loads(line)
+    except ValueError:
+        raise ValueError("Line is not valid JSON") from None
+    if not isinstance(item, dict):
+        raise ValueError("Line must be a JSON object")
+    name, value = item.get("name"), item.get("counter")
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f"Counter '{name}' must have an integer value")
+    return name, value
+
+
+def parse_import_line(line: str, import_format: str) -> tuple:
+    """Returns the name and value of a counter from one line of an import"""
+    if import_format == "csv":
+        row = next(csv.reader([line]))
+        if len(row) != 2:
+            raise ValueError("Line must have a name and a counter")
+        name, value = row
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"Counter '{name}' must have an integer value") from None
+    else:
+        name, value = parse_json_line(line)
+    if not isinstance(name, str) or not name or "/" in name:
+        raise ValueError("Line must have a name without a '/'")
+    if not is_counter_value(value):
+        raise ValueError(f"Counter '{name}' must be between {MIN_COUNTER} and {MAX_COUNTER}")
+    return name, value
+
+
+class ImportReport:
+    """Counts the lines of an import and keeps the first errors"""
+
+    def __init__(self, max_errors: int = 100):
+        self.max_errors = max_errors
+        self.started = time.perf_counter()
+        self.lines = 0
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line: int, message: str):
+        """Records a line that could not be imported"""
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": line, "error": message})
+
+    def add(self, written: list):
+        """Records the results of writing one batch"""
+        imported = sum(written)
+        self.imported += imported
+        self.skipped += len(written) - imported
+
+    def serialize(self) -> dict:
+        """Returns the report with the time taken and the throughput"""
+        seconds = time.perf_counter() - self.started
+        return {
+            "lines": self.lines,
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "errors": self.errors,
+            "seconds": round(seconds, 3),
+            "counters_per_second": round((self.imported + self.skipped) / seconds, 1) if seconds else 0.0,
+        }
@@ -0,0 +1,149 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Fast JSON
+
+This module encodes the JSON of the responses with orjson, which writes
+the small counter documents several times faster than the json module
+that Flask and Quart use.
+
+Documents whose members are mostly the same every time, like the error
+envelopes and the index, are kept as templates whose fixed members are
+encoded once, so a response only encodes the members that change.
+"""
+import time
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+JSON_PROVIDERS = ["orjson", "flask"]
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """A JSON provider for Flask and Quart apps that encodes with orjson
+
+    Unlike the default provider, keys are kept in the order they were
+    added instead of being sorted, text is written as UTF-8 instead of
+    escaped ASCII, and dates are written in ISO 8601.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        """Serializes data as JSON to a string
+
+        Keyword arguments for json.dumps are only honored by the default provider
+        """
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.encode(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        """Deserializes data from a JSON string or bytes"""
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def encode(self, obj, option: int = 0) -> bytes:
+        """Serializes data as JSON to UTF-8 bytes"""
+        return orjson.dumps(obj, default=self.default, option=option | orjson.OPT_NON_STR_KEYS)
+
+    def response(self, *args, **kwargs):
+        """Serializes the arguments like jsonify and returns them as a response"""
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        return self._app.response_class(self.encode(obj, option), mimetype=self.mimetype)
+
+
+class JsonTemplate:
+    """A JSON object whose fixed members are encoded once
+
+    Arguments:
+        fixed: the members that every document has
+        names: the names of the members that each document fills in after them
+
+    Example:
+        NOT_FOUND = JsonTemplate({"status": 404, "error": "Not Found"}, "message")
+        NOT_FOUND.render(message="Counter foo not found")
+    """
+
+    def __init__(self, fixed: dict, *names):
+        self.names = names
+        self._parts = []
+        head, separator = orjson.dumps(fixed)[:-1], b"," if fixed else b""
+        for name in names:
+            self._parts.append(head + separator + orjson.dumps(name) + b":")
+            head, separator = b"", b","
+        self._tail = head + b"}\n"
+
+    def render(self, **values) -> bytes:
+        """Returns the document with the values of the members that change"""
+        chunks = []
+        for part, name in zip(self._parts, self.names):
+            chunks.append(part)
+            chunks.append(orjson.dumps(values[name]))
+        chunks.append(self._tail)
+        return b"".join(chunks)
+
+
+def init_json(app):
+    """Installs the JSON provider named by JSON_PROVIDER in a Flask or Quart app
+
+    Raises:
+        ValueError: JSON_PROVIDER names no provider
+    """
+    name = app.config["JSON_PROVIDER"]
+    if name not in JSON_PROVIDERS:
+        raise ValueError(f"JSON_PROVIDER must be one of {', '.join(JSON_PROVIDERS)}")
+    if name == "orjson":
+        app.json = OrjsonProvider(app)
+
+
+def measure_json(app, count: int = 10000) -> dict:
+    """Measures the CPU microseconds that building each kind of response takes
+
+    Every kind of response is built count times with the default provider
+    of Flask and with orjson, the error envelope with orjson from its
+    template like the error handlers do.
+
+    Arguments:
+        app: the app whose response class is used
+        count: the number of responses of each kind to build
+    """
+    flask_json, fast_json = DefaultJSONProvider(app), OrjsonProvider(app)
+    counters = [{"name": f"counter{index}", "counter": index} for index in range(100)]
+    envelope = {"status": 404, "error": "Not Found", "message": "404 Not Found: Counter foo does not exist"}
+    template = JsonTemplate({"status": 404, "error": "Not Found"}, "message")
+    cases = {
+        "counter": (
+            lambda: flask_json.response(name="foo", counter=12345),
+            lambda: fast_json.response(name="foo", counter=12345),
+        ),
+        "list of 100": (lambda: flask_json.response(counters), lambda: fast_json.response(counters)),
+        "error": (
+            lambda: flask_json.response(**envelope),
+            lambda: app.response_class(template.render(message=envelope["message"]), status=404, mimetype="application/json"),
+        ),
+    }
+    return {name: {"flask": _cpu_us(slow, count), "orjson": _cpu_us(fast, count)} for name, (slow, fast) in cases.items()}
+
+
+def _cpu_us(function, count: int) -> float:
+    """Returns the CPU microseconds that one call of a function takes"""
+    start = time.process_time()
+    for _ in range(count):
+        function()
+    return round((time.process_time() - start) / count * 1e6, 2)
@@ -19,13 +19,44 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+With a queue, the request threads only put their records on a bounded
+queue and a listener thread formats and writes them. A record that finds
+the queue full is dropped and counted rather than making the request
+wait, and the listener logs how many were dropped once it catches up.
+Sampling keeps only a share of the lines of busy levels like INFO and
+skips the others before their records are even made.
 """
+import os
+import queue
+import atexit
+import random
 import logging
+import threading
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+from service.common.metrics import LOG_RECORDS_DROPPED
+
+
+# every queue handler of this process, which a forked child restarts, see _after_fork()
+_handlers = weakref.WeakSet()
+
 
+def init_logging(app, logger_name: str, queue_size: int = 0, sample_rates: dict = None):
+    """Set up logging for production
 
-def init_logging(app, logger_name: str):
-    """Set up logging for production"""
+    Arguments:
+        app: the Flask or Quart application
+        logger_name: the logger of the server whose handlers are used
+        queue_size: the most records to hold for the listener thread, or
+            0 to write them in the thread that logs them
+        sample_rates: the share of records to keep by level, like
+            {logging.INFO: 0.1}, where the other levels keep every record
+    """
     app.logger.propagate = False
+    for handler in app.logger.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            handler.stop()
     gunicorn_logger = logging.getLogger(logger_name)
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
@@ -35,4 +66,135 @@ def init_logging(app, logger_name: str):
     )
     for handler in app.logger.handlers:
         handler.setFormatter(formatter)
+    # the logger of the app is made a SamplingLogger only while it samples
+    app.logger.__class__ = SamplingLogger if sample_rates else logging.Logger
+    app.logger.sample_rates = sample_rates or {}
+    if queue_size > 0:
+        handler = DroppingQueueHandler(queue_size, list(app.logger.handlers))
+        handler.start()
+        app.logger.handlers = [handler]
     app.logger.info("Logging handler established")
+
+
+def parse_sample_rates(text: str) -> dict:
+    """Parses sample rates like "INFO=0.1,DEBUG=0" into a dict by level
+
+    Raises:
+        ValueError: a level is unknown or a rate is not between 0 and 1
+    """
+    rates = {}
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        name, _, rate = item.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(f"Unknown log level: {name}")
+        rates[level] = float(rate)
+        if not 0 <= rates[level] <= 1:
+            raise ValueError(f"The sample rate of {name} must be between 0 and 1")
+    return rates
+
+
+class SamplingLogger(logging.Logger):
+    """A logger that skips a random share of the records of some levels
+
+    The share is skipped before a record is made, which costs more than
+    formatting and writing it, so a skipped line costs next to nothing.
+    sample_rates holds the share of records to keep by level.
+    """
+
+    sample_rates = {}
+
+    def isEnabledFor(self, level) -> bool:
+        """Returns False for the records of the level that are skipped"""
+        rate = self.sample_rates.get(level)
+        if rate is not None and random.random() >= rate:
+            return False
+        return super().isEnabledFor(level)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue for a listener thread to write
+
+    Arguments:
+        size: the most records that the queue holds
+        handlers: the handlers that the listener writes the records with
+    """
+
+    def __init__(self, size: int, handlers: list):
+        super().__init__(queue.Queue(size))
+        self.handlers = handlers
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        _handlers.add(self)
+
+    def start(self):
+        """Starts the listener thread and stops it when the process exits"""
+        self._listener = LogListener(self)
+        self._listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Writes the records that are left and stops the listener thread"""
+        atexit.unregister(self.stop)
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.report_dropped()
+            self._listener = None
+
+    def prepare(self, record):
+        """Queues the record as it is, to be formatted by the listener thread"""
+        return record
+
+    def enqueue(self, record):
+        """Queues a record or drops it and counts it if the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+    def take_dropped(self) -> int:
+        """Returns the number of records dropped since the last call"""
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def _after_fork(self):
+        """Gives a forked child a queue and a listener thread of its own"""
+        self.queue = queue.Queue(self.queue.maxsize)
+        self._lock = threading.Lock()
+        self.dropped = 0
+        if self._listener is not None:
+            self.start()
+
+
+class LogListener(QueueListener):
+    """Writes the records of a DroppingQueueHandler and reports the dropped ones"""
+
+    def __init__(self, queue_handler: DroppingQueueHandler):
+        super().__init__(queue_handler.queue, *queue_handler.handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+
+    def handle(self, record):
+        """Writes a record after reporting the records dropped before it"""
+        self.report_dropped()
+        super().handle(record)
+
+    def report_dropped(self):
+        """Logs how many records were dropped since the last report"""
+        dropped = self.queue_handler.take_dropped()
+        if dropped:
+            message = "Dropped %d log records because the log queue was full"
+            super().handle(logging.LogRecord(__name__, logging.WARNING, __file__, 0, message, (dropped,), None))
+
+
+def _after_fork():
+    """Restarts every queue handler in a forked child"""
+    for handler in list(_handlers):
+        handler._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,288 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Metrics
+
+This module keeps the Prometheus metrics of the requests, Redis commands,
+connection pools and counter caches of a worker.
+
+Each worker process counts on its own. When PROMETHEUS_MULTIPROC_DIR is
+set before the service starts, every worker writes its samples to memory
+mapped files in that directory and GET /metrics adds up the files of all
+of them, so any worker can answer for the whole server. The directory
+must be emptied when the server starts and gunicorn must drop the gauges
+of workers that exit, which gunicorn.conf.py does.
+"""
+import os
+import glob
+import time
+import functools
+import asyncio
+from collections import Counter as Tally
+from prometheus_client import (
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from redis import Redis
+from redis.client import Pipeline
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.client import Pipeline as AsyncPipeline
+from service.common.tracing import current_trace
+
+# the label of the round trip of a whole pipeline in the duration histogram
+PIPELINE = "PIPELINE"
+
+# the route of requests that did not match any
+UNMATCHED = "<unmatched>"
+
+# Redis commands take well under a millisecond, so its buckets start lower
+REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+REQUESTS = Counter("http_requests_total", "Requests handled", ["method", "route", "status"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Seconds to handle a request", ["method", "route"])
+ERRORS = Counter("http_errors_total", "Errors returned by each error handler", ["handler"])
+REDIS_COMMANDS = Counter("redis_commands_total", "Redis commands sent, also in pipelines", ["command"])
+REDIS_SECONDS = Histogram(
+    "redis_command_duration_seconds", "Seconds until Redis replied", ["command"], buckets=REDIS_BUCKETS
+)
+POOL_IN_USE = Gauge(
+    "redis_pool_connections_in_use", "Redis connections checked out of the pools", multiprocess_mode="livesum"
+)
+POOL_CREATED = Counter("redis_pool_connections_created_total", "Redis connections opened by the pools")
+POOL_CHECKOUTS = Counter("redis_pool_checkouts_total", "Redis connections checked out of the pools")
+POOL_WAIT_SECONDS = Counter("redis_pool_wait_seconds_total", "Seconds spent waiting for a free Redis connection")
+POOL_TIMEOUTS = Counter("redis_pool_timeouts_total", "Times that no Redis connection was free in time")
+POOL_CONNECT_ERRORS = Counter("redis_pool_connect_errors_total", "Times that a pool could not connect to Redis")
+CACHE_HITS = Counter("counter_cache_hits_total", "Counter values read from the cache of a worker")
+CACHE_MISSES = Counter("counter_cache_misses_total", "Counter values missing from or expired in the cache of a worker")
+CACHE_EVICTIONS = Counter("counter_cache_evictions_total", "Counter values evicted from a full cache")
+CACHE_EXPIRATIONS = Counter("counter_cache_expirations_total", "Counter values dropped from a cache once they expired")
+CACHE_INVALIDATIONS = Counter("counter_cache_invalidations_total", "Counter values dropped from a cache because they changed")
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+REQUESTS_SHED = Counter(
+    "http_requests_shed_total", "Requests turned away because their route class was at its limit", ["route_class"]
+)
+CIRCUIT_OPENED = Counter("redis_circuit_opened_total", "Times that the circuit to a Redis node opened")
+CIRCUIT_REJECTED = Counter("redis_circuit_rejected_total", "Redis calls failed fast because their circuit was open")
+
+# the metrics of each set of labels that has been seen, see labelled()
+_children = {}
+
+
+def labelled(metric, *labels):
+    """Returns the child of a metric for some labels
+
+    Looking up the labels of a metric takes a lock, so the few routes and
+    commands of the service keep the children they looked up
+    """
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children.setdefault(key, metric.labels(*labels))
+    return child
+
+
+######################################################################
+#  R E Q U E S T S
+######################################################################
+def start_request() -> float:
+    """Returns the time that a request started at"""
+    return time.perf_counter()
+
+
+def record_request(method: str, route: str, status_code: int, start: float):
+    """Counts a request that was handled and how long it took
+
+    Arguments:
+        method: the HTTP method of the request
+        route: the url rule that the request matched, or None
+        status_code: the status of the response
+        start: the time from start_request()
+    """
+    route = route or UNMATCHED
+    labelled(REQUEST_SECONDS, method, route).observe(time.perf_counter() - start)
+    labelled(REQUESTS, method, route, status_code).inc()
+
+
+def count_errors(handler):
+    """Decorates an error handler to count the errors it returns"""
+    errors = ERRORS.labels(handler.__name__)
+    if asyncio.iscoroutinefunction(handler):
+
+        @functools.wraps(handler)
+        async def async_wrapper(*args, **kwargs):
+            errors.inc()
+            return await handler(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        errors.inc()
+        return handler(*args, **kwargs)
+
+    return wrapper
+
+
+######################################################################
+#  R E D I S   C O M M A N D S
+######################################################################
+def record_command(command: str, start: float):
+    """Counts a Redis command and how long it took and adds it to the trace"""
+    seconds = time.perf_counter() - start
+    labelled(REDIS_SECONDS, command).observe(seconds)
+    labelled(REDIS_COMMANDS, command).inc()
+    trace = current_trace()
+    if trace is not None:
+        trace.add([command], seconds)
+
+
+def record_pipeline(command_stack: list, start: float):
+    """Counts the commands of a pipeline and how long its round trip took and adds it to the trace
+
+    The commands are counted once per name so that a long pipeline only
+    costs a few increments
+    """
+    seconds = time.perf_counter() - start
+    commands = [str(args[0]).upper() for args, _ in command_stack]
+    labelled(REDIS_SECONDS, PIPELINE).observe(seconds)
+    for command, count in Tally(commands).items():
+        labelled(REDIS_COMMANDS, command).inc(count)
+    trace = current_trace()
+    if trace is not None:
+        trace.add(commands, seconds)
+
+
+class MeteredPipeline(Pipeline):
+    """A Redis pipeline that counts its commands
+
+    Its commands go through the circuit breaker of its client, if it has one
+    """
+
+    breaker = None
+
+    def execute(self, raise_on_error: bool = True):
+        """Sends the queued commands and counts them"""
+        command_stack, start = list(self.command_stack), time.perf_counter()
+        try:
+            if self.breaker is None:
+                return super().execute(raise_on_error)
+            return self.breaker.call(super().execute, raise_on_error)
+        finally:
+            record_pipeline(command_stack, start)
+
+
+class MeteredRedis(Redis):
+    """A Redis client that counts its commands and how long they take
+
+    Its commands go through the circuit breaker that is set as its breaker, if any
+    """
+
+    breaker = None
+
+    def execute_command(self, *args, **options):
+        """Sends a command and counts it"""
+        start = time.perf_counter()
+        try:
+            if self.breaker is None:
+                return super().execute_command(*args, **options)
+            return self.breaker.call(super().execute_command, *args, **options)
+        finally:
+            record_command(str(args[0]).upper(), start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """Returns a pipeline that counts its commands"""
+        pipe = MeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+
+class AsyncMeteredPipeline(AsyncPipeline):
+    """A redis.asyncio pipeline that counts its commands"""
+
+    breaker = None
+
+    async def execute(self, raise_on_error: bool = True):
+        """Sends the queued commands and counts them"""
+        command_stack, start = list(self.command_stack), time.perf_counter()
+        try:
+            if self.breaker is None:
+                return await super().execute(raise_on_error)
+            return await self.breaker.call_async(super().execute, raise_on_error)
+        finally:
+            record_pipeline(command_stack, start)
+
+
+class AsyncMeteredRedis(AsyncRedis):
+    """A redis.asyncio client that counts its commands and how long they take"""
+
+    breaker = None
+
+    async def execute_command(self, *args, **options):
+        """Sends a command and counts it"""
+        start = time.perf_counter()
+        try:
+            if self.breaker is None:
+                return await super().execute_command(*args, **options)
+            return await self.breaker.call_async(super().execute_command, *args, **options)
+        finally:
+            record_command(str(args[0]).upper(), start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """Returns a pipeline that counts its commands"""
+        pipe = AsyncMeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+
+######################################################################
+#  E X P O S I T I O N
+######################################################################
+def generate_metrics() -> tuple:
+    """Returns the metrics in the Prometheus text format and its content type
+
+    The samples of every worker are added up when PROMETHEUS_MULTIPROC_DIR is set
+    """
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=path)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def clear_metrics():
+    """Removes the samples that the workers of an earlier run left behind"""
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        for filename in glob.glob(os.path.join(path, "*.db")):
+            os.remove(filename)
+
+
+def worker_exited(pid: int):
+    """Drops the live gauges of a worker process that exited
+
+    Its counters and histograms are kept so that the totals never go down
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,217 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Notifications
+
+This module contains listeners that share one Redis pub/sub subscription
+per process, or per event loop, and pass every counter change message to
+their handlers.
+
+Messages are JSON objects like {"name": "foo", "counter": 5} where the
+counter is null when the counter was deleted.
+"""
+import os
+import json
+import asyncio
+import logging
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# every listener of this process, which a forked child restarts, see _after_fork()
+_listeners = weakref.WeakSet()
+
+
+class ChangeHandlers:
+    """The handlers of the change messages of a pub/sub channel
+
+    Arguments:
+        connection_fn: returns the Redis client to subscribe with
+        channel: the name of the pub/sub channel
+        reconnect_delay: seconds to wait before subscribing again
+    """
+
+    def __init__(self, connection_fn, channel: str, reconnect_delay: float = 1.0):
+        self.connection_fn = connection_fn
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._handlers = []
+        self._reset_handlers = []
+
+    def add_handler(self, handler, on_reset=None):
+        """Calls handler(name, value) for every change
+
+        The on_reset function is called whenever the listener (re)subscribes
+        because changes could have been missed while it was not subscribed
+        """
+        self._handlers.append(handler)
+        if on_reset:
+            self._reset_handlers.append(on_reset)
+
+    def remove_handler(self, handler, on_reset=None):
+        """Stops calling a handler"""
+        if handler in self._handlers:
+            self._handlers.remove(handler)
+        if on_reset in self._reset_handlers:
+            self._reset_handlers.remove(on_reset)
+
+    def dispatch(self, data: str):
+        """Passes a change message to every handler"""
+        try:
+            change = json.loads(data)
+            name, value = change["name"], change["counter"]
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Ignoring bad change message: %s", data)
+            return
+        for handler in list(self._handlers):
+            handler(name, value)
+
+    def _reset(self):
+        """Tells every handler that changes could have been missed"""
+        for on_reset in list(self._reset_handlers):
+            on_reset()
+
+
+class ChangeListener(ChangeHandlers):
+    """Listens to a pub/sub channel in a background thread"""
+
+    def __init__(self, connection_fn, channel: str, reconnect_delay: float = 1.0):
+        super().__init__(connection_fn, channel, reconnect_delay)
+        self._stopped = threading.Event()
+        self._subscribed = threading.Event()
+        self._thread = None
+        _listeners.add(self)
+
+    def start(self):
+        """Starts listening in a background thread"""
+        self._stopped.clear()
+        self._subscribed.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="change-listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops listening"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def wait_until_subscribed(self, timeout: float = None) -> bool:
+        """Waits until the listener has subscribed to the channel"""
+        return self._subscribed.wait(timeout)
+
+    def _run(self):
+        """Subscribes and dispatches messages until stopped"""
+        while not self._stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = self.connection_fn().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self._reset()
+                self._subscribed.set()
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=0.1)
+                    if message:
+                        self.dispatch(message["data"])
+            except Exception as err:  # pylint: disable=broad-except
+                self._subscribed.clear()
+                logger.warning("Lost the change subscription: %s", err)
+                self._stopped.wait(self.reconnect_delay)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    def _after_fork(self):
+        """Gives a forked child a subscription of its own"""
+        self._subscribed = threading.Event()
+        if self._thread is not None:
+            self.start()
+
+
+class AsyncChangeListener(ChangeHandlers):
+    """Listens to a pub/sub channel in a task of the running event loop
+
+    The connection function returns a list of clients because a script
+    publishes on the node of its first key, so every shard is subscribed
+    to with a task of its own.
+    """
+
+    def __init__(self, connection_fn, channel: str, reconnect_delay: float = 1.0):
+        super().__init__(connection_fn, channel, reconnect_delay)
+        self._tasks = []
+        self._subscribed = None
+
+    def start(self):
+        """Starts listening in tasks of the running event loop"""
+        clients = self.connection_fn()
+        self._subscribed = [asyncio.Event() for _ in clients]
+        self._tasks = [
+            asyncio.get_running_loop().create_task(self._run(client, subscribed))
+            for client, subscribed in zip(clients, self._subscribed)
+        ]
+
+    async def stop(self):
+        """Stops listening"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def wait_until_subscribed(self, timeout: float = None) -> bool:
+        """Waits until the listener has subscribed to the channel on every node"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(event.wait() for event in self._subscribed)), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _run(self, client, subscribed: asyncio.Event):
+        """Subscribes on one node and dispatches messages until cancelled"""
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                self._reset()
+                subscribed.set()
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message:
+                        self.dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:  # pylint: disable=broad-except
+                subscribed.clear()
+                logger.warning("Lost the change subscription: %s", err)
+                await asyncio.sleep(self.reconnect_delay)
+            finally:
+                if hasattr(pubsub, "aclose"):
+                    await pubsub.aclose()
+                else:  # redis-py before 5.0.1
+                    await pubsub.close()
+
+
+def _after_fork():
+    """Restarts every listener in a forked child"""
+    for listener in list(_listeners):
+        listener._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,282 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Profiler
+
+This module profiles a random sample of the requests of a live worker,
+and any request that carries the X-Profile header with the admin token.
+
+A profiled request runs under cProfile, or with ``mode="sample"`` its
+thread is sampled by a stack sampler thread. The profiles of a worker are
+added up and written to the profile directory every ``interval`` seconds,
+as pstats files that ``python -m pstats`` and snakeviz read or as
+collapsed stacks that flamegraph.pl and speedscope read.
+
+The share of requests to profile is kept in Redis so that changing it
+through the admin endpoint reaches every worker within a second. A
+forked child, like a gunicorn worker, starts with empty profiles and
+threads of its own.
+"""
+import os
+import sys
+import time
+import random
+import cProfile
+import pstats
+import logging
+import threading
+import weakref
+from collections import Counter as Tally
+
+logger = logging.getLogger(__name__)
+
+# the key that keeps the sampling rate that every worker follows
+RATE_KEY = "admin/profile_rate"
+
+# seconds between reads of the sampling rate from Redis
+RATE_REFRESH = 1.0
+
+PROFILE_MODES = ["cprofile", "sample"]
+
+# every profiler of this process, which a forked child resets, see _after_fork()
+_profilers = weakref.WeakSet()
+
+
+class Profiler:
+    """Profiles a sample of the requests of a worker
+
+    Arguments:
+        directory: where the profiles are written
+        rate: the share of requests to profile, from 0 to 1
+        interval: seconds between writes of the profiles
+        mode: "cprofile" or "sample" for the stack sampler
+        sample_interval: seconds between the stack samples of a request
+        redis_fn: returns the Redis client that keeps the shared rate, or
+            None to only keep the rate in this worker
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        rate: float = 0.0,
+        interval: float = 60.0,
+        mode: str = "cprofile",
+        sample_interval: float = 0.005,
+        redis_fn=None,
+    ):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+        self.directory = directory
+        self.rate = check_rate(rate)
+        self.interval = interval
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.redis_fn = redis_fn
+        self._reset()
+        self._stopped = threading.Event()
+        self._threads = []
+        _profilers.add(self)
+
+    def _reset(self):
+        """Forgets every profile"""
+        self._lock = threading.Lock()
+        self._stats = None
+        self._stacks = Tally()
+        self._active = set()
+        self._profiled = 0
+
+    def start(self):
+        """Starts the threads that write the profiles and sample stacks"""
+        self._stopped.clear()
+        self._threads = [threading.Thread(target=self._run, name="profile-writer", daemon=True)]
+        if self.mode == "sample":
+            self._threads.append(threading.Thread(target=self._sample, name="profile-sampler", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stops the threads and writes what is left"""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.write()
+
+    ######################################################################
+    #  R E Q U E S T S
+    ######################################################################
+
+    def should_profile(self) -> bool:
+        """Returns True for the share of requests that should be profiled"""
+        return self.rate > 0 and random.random() < self.rate
+
+    def begin(self):
+        """Starts profiling the request of this thread
+
+        Returns what end() needs, or None if the request cannot be
+        profiled because the interpreter allows one profiler at a time
+        """
+        if self.mode == "sample":
+            with self._lock:
+                self._active.add(threading.get_ident())
+            return threading.get_ident()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+        return profile
+
+    def end(self, token):
+        """Stops profiling a request and adds its profile to the others"""
+        if self.mode == "sample":
+            with self._lock:
+                self._active.discard(token)
+                self._profiled += 1
+            return
+        token.disable()
+        stats = pstats.Stats(token)
+        with self._lock:
+            if self._stats is None:
+                self._stats = stats
+            else:
+                self._stats.add(stats)
+            self._profiled += 1
+
+    ######################################################################
+    #  S A M P L I N G   R A T E
+    ######################################################################
+
+    def set_rate(self, rate: float):
+        """Changes the share of requests to profile in every worker
+
+        Raises:
+            ValueError: the rate is not between 0 and 1
+        """
+        rate = check_rate(rate)
+        if self.redis_fn is not None:
+            self.redis_fn().set(RATE_KEY, rate)
+        self.rate = rate
+
+    def refresh_rate(self):
+        """Reads the share of requests to profile that every worker follows"""
+        rate = self.redis_fn().get(RATE_KEY) if self.redis_fn is not None else None
+        if rate is not None:
+            self.rate = check_rate(rate)
+
+    def status(self) -> dict:
+        """Returns the settings of the profiler and what it has not written yet"""
+        return {
+            "rate": self.rate,
+            "mode": self.mode,
+            "directory": self.directory,
+            "interval": self.interval,
+            "pending": self._profiled,
+        }
+
+    ######################################################################
+    #  P R O F I L E S
+    ######################################################################
+
+    def write(self):
+        """Writes the profiles added up since the last write and returns the file name
+
+        Returns None when no request was profiled
+        """
+        with self._lock:
+            stats, self._stats = self._stats, None
+            stacks, self._stacks = self._stacks, Tally()
+            profiled, self._profiled = self._profiled, 0
+        if not profiled:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        if self.mode == "sample":
+            filename = os.path.join(self.directory, f"profile-{os.getpid()}-{stamp}.collapsed")
+            with open(filename, "w", encoding="utf-8") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        else:
+            filename = os.path.join(self.directory, f"profile-{os.getpid()}-{stamp}.pstats")
+            stats.dump_stats(filename)
+        logger.info("Wrote the profiles of %d requests to %s", profiled, filename)
+        return filename
+
+    def _run(self):
+        """Refreshes the rate every second and writes the profiles every interval"""
+        next_write = time.monotonic() + self.interval
+        while not self._stopped.wait(RATE_REFRESH):
+            try:
+                self.refresh_rate()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning("Could not read the profiling rate: %s", err)
+            if time.monotonic() >= next_write:
+                next_write = time.monotonic() + self.interval
+                try:
+                    self.write()
+                except OSError as err:
+                    logger.warning("Could not write the profiles: %s", err)
+
+    def _sample(self):
+        """Adds the stacks of the threads of profiled requests up until stopped"""
+        while not self._stopped.wait(self.sample_interval):
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = [collapse(frames[ident]) for ident in active if ident in frames]
+            with self._lock:
+                self._stacks.update(stacks)
+
+    def _after_fork(self):
+        """Gives a forked child empty profiles and threads of its own"""
+        self._reset()
+        if self._threads:
+            self._threads = []
+            self.start()
+
+
+def check_rate(rate) -> float:
+    """Returns a sampling rate as a float
+
+    Raises:
+        ValueError: the rate is not a number between 0 and 1
+    """
+    rate = float(rate)
+    if not 0 <= rate <= 1:
+        raise ValueError("rate must be between 0 and 1")
+    return rate
+
+
+def collapse(frame) -> str:
+    """Returns the stack of a frame from its root in the collapsed format"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _after_fork():
+    """Resets every profiler in a forked child"""
+    for profiler in list(_profilers):
+        profiler._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
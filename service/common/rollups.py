@@ -0,0 +1,95 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Rollups
+
+This module names the keys that count the increments of a counter in
+windows of time.
+
+Every increment is also added to one rollup per resolution: the second,
+the minute and the hour that it happened in. A rollup expires once it is
+older than the longest window its resolution answers, so the rollups of
+a counter never take more than about 60 + 60 + 24 keys. A window is
+answered by the finest resolution whose slots reach back far enough, as
+the sum of at most 60 rollups however many increments there were. The
+window is rounded up to whole slots and the current slot has only just
+begun, so a window of 5 minutes counts the increments of the last 4 to 5
+minutes.
+"""
+import math
+
+ROLLUP_PREFIX = "rates/"
+
+# (seconds in a slot, longest window in seconds that the slots answer)
+RESOLUTIONS = ((1, 60), (60, 3600), (3600, 86400))
+MAX_WINDOW = RESOLUTIONS[-1][1]
+
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def rollup_key(name: str, resolution: int, slot: int) -> str:
+    """Returns the key that counts the increments of a counter in one slot"""
+    return f"{ROLLUP_PREFIX}{resolution}/{slot}/{name}"
+
+
+def is_rollup_key(key: str) -> bool:
+    """Returns True if the key is the key of a rollup"""
+    return key.startswith(ROLLUP_PREFIX)
+
+
+def rollup_updates(name: str, now: float) -> list:
+    """Returns the (key, seconds to live) of every rollup an increment at now adds to"""
+    return [
+        (rollup_key(name, resolution, int(now // resolution)), longest + resolution)
+        for resolution, longest in RESOLUTIONS
+    ]
+
+
+def queue_rollups(pipe, name: str, amount: int, now: float):
+    """Queues adding an increment at now to the rollups of a counter on a pipeline"""
+    for key, ttl in rollup_updates(name, now):
+        pipe.incrby(key, amount)
+        pipe.expire(key, ttl)
+
+
+def window_keys(name: str, window: int, now: float) -> list:
+    """Returns the keys of the rollups that add up to the increments in a window
+
+    Arguments:
+        name: the name of the counter
+        window: the length of the window in seconds, at most MAX_WINDOW
+        now: the time the window ends at
+    """
+    resolution = next(resolution for resolution, longest in RESOLUTIONS if window <= longest)
+    last = int(now // resolution)
+    slots = math.ceil(window / resolution)
+    return [rollup_key(name, resolution, slot) for slot in range(last - slots + 1, last + 1)]
+
+
+def parse_window(text) -> int:
+    """Returns a window like "90", "30s", "5m", "1h" or "1d" in seconds
+
+    Raises:
+        ValueError: the window is not a positive length of at most MAX_WINDOW
+    """
+    text = str(text).strip().lower()
+    unit = WINDOW_UNITS.get(text[-1:])
+    digits = text[:-1] if unit else text
+    window = int(digits) * (unit or 1) if digits.isdigit() else 0
+    if not 0 < window <= MAX_WINDOW:
+        raise ValueError(f"Invalid value for 'window': {text}")
+    return window
@@ -0,0 +1,592 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Sharding
+
+This module spreads keys over several Redis nodes with consistent hashing.
+
+Every node is put on a hash ring at many virtual points and a key belongs
+to the first point after its own hash, so adding a node to N nodes only
+moves about 1/(N + 1) of the keys. ShardedRedis and AsyncShardedRedis offer
+the commands that the counter models use and send each one to the nodes
+that own its keys, in parallel when it touches more than one node.
+
+Pub/sub messages are published on the first node and every node is
+subscribed to, because scripts publish on the node that runs them.
+
+A sorted set that every node keeps for its own keys, like the index of
+counter names or the leaderboard, is read from every node with
+ZRANGEBYLEX or ZREVRANGE and merged.
+"""
+import time
+import heapq
+import bisect
+import itertools
+import asyncio
+import contextvars
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from redis.commands.core import Script, AsyncScript
+
+logger = logging.getLogger(__name__)
+
+
+def split_uris(database_uri) -> list:
+    """Returns a list of Redis uris from a list or a comma separated string"""
+    if isinstance(database_uri, str):
+        database_uri = database_uri.split(",")
+    return [uri.strip() for uri in database_uri if uri and uri.strip()]
+
+
+def key_hash(key: str) -> int:
+    """Returns the position of a key on the hash ring"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Maps keys to nodes with consistent hashing
+
+    Arguments:
+        nodes: the names of the nodes, which decide where they are on the ring
+        virtual_nodes: the number of points on the ring for each node
+    """
+
+    def __init__(self, nodes: list, virtual_nodes: int = 160):
+        self.nodes = list(nodes)
+        self.virtual_nodes = virtual_nodes
+        points = sorted(
+            (key_hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def node_for(self, key: str) -> int:
+        """Returns the index of the node that owns the key"""
+        position = bisect.bisect(self._hashes, key_hash(key)) % len(self._hashes)
+        return self._indexes[position]
+
+    def group(self, keys: list) -> dict:
+        """Groups the positions of the keys by the index of their node"""
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self.node_for(key), []).append(position)
+        return groups
+
+
+def merge(groups: dict, results: dict, size: int) -> list:
+    """Puts the results of grouped keys back in the order of the keys"""
+    merged = [None] * size
+    for node, positions in groups.items():
+        for position, result in zip(positions, results[node]):
+            merged[position] = result
+    return merged
+
+
+def merge_sorted(results: list, num: int = None, key=None, reverse: bool = False) -> list:
+    """Merges the sorted members read from every node and keeps the first num"""
+    return list(itertools.islice(heapq.merge(*results, key=key, reverse=reverse), num))
+
+
+def score(member: tuple) -> float:
+    """Returns the score of a sorted set member read with its score"""
+    return member[1]
+
+
+def sum_stats(stats: list) -> dict:
+    """Adds up the connection pool statistics of every node"""
+    totals = {}
+    for node_stats in stats:
+        for name, value in node_stats.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+class ShardedBase:
+    """The routing that is shared by the sharded clients"""
+
+    def __init__(self, clients: list, nodes: list, virtual_nodes: int = 160):
+        self.clients = list(clients)
+        self.ring = HashRing(nodes, virtual_nodes)
+        self.scripts = []
+
+    def client_for(self, key: str):
+        """Returns the client of the node that owns the key"""
+        return self.clients[self.ring.node_for(key)]
+
+    def get_encoder(self):
+        """Returns the encoder that scripts use to compute their sha"""
+        return self.clients[0].get_encoder()
+
+    def pool_stats(self) -> dict:
+        """Returns the utilization of the connection pools of every node"""
+        return sum_stats([client.connection_pool.stats() for client in self.clients])
+
+
+class ShardedPipelineBase:
+    """Queues commands on one pipeline for each node that they touch"""
+
+    def __init__(self, sharded, transaction: bool = False):
+        self.sharded = sharded
+        self.transaction = transaction
+        self._pipes = {}
+        self._sizes = {}
+        self._commands = []
+
+    def _queue(self, node: int, command: str, *args, **kwargs) -> int:
+        """Queues a command on the pipeline of a node and returns its position"""
+        if node not in self._pipes:
+            self._pipes[node] = self.sharded.clients[node].pipeline(transaction=self.transaction)
+            self._sizes[node] = 0
+        getattr(self._pipes[node], command)(*args, **kwargs)
+        self._sizes[node] += 1
+        return self._sizes[node] - 1
+
+    def _queue_evalsha(self, sha: str, numkeys: int, *keys_and_args):
+        """Queues a script on the node of its first key"""
+        node = self.sharded.ring.node_for(keys_and_args[0])
+        position = self._queue(node, "evalsha", sha, numkeys, *keys_and_args)
+        self._pipes[node].scripts.update(
+            script for script in self.sharded.scripts if script.sha == sha
+        )
+        self._commands.append((None, {node: position}))
+
+    def _queue_key(self, command: str, key: str, *args, **kwargs):
+        """Queues a command on the node of its key"""
+        node = self.sharded.ring.node_for(key)
+        position = self._queue(node, command, key, *args, **kwargs)
+        self._commands.append((None, {node: position}))
+
+    def hmget(self, key: str, fields: list):
+        """Queues an HMGET on the node of the hash"""
+        self._queue_key("hmget", key, fields)
+        return self
+
+    def hset(self, key: str, mapping: dict):
+        """Queues an HSET of many fields on the node of the hash"""
+        self._queue_key("hset", key, mapping=mapping)
+        return self
+
+    def hdel(self, key: str, *fields):
+        """Queues an HDEL on the node of the hash"""
+        self._queue_key("hdel", key, *fields)
+        return self
+
+    def incrby(self, key: str, amount: int = 1):
+        """Queues an INCRBY on the node of the key"""
+        self._queue_key("incrby", key, amount)
+        return self
+
+    def expire(self, key: str, seconds: int):
+        """Queues an EXPIRE on the node of the key"""
+        self._queue_key("expire", key, seconds)
+        return self
+
+    def _queue_mget(self, keys: list):
+        """Queues an MGET on every node that owns some of the keys"""
+        groups = self.sharded.ring.group(keys)
+        positions = {
+            node: self._queue(node, "mget", [keys[index] for index in indexes])
+            for node, indexes in groups.items()
+        }
+        self._commands.append(((groups, len(keys)), positions))
+
+    def _results(self, node_results: dict) -> list:
+        """Returns the result of every command in the order they were queued
+
+        Arguments:
+            node_results: the results of the pipeline of each node
+        """
+        results = []
+        for mget, positions in self._commands:
+            values = {node: node_results[node][position] for node, position in positions.items()}
+            if mget is None:
+                results.extend(values.values())
+            else:
+                groups, size = mget
+                results.append(merge(groups, values, size))
+        self._pipes, self._sizes, self._commands = {}, {}, []
+        return results
+
+
+######################################################################
+#  S Y N C H R O N O U S   C L I E N T
+######################################################################
+
+
+class ShardedRedis(ShardedBase):
+    """A Redis client that spreads keys over many nodes
+
+    Arguments:
+        clients: a Redis client for each node
+        nodes: the names of the nodes in the same order, usually their uris
+        virtual_nodes: the number of points on the hash ring for each node
+    """
+
+    def __init__(self, clients: list, nodes: list, virtual_nodes: int = 160):
+        super().__init__(clients, nodes, virtual_nodes)
+        # functions that are fanned out may run commands on many nodes
+        # themselves so they get threads of their own to never wait on them
+        self._executor = ThreadPoolExecutor(len(self.clients), thread_name_prefix="shard")
+        self._fan_out_executor = ThreadPoolExecutor(len(self.clients), thread_name_prefix="shard-fan-out")
+
+    def parallel(self, function, items) -> list:
+        """Calls function(item) for every item on a thread of its own
+
+        The threads see the context of the caller, like the Redis trace of a request
+        """
+        context = contextvars.copy_context()
+        return list(self._executor.map(lambda item: context.copy().run(function, item), items))
+
+    def fan_out(self, function) -> list:
+        """Calls function(client) for every node in parallel and returns the results"""
+        context = contextvars.copy_context()
+        return list(self._fan_out_executor.map(lambda client: context.copy().run(function, client), self.clients))
+
+    def register_script(self, script: str) -> Script:
+        """Returns a script that runs on the node of its first key"""
+        script = Script(self, script)
+        self.scripts.append(script)
+        return script
+
+    def evalsha(self, sha: str, numkeys: int, *keys_and_args):
+        """Runs a script on the node of its first key"""
+        return self.client_for(keys_and_args[0]).evalsha(sha, numkeys, *keys_and_args)
+
+    def script_load(self, script: str) -> str:
+        """Loads a script on every node"""
+        return self.fan_out(lambda client: client.script_load(script))[0]
+
+    def get(self, name: str):
+        """Returns the value of a key"""
+        return self.client_for(name).get(name)
+
+    def set(self, name: str, value, **kwargs):
+        """Sets the value of a key"""
+        return self.client_for(name).set(name, value, **kwargs)
+
+    def mset(self, mapping: dict) -> bool:
+        """Sets many keys with one MSET on each node"""
+        keys = list(mapping)
+        groups = self.ring.group(keys)
+        results = self._run_grouped(
+            groups, lambda client, indexes: client.mset({keys[index]: mapping[keys[index]] for index in indexes})
+        )
+        return all(results.values())
+
+    def delete(self, *names) -> int:
+        """Deletes keys and returns how many there were"""
+        groups = self.ring.group(names)
+        results = self._run_grouped(
+            groups, lambda client, indexes: client.delete(*[names[index] for index in indexes])
+        )
+        return sum(results.values())
+
+    def exists(self, *names) -> int:
+        """Returns how many of the keys exist"""
+        groups = self.ring.group(names)
+        results = self._run_grouped(
+            groups, lambda client, indexes: client.exists(*[names[index] for index in indexes])
+        )
+        return sum(results.values())
+
+    def _run_grouped(self, groups: dict, function) -> dict:
+        """Calls function(client, indexes) for the node of every group in parallel"""
+        nodes = list(groups)
+        results = self.parallel(lambda node: function(self.clients[node], groups[node]), nodes)
+        return dict(zip(nodes, results))
+
+    def zrangebylex(self, name: str, minimum, maximum, start: int = None, num: int = None) -> list:
+        """Returns the first num members of a sorted set that every node keeps
+
+        Each node returns its own first num members and they are merged
+        in order, so start must be 0 or None
+        """
+        results = self.fan_out(lambda client: client.zrangebylex(name, minimum, maximum, start, num))
+        return merge_sorted(results, num)
+
+    def zrevrange(self, name: str, start: int, end: int, withscores: bool = False) -> list:
+        """Returns the highest members of a sorted set that every node keeps
+
+        Each node returns its own highest members and they are merged by
+        score, so start must be 0
+        """
+        results = self.fan_out(lambda client: client.zrevrange(name, start, end, withscores=True))
+        members = merge_sorted(results, end + 1 if end >= 0 else None, score, reverse=True)
+        return members if withscores else [member for member, _ in members]
+
+    def publish(self, channel: str, message: str) -> int:
+        """Publishes a message on the first node"""
+        return self.clients[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        """Returns a pub/sub object that listens to every node"""
+        return ShardedPubSub([client.pubsub(**kwargs) for client in self.clients])
+
+    def ping(self) -> bool:
+        """Pings every node"""
+        return all(self.fan_out(lambda client: client.ping()))
+
+    def flushall(self) -> bool:
+        """Removes every key from every node"""
+        return all(self.fan_out(lambda client: client.flushall()))
+
+    def pipeline(self, transaction: bool = False):
+        """Returns a pipeline that runs on every node that it touches"""
+        return ShardedPipeline(self, transaction)
+
+    def close(self):
+        """Closes the connections to every node"""
+        for client in self.clients:
+            client.close()
+        self._executor.shutdown(wait=False)
+        self._fan_out_executor.shutdown(wait=False)
+
+    def rebalance(self, dry_run: bool = False, keep: list = ()) -> dict:
+        """Moves every key that is not on the node that owns it
+
+        Run this after a node has been added to the list of nodes. A key is
+        copied with DUMP and RESTORE and only removed from its old node if
+        it did not change meanwhile. A key that already exists on its new
+        node is left where it is and counted as a conflict. The keys in keep
+        are kept by every node for itself and never moved.
+
+        Returns:
+            the number of keys that were scanned, moved and in conflict
+        """
+        totals = {"scanned": 0, "moved": 0, "conflicts": 0}
+        for node, client in enumerate(self.clients):
+            for key in client.scan_iter(count=1000):
+                totals["scanned"] += 1
+                owner = self.ring.node_for(key)
+                if owner == node or key in keep:
+                    continue
+                if dry_run:
+                    totals["moved"] += 1
+                elif move_key(client, self.clients[owner], key):
+                    totals["moved"] += 1
+                else:
+                    totals["conflicts"] += 1
+        return totals
+
+
+def move_key(source, target, key: str, retries: int = 3) -> bool:
+    """Moves a key to another node unless the key already exists there
+
+    The key is watched while it is copied so that it is not removed from
+    the source if it was changed in the meantime, and the copy is tried
+    again instead
+    """
+    for _ in range(retries):
+        with source.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                data = pipe.dump(key)
+                if data is None:
+                    return True
+                ttl = pipe.pttl(key)
+                target.restore(key, max(ttl, 0), data)
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                target.delete(key)
+            except redis.ResponseError as err:
+                logger.warning("Could not move %s: %s", key, err)
+                return False
+    return False
+
+
+class ShardedPipeline(ShardedPipelineBase):
+    """A pipeline for each node that a ShardedRedis pipeline touches"""
+
+    def evalsha(self, sha: str, numkeys: int, *keys_and_args):
+        """Queues a script on the node of its first key"""
+        self._queue_evalsha(sha, numkeys, *keys_and_args)
+        return self
+
+    def mget(self, keys: list):
+        """Queues an MGET on every node that owns some of the keys"""
+        self._queue_mget(keys)
+        return self
+
+    def execute(self) -> list:
+        """Runs the pipeline of every node in parallel"""
+        nodes = list(self._pipes)
+        results = self.sharded.parallel(lambda node: self._pipes[node].execute(), nodes)
+        return self._results(dict(zip(nodes, results)))
+
+
+class ShardedPubSub:
+    """Listens to the same channels on every node"""
+
+    def __init__(self, pubsubs: list):
+        self.pubsubs = pubsubs
+
+    def subscribe(self, *channels):
+        """Subscribes to the channels on every node"""
+        for pubsub in self.pubsubs:
+            pubsub.subscribe(*channels)
+
+    def get_message(self, timeout: float = 0.0):
+        """Returns the next message from any node or None after the timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            for pubsub in self.pubsubs:
+                message = pubsub.get_message(timeout=0.01)
+                if message:
+                    return message
+            if time.monotonic() >= deadline:
+                return None
+
+    def close(self):
+        """Closes the subscription to every node"""
+        for pubsub in self.pubsubs:
+            pubsub.close()
+
+
+######################################################################
+#  A S Y N C H R O N O U S   C L I E N T
+######################################################################
+
+
+class AsyncShardedRedis(ShardedBase):
+    """A redis.asyncio client that spreads keys over many nodes
+
+    See ShardedRedis for the arguments
+    """
+
+    async def fan_out(self, function) -> list:
+        """Awaits function(client) for every node concurrently"""
+        return await asyncio.gather(*(function(client) for client in self.clients))
+
+    def register_script(self, script: str) -> AsyncScript:
+        """Returns a script that runs on the node of its first key"""
+        script = AsyncScript(self, script)
+        self.scripts.append(script)
+        return script
+
+    async def evalsha(self, sha: str, numkeys: int, *keys_and_args):
+        """Runs a script on the node of its first key"""
+        return await self.client_for(keys_and_args[0]).evalsha(sha, numkeys, *keys_and_args)
+
+    async def script_load(self, script: str) -> str:
+        """Loads a script on every node"""
+        return (await self.fan_out(lambda client: client.script_load(script)))[0]
+
+    async def set(self, name: str, value, **kwargs):
+        """Sets the value of a key"""
+        return await self.client_for(name).set(name, value, **kwargs)
+
+    async def mset(self, mapping: dict) -> bool:
+        """Sets many keys with one MSET on each node"""
+        keys = list(mapping)
+        groups = self.ring.group(keys)
+        results = await self._run_grouped(
+            groups, lambda client, indexes: client.mset({keys[index]: mapping[keys[index]] for index in indexes})
+        )
+        return all(results.values())
+
+    async def delete(self, *names) -> int:
+        """Deletes keys and returns how many there were"""
+        groups = self.ring.group(names)
+        results = await self._run_grouped(
+            groups, lambda client, indexes: client.delete(*[names[index] for index in indexes])
+        )
+        return sum(results.values())
+
+    async def exists(self, *names) -> int:
+        """Returns how many of the keys exist"""
+        groups = self.ring.group(names)
+        results = await self._run_grouped(
+            groups, lambda client, indexes: client.exists(*[names[index] for index in indexes])
+        )
+        return sum(results.values())
+
+    async def _run_grouped(self, groups: dict, function) -> dict:
+        """Awaits function(client, indexes) for the node of every group concurrently"""
+        nodes = list(groups)
+        results = await asyncio.gather(*(function(self.clients[node], groups[node]) for node in nodes))
+        return dict(zip(nodes, results))
+
+    async def zrangebylex(self, name: str, minimum, maximum, start: int = None, num: int = None) -> list:
+        """Returns the first num members of a sorted set like ShardedRedis.zrangebylex()"""
+        results = await self.fan_out(lambda client: client.zrangebylex(name, minimum, maximum, start, num))
+        return merge_sorted(results, num)
+
+    async def zrevrange(self, name: str, start: int, end: int, withscores: bool = False) -> list:
+        """Returns the highest members of a sorted set like ShardedRedis.zrevrange()"""
+        results = await self.fan_out(lambda client: client.zrevrange(name, start, end, withscores=True))
+        members = merge_sorted(results, end + 1 if end >= 0 else None, score, reverse=True)
+        return members if withscores else [member for member, _ in members]
+
+    async def publish(self, channel: str, message: str) -> int:
+        """Publishes a message on the first node"""
+        return await self.clients[0].publish(channel, message)
+
+    async def ping(self) -> bool:
+        """Pings every node"""
+        return all(await self.fan_out(lambda client: client.ping()))
+
+    async def flushall(self) -> bool:
+        """Removes every key from every node"""
+        return all(await self.fan_out(lambda client: client.flushall()))
+
+    def pipeline(self, transaction: bool = False):
+        """Returns a pipeline that runs on every node that it touches"""
+        return AsyncShardedPipeline(self, transaction)
+
+    async def aclose(self):
+        """Closes the connections to every node"""
+        await self.fan_out(lambda client: client.aclose() if hasattr(client, "aclose") else client.close())
+
+
+class AsyncShardedPipeline(ShardedPipelineBase):
+    """A redis.asyncio pipeline for each node that a pipeline touches"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for pipe in self._pipes.values():
+            await pipe.reset()
+
+    def __await__(self):
+        return self._self().__await__()
+
+    async def _self(self):
+        return self
+
+    def evalsha(self, sha: str, numkeys: int, *keys_and_args):
+        """Queues a script on the node of its first key"""
+        self._queue_evalsha(sha, numkeys, *keys_and_args)
+        return self
+
+    def mget(self, keys: list):
+        """Queues an MGET on every node that owns some of the keys"""
+        self._queue_mget(keys)
+        return self
+
+    async def execute(self) -> list:
+        """Runs the pipeline of every node concurrently"""
+        nodes = list(self._pipes)
+        results = await asyncio.gather(*(self._pipes[node].execute() for node in nodes))
+        return self._results(dict(zip(nodes, results)))
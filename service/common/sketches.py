@@ -0,0 +1,220 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Sketches
+
+This module holds the parts of the probabilistic counters that do not
+talk to Redis.
+
+A unique counter is a Redis HyperLogLog, which counts distinct items in
+at most 12 KB with a standard error of 0.81% however many there are.
+
+A frequency sketch is a count-min sketch: ``depth`` rows of ``width``
+counters where every item adds its count to one counter of each row and
+its frequency is estimated by the smallest of them. With ``width`` =
+e / error and ``depth`` = ln(1 / (1 - confidence)), an estimate is at
+most ``error`` times the total of all counts too high, with the given
+confidence, and never too low. The sketch is one Redis string that is
+changed with BITFIELD: a header with the width, the depth and the total,
+followed by the counters as saturating unsigned 32 bit integers. Its
+size is fixed when it is created.
+
+Items are hashed in Python and the Lua scripts pick the counter of each
+row with double hashing, h1 + row * h2 modulo the width, so that an item
+is added to every row in one atomic step.
+"""
+import math
+import hashlib
+
+UNIQUE_PREFIX = "counters/unique/"
+SKETCH_PREFIX = "counters/sketch/"
+
+# relative standard error of a Redis HyperLogLog with 16384 registers
+HLL_STANDARD_ERROR = 1.04 / math.sqrt(16384)
+
+# bounds that keep a sketch under about 1 MB
+MIN_ERROR = 0.0001
+MAX_CONFIDENCE = 0.9999
+
+# Lua has a limit on the number of arguments it can pass to BITFIELD
+MAX_CELLS_PER_CALL = 1000
+
+# The add and read scripts return the width, the depth and the total
+# followed by the estimate of every item, or nil if there is no sketch.
+# The header is the width (u32 #0), the depth (u32 #1) and the total
+# (i64 at bit 64), and the counter of row r and column c is u32 #(4 + r * width + c)
+SKETCH = """
+local function header(key)
+    local values = redis.call("BITFIELD", key, "GET", "u32", "#0", "GET", "u32", "#1", "GET", "i64", 64)
+    return values[1], values[2], values[3]
+end
+
+local function cell(width, row, h1, h2)
+    return "#" .. (4 + row * width + (h1 + row * h2) % width)
+end
+"""
+
+SKETCH_CREATE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return false
+end
+local width, depth = tonumber(ARGV[1]), tonumber(ARGV[2])
+redis.call("BITFIELD", KEYS[1], "SET", "u32", "#0", width, "SET", "u32", "#1", depth,
+    "SET", "u32", "#" .. (3 + width * depth), 0)
+return 1
+"""
+
+SKETCH_ADD_SCRIPT = SKETCH + """
+local width, depth = header(KEYS[1])
+if width == 0 then
+    return false
+end
+local args = {"OVERFLOW", "SAT"}
+local total = 0
+for i = 1, #ARGV, 3 do
+    local h1, h2, count = tonumber(ARGV[i]), tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2])
+    total = total + count
+    for row = 0, depth - 1 do
+        table.insert(args, "INCRBY")
+        table.insert(args, "u32")
+        table.insert(args, cell(width, row, h1, h2))
+        table.insert(args, count)
+    end
+end
+table.insert(args, "INCRBY")
+table.insert(args, "i64")
+table.insert(args, 64)
+table.insert(args, total)
+local values = redis.call("BITFIELD", KEYS[1], unpack(args))
+local result = {width, depth, values[#values]}
+for item = 0, #ARGV / 3 - 1 do
+    local estimate = values[item * depth + 1]
+    for row = 1, depth - 1 do
+        estimate = math.min(estimate, values[item * depth + row + 1])
+    end
+    table.insert(result, estimate)
+end
+return result
+"""
+
+SKETCH_READ_SCRIPT = SKETCH + """
+local width, depth, total = header(KEYS[1])
+if width == 0 then
+    return false
+end
+local result = {width, depth, total}
+for i = 1, #ARGV, 2 do
+    local h1, h2 = tonumber(ARGV[i]), tonumber(ARGV[i + 1])
+    local args = {}
+    for row = 0, depth - 1 do
+        table.insert(args, "GET")
+        table.insert(args, "u32")
+        table.insert(args, cell(width, row, h1, h2))
+    end
+    local values = redis.call("BITFIELD", KEYS[1], unpack(args))
+    table.insert(result, math.min(unpack(values)))
+end
+return result
+"""
+
+SKETCH_SCRIPTS = {
+    "sketch_create": SKETCH_CREATE_SCRIPT,
+    "sketch_add": SKETCH_ADD_SCRIPT,
+    "sketch_read": SKETCH_READ_SCRIPT,
+}
+
+
+def is_sketch_key(key: str) -> bool:
+    """Returns True if the key is the key of a unique counter or a frequency sketch"""
+    return key.startswith((UNIQUE_PREFIX, SKETCH_PREFIX))
+
+
+def unique_key(name: str) -> str:
+    """Returns the key of the HyperLogLog of a unique counter"""
+    return f"{UNIQUE_PREFIX}{name}"
+
+
+def sketch_key(name: str) -> str:
+    """Returns the key of a frequency sketch"""
+    return f"{SKETCH_PREFIX}{name}"
+
+
+def sketch_dimensions(error, confidence) -> tuple:
+    """Returns the width and depth of a sketch with the error bounds
+
+    Arguments:
+        error: how far an estimate may be too high, as a fraction of the total
+        confidence: the probability that an estimate is within the error
+
+    Raises:
+        ValueError: a bound is not a number, or would make a sketch
+            larger than about 1 MB
+    """
+    error = _parse_fraction(error, "error", MIN_ERROR, 1)
+    confidence = _parse_fraction(confidence, "confidence", 0, MAX_CONFIDENCE)
+    return math.ceil(math.e / error), math.ceil(math.log(1 / (1 - confidence)))
+
+
+def _parse_fraction(text, name: str, minimum: float, maximum: float) -> float:
+    """Returns a bound as a float between 0 and 1 and within minimum and maximum"""
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        value = None
+    if value is None or not minimum <= value <= maximum or value in (0, 1):
+        raise ValueError(f"Invalid value for '{name}': {text}")
+    return value
+
+
+def sketch_bounds(width: int, depth: int) -> tuple:
+    """Returns the error and the confidence of a sketch of the size"""
+    return math.e / width, 1 - math.exp(-depth)
+
+
+def item_hashes(item: str) -> tuple:
+    """Returns the two 32 bit hashes of an item that pick its counters"""
+    digest = hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest[:4], "big"), int.from_bytes(digest[4:], "big") | 1
+
+
+def add_args(items: dict) -> list:
+    """Returns the arguments of the add script for items and their counts"""
+    args = []
+    for item, count in items.items():
+        args.extend(item_hashes(item))
+        args.append(count)
+    return args
+
+
+def read_args(items: list) -> list:
+    """Returns the arguments of the read script for items"""
+    args = []
+    for item in items:
+        args.extend(item_hashes(item))
+    return args
+
+
+def chunks(items: dict, depth: int) -> list:
+    """Splits items into chunks that the add script can take in one call"""
+    size = max(MAX_CELLS_PER_CALL // depth, 1)
+    names = list(items)
+    return [{name: items[name] for name in names[start:start + size]} for start in range(0, len(names), size)]
+
+
+def unique_error(estimate: int) -> int:
+    """Returns the standard error of the estimate of a unique counter"""
+    return math.ceil(estimate * HLL_STANDARD_ERROR)
@@ -0,0 +1,108 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Redis Tracing
+
+This module records every Redis command that a request sends, so that
+the number of round trips an endpoint makes can be seen in its
+Server-Timing header and asserted on in tests.
+
+The trace of a request is kept in a context variable, which the metered
+clients of service.common.metrics add to after every round trip. The
+threads and tasks that a request fans out to see the same trace.
+"""
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import Counter as Tally
+
+_trace = contextvars.ContextVar("redis_trace", default=None)
+
+
+class RedisTrace:
+    """The Redis round trips of one request
+
+    Every round trip is kept as the names of the commands it sent and the
+    seconds until Redis replied. A pipeline is one round trip.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.round_trips = []
+
+    def add(self, commands: list, seconds: float):
+        """Records a round trip that sent some commands"""
+        with self._lock:
+            self.round_trips.append((commands, seconds))
+
+    @property
+    def seconds(self) -> float:
+        """Returns the seconds spent waiting on Redis"""
+        return sum(seconds for _, seconds in self.round_trips)
+
+    def commands(self) -> dict:
+        """Returns the number of times that each command was sent"""
+        return dict(Tally(command for commands, _ in self.round_trips for command in commands))
+
+    def server_timing(self) -> str:
+        """Returns the trace as a Server-Timing header value"""
+        count = sum(len(commands) for commands, _ in self.round_trips)
+        return f'redis;desc="round trips: {len(self.round_trips)}, commands: {count}";dur={self.seconds * 1000:.3f}'
+
+    def serialize(self) -> dict:
+        """Converts the trace into a dictionary for a structured log line"""
+        return {
+            "round_trips": len(self.round_trips),
+            "commands": self.commands(),
+            "ms": round(self.seconds * 1000, 3),
+            "trace": [{"commands": commands, "ms": round(seconds * 1000, 3)} for commands, seconds in self.round_trips],
+        }
+
+
+def current_trace():
+    """Returns the trace of the current request or None if it is not traced"""
+    return _trace.get()
+
+
+def start_trace() -> RedisTrace:
+    """Starts tracing the Redis commands of the current request"""
+    trace = RedisTrace()
+    _trace.set(trace)
+    return trace
+
+
+def stop_trace():
+    """Stops tracing and returns the trace, or None if there was none"""
+    trace = _trace.get()
+    _trace.set(None)
+    return trace
+
+
+@contextmanager
+def trace_redis():
+    """Traces the Redis commands sent in a block of code
+
+    Example:
+        with trace_redis() as trace:
+            Counter.find("foo")
+        assert len(trace.round_trips) == 1
+    """
+    token = _trace.set(RedisTrace())
+    try:
+        yield _trace.get()
+    finally:
+        _trace.reset(token)
@@ -0,0 +1,173 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Write-Behind Buffer
+
+This module contains a per process buffer that adds up increments in
+memory and writes them to the database in batches.
+
+Increments are flushed every ``interval`` seconds by a background thread,
+as soon as ``max_pending`` increments have been buffered, and when the
+process exits normally. A forked child, like a gunicorn worker, starts
+with an empty buffer and a flush thread of its own.
+
+Bound on lost increments: the buffer never holds more than ``max_pending``
+increments. When it is full the next increment flushes it first and is
+rejected if that flush fails, so a process that is killed without running
+its exit handlers loses at most ``max_pending`` increments, or the ones
+accepted in the last ``interval`` seconds if that is fewer.
+"""
+import os
+import atexit
+import logging
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# every buffer of this process, which a forked child resets, see _after_fork()
+_buffers = weakref.WeakSet()
+
+
+class WriteBehindBuffer:
+    """Coalesces increments by name and writes them behind in batches
+
+    Arguments:
+        flush_fn: called with a dictionary of name to total increment that
+            writes them and returns a dictionary of name to the new value,
+            or None when the name no longer exists
+        interval: seconds between background flushes
+        max_pending: maximum number of increments to hold in memory
+    """
+
+    def __init__(self, flush_fn, interval: float = 1.0, max_pending: int = 1000):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._count = 0
+        self._values = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        _buffers.add(self)
+
+    def start(self):
+        """Starts the background flush thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the background thread and flushes what is left"""
+        atexit.unregister(self.stop)
+        self._stopped.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        try:
+            self.flush()
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error("Lost %d buffered increments: %s", self._count, err)
+
+    def add(self, name: str, amount: int = 1) -> int:
+        """Buffers an increment and returns the pending delta for the name
+
+        Raises:
+            Exception: the buffer was full and could not be flushed
+        """
+        while True:
+            with self._lock:
+                if self._count < self.max_pending:
+                    self._pending[name] = self._pending.get(name, 0) + amount
+                    self._count += 1
+                    return self._pending[name]
+            self.flush()
+
+    def pending(self, name: str) -> int:
+        """Returns the increments for the name that are not written yet"""
+        return self._pending.get(name, 0)
+
+    def value(self, name: str):
+        """Returns the value of the name from the last flush or None"""
+        return self._values.get(name)
+
+    def remember(self, name: str, value: int):
+        """Records a value for the name that was read from the database"""
+        with self._lock:
+            self._values[name] = value
+
+    def discard(self, name: str):
+        """Forgets the pending increments and value of a removed name"""
+        with self._lock:
+            self._pending.pop(name, None)
+            self._values.pop(name, None)
+
+    def flush(self) -> int:
+        """Writes the pending increments and returns how many there were
+
+        The increments are put back in the buffer if they cannot be written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            count, self._count = self._count, 0
+        if not pending:
+            return 0
+        try:
+            results = self.flush_fn(pending)
+        except Exception:
+            with self._lock:
+                for name, amount in pending.items():
+                    self._pending[name] = self._pending.get(name, 0) + amount
+                self._count += count
+            raise
+        with self._lock:
+            self._values = {
+                name: value for name, value in results.items() if value is not None
+            }
+        logger.debug("Flushed %d increments for %d names", count, len(pending))
+        return count
+
+    def _run(self):
+        """Flushes the buffer until the buffer is stopped"""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning("Write-behind flush failed: %s", err)
+
+    def _after_fork(self):
+        """Gives a forked child its own empty buffer and flush thread"""
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._count = 0
+        self._values = {}
+        if self._thread is not None:
+            self.start()
+
+
+def _after_fork():
+    """Resets every buffer in a forked child"""
+    for buffer in list(_buffers):
+        buffer._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -5,5 +5,125 @@ import os
 import logging
 
 # Get configuration from environment
+# DATABASE_URI can be a comma separated list of uris to shard counters across
 DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+REDIS_VIRTUAL_NODES = int(os.getenv("REDIS_VIRTUAL_NODES", "160"))
 LOGGING_LEVEL = logging.INFO
+
+# Log records are written by a background thread from a queue of at most
+# LOG_QUEUE_SIZE records, or by the request thread when it is 0, and only
+# a share of the records of the levels in LOG_SAMPLE_RATES, like
+# "INFO=0.1,DEBUG=0", is kept
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "0"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+# Responses are encoded with orjson, or with the json module of Flask and
+# Quart when JSON_PROVIDER is "flask"
+JSON_PROVIDER = os.getenv("JSON_PROVIDER", "orjson")
+
+# Paging of the counter listings
+COUNTERS_PAGE_SIZE = int(os.getenv("COUNTERS_PAGE_SIZE", "1000"))
+COUNTERS_MAX_PAGE_SIZE = int(os.getenv("COUNTERS_MAX_PAGE_SIZE", "10000"))
+
+# Striped counters spread their increments over many keys
+COUNTERS_MAX_STRIPES = int(os.getenv("COUNTERS_MAX_STRIPES", "64"))
+STRIPE_SELECTION = os.getenv("STRIPE_SELECTION", "random")
+
+# Write-behind buffering of increments
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "False").lower() in ["true", "yes", "1"]
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "1000"))
+
+# Largest number of operations in one batch request
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "1000"))
+
+# Most counters that the leaderboard of each shard keeps, 0 to turn it off
+COUNTERS_TOP_SIZE = int(os.getenv("COUNTERS_TOP_SIZE", "1000"))
+
+# Counters are kept in this many hashes, about one per 100 counters, or 0 for a key each
+COUNTERS_BUCKETS = int(os.getenv("COUNTERS_BUCKETS", "0"))
+
+# Rollups of increments per second, minute and hour for GET /counters/<name>/rate
+RATES_ENABLED = os.getenv("RATES_ENABLED", "False").lower() in ["true", "yes", "1"]
+
+# Unique counters and frequency sketches: most items per request and the
+# default bounds of a new sketch, which is at most SKETCH_ERROR times its
+# total too high with SKETCH_CONFIDENCE
+SKETCH_MAX_ITEMS = int(os.getenv("SKETCH_MAX_ITEMS", "1000"))
+SKETCH_ERROR = float(os.getenv("SKETCH_ERROR", "0.001"))
+SKETCH_CONFIDENCE = float(os.getenv("SKETCH_CONFIDENCE", "0.99"))
+
+# Streaming imports are written in pipelined batches
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_BATCH_SIZE = int(os.getenv("IMPORT_MAX_BATCH_SIZE", "10000"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "100"))
+
+# Per worker cache of counter values
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "False").lower() in ["true", "yes", "1"]
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "1.0"))
+CHANGES_CHANNEL = os.getenv("CHANGES_CHANNEL", "counters:changes")
+
+# Server-Sent Events streams of counter changes, which are gathered for
+# EVENTS_WINDOW seconds before they are sent. Each stream holds a thread of
+# a synchronous worker, which opens at most EVENTS_MAX_STREAMS of them
+EVENTS_ENABLED = os.getenv("EVENTS_ENABLED", "False").lower() in ["true", "yes", "1"]
+EVENTS_WINDOW = float(os.getenv("EVENTS_WINDOW", "0.2"))
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15.0"))
+EVENTS_MAX_COUNTERS = int(os.getenv("EVENTS_MAX_COUNTERS", "100"))
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", "4"))
+EVENTS_RETRY_AFTER = int(os.getenv("EVENTS_RETRY_AFTER", "5"))
+
+# Trace the Redis commands of every request into its Server-Timing header
+# and, with REDIS_TRACE_LOG, a structured log line
+REDIS_TRACING = os.getenv("REDIS_TRACING", "False").lower() in ["true", "yes", "1"]
+REDIS_TRACE_LOG = os.getenv("REDIS_TRACE_LOG", "False").lower() in ["true", "yes", "1"]
+
+# Profile PROFILE_RATE of the requests, and those with an X-Profile header
+# that holds PROFILE_TOKEN, into PROFILE_DIR every PROFILE_INTERVAL seconds.
+# PROFILE_TOKEN also authorizes the admin endpoint that changes the rate
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+PROFILE_RATE = float(os.getenv("PROFILE_RATE", "0.0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "60.0"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+
+# Let at most ADMISSION_*_LIMIT requests of each route class run at once
+# in a worker, and up to ADMISSION_MAX_QUEUE more wait for ADMISSION_INTERVAL
+# seconds, or only ADMISSION_TARGET seconds once the queue stops draining.
+# The rest get 503 with Retry-After: ADMISSION_RETRY_AFTER. The limits stay
+# below the GUNICORN_THREADS of gunicorn.conf.py so that they can be reached
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "False").lower() in ["true", "yes", "1"]
+ADMISSION_READ_LIMIT = int(os.getenv("ADMISSION_READ_LIMIT", "12"))
+ADMISSION_WRITE_LIMIT = int(os.getenv("ADMISSION_WRITE_LIMIT", "8"))
+ADMISSION_LISTING_LIMIT = int(os.getenv("ADMISSION_LISTING_LIMIT", "2"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+ADMISSION_TARGET = float(os.getenv("ADMISSION_TARGET", "0.005"))
+ADMISSION_INTERVAL = float(os.getenv("ADMISSION_INTERVAL", "0.1"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Fail the commands to a Redis node fast once CIRCUIT_FAILURE_RATE of the
+# last CIRCUIT_WINDOW commands failed or took over CIRCUIT_SLOW_SECONDS, and
+# probe it again after CIRCUIT_OPEN_SECONDS, doubled after each failed probe
+CIRCUIT_BREAKER = os.getenv("CIRCUIT_BREAKER", "False").lower() in ["true", "yes", "1"]
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_SECONDS = float(os.getenv("CIRCUIT_SLOW_SECONDS", "1.0"))
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "1.0"))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv("CIRCUIT_MAX_OPEN_SECONDS", "30.0"))
+
+# Serve the last value that a worker read of a counter, for up to
+# STALE_MAX_AGE seconds, while Redis cannot be reached
+STALE_READS = os.getenv("STALE_READS", "False").lower() in ["true", "yes", "1"]
+STALE_MAX_SIZE = int(os.getenv("STALE_MAX_SIZE", "10000"))
+STALE_MAX_AGE = float(os.getenv("STALE_MAX_AGE", "300.0"))
+
+# Redis connection pool of each worker
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5.0"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5.0"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2.0"))
+REDIS_SOCKET_KEEPALIVE = os.getenv("REDIS_SOCKET_KEEPALIVE", "True").lower() in ["true", "yes", "1"]
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
@@ -16,10 +16,24 @@
 """
 Counter Model
 """
+# pylint: disable=too-many-lines
 import os
+import time
+import random
 import logging
-from redis import Redis
-from redis.exceptions import ConnectionError as RedisConnectionError
+import itertools
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from service.common.buckets import bucket_key, is_bucket_key, group_by_bucket, ungroup, move_to_bucket
+from service.common.cache import LRUCache
+from service.common.circuit_breaker import CircuitBreaker
+from service.common.connection_pool import create_pool
+from service.common.events import EventHub
+from service.common.metrics import MeteredRedis
+from service.common.notifications import ChangeListener
+from service.common.rollups import queue_rollups, window_keys, is_rollup_key
+from service.common.sharding import ShardedRedis, split_uris
+from service.common.sketches import SKETCH_SCRIPTS, is_sketch_key
+from service.common.write_behind import WriteBehindBuffer
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +44,376 @@ class DatabaseConnectionError(RedisConnectionError):
     """Generic Exception for Redis database connection errors"""
 
 
-class Counter:
+######################################################################
+#  L U A   S C R I P T S
+######################################################################
+# Each script changes or reads a counter in a single atomic round trip
+# and returns nil when the counter is not in the state the caller needs.
+# Scripts that change a counter take the pub/sub channel for change
+# notifications and the size of the leaderboard as their last arguments,
+# and publish nothing when the channel is ""
+#
+# A counter is either a string key of its own, when the first argument is
+# "", or the field named by the first argument of the hash bucket KEYS[1].
+# See service.common.buckets for the hashes.
+#
+# A striped counter keeps the marker "*<stripes>" under its name and its
+# value in the counters "<name>/0" to "<name>/<stripes - 1>". Increment
+# returns the marker without changing anything so the caller can pick a
+# stripe, and set and delete return the value they replaced so the stripes
+# can go too
+#
+# The names of the counters are also kept in the sorted set INDEX_KEY with
+# a score of 0, so that they are sorted by name and can be listed by prefix
+# with ZRANGEBYLEX. The sorted set TOP_KEY keeps the highest counters scored
+# by their values for the leaderboard and is trimmed to its size by dropping
+# the lowest. Scripts change both in the same atomic step as the counter.
+# Every shard keeps these sets for its own counters because a script runs on
+# the node of its first key. Counter names cannot contain a "/" so the sets
+# never clash with a counter.
+#
+# Every change also counts up the generation GENERATION_KEY of the node
+# and stamps the counter with it as its version in the hash VERSIONS_KEY,
+# so that a client can tell if a counter, or any counter on a node, changed
+# since it last looked. A new generation starts at the time of the node in
+# microseconds so that generations never repeat after the keys are flushed.
+# The stripes of a striped counter only count up the generation and the
+# counter gets its version when its total is ranked and published.
+
+INDEX_KEY = "counters/index"
+TOP_KEY = "counters/top"
+VERSIONS_KEY = "counters/versions"
+GENERATION_KEY = "counters/generation"
+
+# the keys that every node keeps for its own counters
+NODE_KEYS = (INDEX_KEY, TOP_KEY, VERSIONS_KEY, GENERATION_KEY)
+
+COUNTER = """
+local function counter_name(key, field)
+    if field == "" then
+        return key
+    end
+    return field
+end
+
+local function get(key, field)
+    if field == "" then
+        return redis.call("GET", key)
+    end
+    return redis.call("HGET", key, field)
+end
+
+local function put(key, field, value)
+    if field == "" then
+        redis.call("SET", key, value)
+    else
+        redis.call("HSET", key, field, value)
+    end
+end
+"""
+
+NOTIFY = COUNTER + """
+local function notify(channel, name, value)
+    if channel ~= "" then
+        redis.call("PUBLISH", channel, cjson.encode({name = name, counter = value}))
+    end
+end
+
+local function rank(key, name, value, size)
+    if size > 0 and value then
+        redis.call("ZADD", key, value, name)
+        local extra = redis.call("ZCARD", key) - size
+        if extra > 0 then
+            redis.call("ZREMRANGEBYRANK", key, 0, extra - 1)
+        end
+    end
+end
+
+local function bump(name)
+    local version = redis.call("INCR", KEYS[5])
+    if version == 1 then
+        version = redis.call("TIME")[1] .. "000000"
+        redis.call("SET", KEYS[5], version)
+    end
+    if not string.find(name, "/", 1, true) then
+        redis.call("HSET", KEYS[4], name, version)
+    end
+end
+"""
+
+CREATE_SCRIPT = NOTIFY + """
+local name = counter_name(KEYS[1], ARGV[1])
+if get(KEYS[1], ARGV[1]) then
+    return false
+end
+put(KEYS[1], ARGV[1], ARGV[2])
+redis.call("ZADD", KEYS[2], 0, name)
+rank(KEYS[3], name, tonumber(ARGV[2]), tonumber(ARGV[4]))
+bump(name)
+notify(ARGV[3], name, tonumber(ARGV[2]))
+return ARGV[2]
+"""
+
+INCREMENT_SCRIPT = NOTIFY + """
+local value = get(KEYS[1], ARGV[1])
+if not value then
+    return false
+end
+if string.sub(value, 1, 1) == "*" then
+    return value
+end
+local count
+if ARGV[1] == "" then
+    count = redis.call("INCRBY", KEYS[1], ARGV[2])
+else
+    count = redis.call("HINCRBY", KEYS[1], ARGV[1], ARGV[2])
+end
+local name = counter_name(KEYS[1], ARGV[1])
+rank(KEYS[3], name, count, tonumber(ARGV[4]))
+bump(name)
+notify(ARGV[3], name, count)
+return count
+"""
+
+SET_SCRIPT = NOTIFY + """
+local name = counter_name(KEYS[1], ARGV[1])
+local value = get(KEYS[1], ARGV[1])
+put(KEYS[1], ARGV[1], ARGV[2])
+redis.call("ZADD", KEYS[2], 0, name)
+rank(KEYS[3], name, tonumber(ARGV[2]), tonumber(ARGV[4]))
+bump(name)
+notify(ARGV[3], name, tonumber(ARGV[2]))
+return value
+"""
+
+CHANGED_SCRIPT = NOTIFY + """
+local name = counter_name(KEYS[1], ARGV[1])
+rank(KEYS[3], name, tonumber(ARGV[2]), tonumber(ARGV[4]))
+bump(name)
+notify(ARGV[3], name, tonumber(ARGV[2]))
+return ARGV[2]
+"""
+
+READ_SCRIPT = COUNTER + """
+return get(KEYS[1], ARGV[1])
+"""
+
+FIND_SCRIPT = COUNTER + """
+local value = get(KEYS[1], ARGV[1])
+if not value then
+    return false
+end
+return {value, redis.call("HGET", KEYS[2], counter_name(KEYS[1], ARGV[1])) or "0"}
+"""
+
+DELETE_SCRIPT = NOTIFY + """
+local name = counter_name(KEYS[1], ARGV[1])
+local value = get(KEYS[1], ARGV[1])
+if value then
+    if ARGV[1] == "" then
+        redis.call("DEL", KEYS[1])
+    else
+        redis.call("HDEL", KEYS[1], ARGV[1])
+    end
+    redis.call("ZREM", KEYS[2], name)
+    redis.call("ZREM", KEYS[3], name)
+    bump(name)
+    redis.call("HDEL", KEYS[4], name)
+    notify(ARGV[2], name, cjson.null)
+end
+return value
+"""
+
+LUA_SCRIPTS = {
+    "create": CREATE_SCRIPT,
+    "increment": INCREMENT_SCRIPT,
+    "set": SET_SCRIPT,
+    "changed": CHANGED_SCRIPT,
+    "read": READ_SCRIPT,
+    "find": FIND_SCRIPT,
+    "delete": DELETE_SCRIPT,
+    **SKETCH_SCRIPTS,
+}
+
+BATCH_OPERATIONS = ("create", "increment", "read", "delete")
+
+
+def counter_key(name: str, buckets: int = 0) -> str:
+    """Returns the key that holds a counter, which is its bucket when there are buckets"""
+    return bucket_key(name, buckets) if buckets else name
+
+
+def script_keys(operation: str, name: str, buckets: int = 0) -> list:
+    """Returns the keys of the Lua script for an operation on a counter
+
+    Arguments:
+        operation: one of BATCH_OPERATIONS or "set", "changed" or "find"
+        name: the name of the counter
+        buckets: the number of hash buckets or 0 for a key per counter
+    """
+    if operation == "read":
+        return [counter_key(name, buckets)]
+    if operation == "find":
+        return [counter_key(name, buckets), VERSIONS_KEY]
+    return [counter_key(name, buckets), INDEX_KEY, TOP_KEY, VERSIONS_KEY, GENERATION_KEY]
+
+
+def script_args(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    operation: str, name: str, number: int = 0, channel: str = "", top_size: int = 0, buckets: int = 0
+) -> list:
+    """Returns the arguments of the Lua script for an operation
+
+    Arguments:
+        operation: one of BATCH_OPERATIONS or "set", "changed" or "find"
+        name: the name of the counter
+        number: the initial value to create or the amount to increment by
+        channel: the pub/sub channel for change notifications or ""
+        top_size: the most counters the leaderboard keeps or 0 to leave it alone
+        buckets: the number of hash buckets or 0 for a key per counter
+    """
+    field = name if buckets else ""
+    if operation in ("read", "find"):
+        return [field]
+    if operation == "delete":
+        return [field, channel]
+    return [field, number, channel, top_size]
+
+
+def queue_read(pipe, names: list, buckets: int = 0):
+    """Queues reading the raw values of counters on a pipeline
+
+    The values are read with one MGET, or with one HMGET per bucket when
+    the counters are kept in buckets. See read_results().
+    """
+    if not buckets:
+        pipe.mget(names)
+        return
+    for key, positions in group_by_bucket(names, buckets).items():
+        pipe.hmget(key, [names[position] for position in positions])
+
+
+def read_results(names: list, results: list, buckets: int = 0) -> list:
+    """Returns the values read by queue_read() in the order of the names"""
+    if not buckets:
+        return results[0]
+    return ungroup(group_by_bucket(names, buckets), results, len(names))
+
+
+def entity_tag(version, count) -> str:
+    """Returns the entity tag of a counter or None when its version was not read
+
+    The value is part of the tag so that a counter that was moved to
+    another shard never matches a tag from its old shard
+    """
+    if version is None:
+        return None
+    return f"{version}-{count}"
+
+
+######################################################################
+#  S T R I P E D   C O U N T E R S
+######################################################################
+# A hot counter can be split into stripes that are incremented one at a
+# time so that no single key takes every write. Its value is the sum of
+# its stripes, which is read with one MGET.
+
+STRIPES_MARKER = "*"
+STRIPE_SEPARATOR = "/"
+
+
+def stripe_keys(name: str, stripes: int) -> list:
+    """Returns the keys of the stripes of a counter"""
+    return [f"{name}{STRIPE_SEPARATOR}{index}" for index in range(stripes)]
+
+
+def stripe_count(value) -> int:
+    """Returns the number of stripes from a marker or 0 for other values"""
+    if isinstance(value, str) and value.startswith(STRIPES_MARKER):
+        return int(value[len(STRIPES_MARKER):])
+    return 0
+
+
+def is_stripe_key(key: str) -> bool:
+    """Returns True if the key holds a stripe of a counter"""
+    name, separator, index = key.rpartition(STRIPE_SEPARATOR)
+    return bool(name and separator and index.isdigit())
+
+
+def pick_stripe(stripes: int, selection: str = "random") -> int:
+    """Picks the stripe to increment at random or one per worker process"""
+    if selection == "worker":
+        return os.getpid() % stripes
+    return random.randrange(stripes)
+
+
+def striped_keys(names: list, values: list) -> list:
+    """Returns the keys of every stripe of the striped counters in values"""
+    keys = []
+    for name, value in zip(names, values):
+        keys.extend(stripe_keys(name, stripe_count(value)))
+    return keys
+
+
+def counter_values(values: list, stripe_values: list) -> list:
+    """Converts values read from Redis into counter values
+
+    Arguments:
+        values: the values of the names, which are None for missing counters
+            and markers for striped counters
+        stripe_values: the values of the keys returned by striped_keys()
+    """
+    stripe_values = iter(stripe_values)
+    counts = []
+    for value in values:
+        stripes = stripe_count(value)
+        if value is None:
+            counts.append(None)
+        elif stripes:
+            counts.append(sum(int(part or 0) for part in itertools.islice(stripe_values, stripes)))
+        else:
+            counts.append(int(value))
+    return counts
+
+
+######################################################################
+#  N A M E   I N D E X
+######################################################################
+
+
+def lex_range(prefix: str = "", after: str = "") -> tuple:
+    """Returns the ZRANGEBYLEX bounds of the names that start with a prefix
+
+    Arguments:
+        prefix: the start of the names or "" for every name
+        after: only return the names that sort after this one
+    """
+    if after and after >= prefix:
+        minimum = b"(" + after.encode("utf-8")
+    elif prefix:
+        minimum = b"[" + prefix.encode("utf-8")
+    else:
+        minimum = b"-"
+    # 0xff is never part of a UTF-8 name so it sorts after every name with the prefix
+    maximum = b"[" + prefix.encode("utf-8") + b"\xff" if prefix else b"+"
+    return minimum, maximum
+
+
+def is_counter(key: str, value) -> bool:
+    """Returns True if a key and its value look like those of a counter"""
+    if value is None or STRIPE_SEPARATOR in key:
+        return False
+    digits = value[1:] if value[:1] in (STRIPES_MARKER, "-") else value
+    return digits.isdigit()
+
+
+def is_counter_key(key: str, value) -> bool:
+    """Returns True if a key and its value look like those of a counter or of a stripe"""
+    if is_stripe_key(key):
+        return value is not None and value.lstrip("-").isdigit()
+    return is_counter(key, value)
+
+
+class Counter:  # pylint: disable=too-many-public-methods
     """An integer counter that is persisted in Redis
 
     You can establish a connection to Redis using an environment
@@ -42,10 +425,29 @@ class Counter:
     """
 
     redis = None
+    database_uri = []
+    virtual_nodes = 160
+    pool_options = {}
+    scripts = {}
+    channel = ""
+    listener = None
+    cache = None
+    last_known = None
+    breaker_options = None
+    events = None
+    write_behind = None
+    stripe_counts = {}
+    stripe_selection = "random"
+    top_size = 1000
+    buckets = 0
+    rates = False
 
     def __init__(self, name: str = "hits", value: int = None):
         """Constructor"""
         self.name = name
+        self._count = None
+        self.version = None
+        self.age = None
         if not value:
             self.value = 0
         else:
@@ -53,29 +455,619 @@ class Counter:
 
     @property
     def value(self):
-        """Returns the current value of the counter"""
-        return int(Counter.redis.get(self.name))
+        """Returns the current value of the counter or None if it does not exist
+
+        The stripes of a striped counter are added up and the increments
+        that this worker buffered are added like find() does
+        """
+        count = Counter._counter_values([self.name], Counter._read_many([self.name]))[0]
+        self._count = None if count is None else count + Counter.pending(self.name)
+        return self._count
 
     @value.setter
     def value(self, value):
         """Sets the value of the counter"""
-        Counter.redis.set(self.name, value)
+        Counter.scripts["set"](keys=Counter._keys("set", self.name), args=Counter._args("set", self.name, value))
+        self._count = int(value)
 
     @value.deleter
     def value(self):
         """Removes the counter fom the database"""
-        Counter.redis.delete(self.name)
+        Counter.scripts["delete"](keys=Counter._keys("delete", self.name), args=Counter._args("delete", self.name))
+        self._count = None
 
     def increment(self):
-        """Increments the current value of the counter by 1"""
-        return Counter.redis.incr(self.name)
+        """Increments the current value of the counter by 1
+
+        Like increment_existing() it increments striped counters, buffers
+        the increment with write-behind and adds to the rollups, and like
+        INCR it creates a counter that does not exist with the value 1
+        """
+        count = Counter.increment_existing(self.name)
+        if count is None:
+            created = Counter.create(self.name, 1)
+            count = created._count if created else Counter.increment_existing(self.name)
+        self._count = count
+        return self._count
 
     def serialize(self):
-        """Converts a counter into a dictionary"""
-        return {
-            "name": self.name,
-            "counter": int(Counter.redis.get(self.name))
-        }
+        """Converts a counter into a dictionary
+
+        The value is the one last read or written by this counter so
+        serializing does not need another round trip to the database
+        """
+        return {"name": self.name, "counter": self._count}
+
+    @property
+    def etag(self):
+        """Returns a tag that changes whenever the counter does, or None if it was not found"""
+        return entity_tag(self.version, self._count)
+
+    @classmethod
+    def _load(cls, name: str, count, version=None) -> "Counter":
+        """Makes a counter from a value that was read from the database"""
+        counter = cls.__new__(cls)
+        counter.name = name
+        counter._count = int(count)
+        counter.version = version
+        counter.age = None
+        return counter
+
+    ######################################################################
+    #  A T O M I C   O P E R A T I O N S
+    ######################################################################
+
+    @classmethod
+    def create(cls, name: str, value: int = 0, stripes: int = 1):
+        """Creates a counter unless it already exists
+
+        Arguments:
+            name: the name of the counter
+            value: the initial value of the counter
+            stripes: the number of keys that increments are spread over
+
+        Returns:
+            the new Counter or None if the counter already exists
+        """
+        if stripes > 1:
+            return cls._create_striped(name, value, stripes)
+        try:
+            count = cls.scripts["create"](keys=cls._keys("create", name), args=cls._args("create", name, value))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls._forget(name)
+        if count is None:
+            return None
+        return cls._load(name, count)
+
+    @classmethod
+    def increment_existing(cls, name: str, amount: int = 1):
+        """Increments a counter only if it already exists
+
+        Returns:
+            the new value of the counter or None if it does not exist
+        """
+        try:
+            if cls.write_behind:
+                return cls._buffer_increment(name, amount)
+            count = cls._increment(name, amount)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls._forget(name)
+        return count
+
+    @classmethod
+    def remove(cls, name: str) -> bool:
+        """Removes a counter and returns True if it existed"""
+        if cls.write_behind:
+            cls.write_behind.discard(name)
+        try:
+            deleted = cls.scripts["delete"](keys=cls._keys("delete", name), args=cls._args("delete", name))
+            cls._remove_stripes(name, deleted)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls._forget(name)
+        if cls.last_known:
+            cls.last_known.invalidate(name)
+        return deleted is not None
+
+    ######################################################################
+    #  B U L K   O P E R A T I O N S
+    ######################################################################
+
+    @classmethod
+    def batch(cls, operations: list) -> list:
+        """Runs many counter operations in a single pipeline
+
+        Arguments:
+            operations: a list of (operation, name, number) tuples where the
+                operation is one of BATCH_OPERATIONS and the number is the
+                initial value to create or the amount to increment by
+
+        Returns:
+            a list with the result of each operation in the same order: the
+            value of the counter or None when it was missing (or already
+            existed for create), and True or False for delete
+        """
+        try:
+            pipe = cls.redis.pipeline(transaction=False)
+            for operation, name, number in operations:
+                cls.scripts[operation](
+                    keys=cls._keys(operation, name), args=cls._args(operation, name, number), client=pipe
+                )
+            for operation, name, number in operations:
+                if operation == "increment":
+                    cls._queue_rollups(pipe, name, number)
+            results = pipe.execute()[:len(operations)]
+            return [
+                cls._batch_result(operation, name, number, result)
+                for (operation, name, number), result in zip(operations, results)
+            ]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+    @classmethod
+    def _batch_result(cls, operation: str, name: str, number: int, result):
+        """Converts the result of a script the way its single method does
+
+        Striped counters take another round trip to read or increment
+        their stripes
+        """
+        if operation != "read":
+            cls._forget(name)
+        if operation == "delete":
+            if cls.write_behind:
+                cls.write_behind.discard(name)
+            cls._remove_stripes(name, result)
+            return result is not None
+        if result is None:
+            return None
+        if operation == "read":
+            return cls._counter_values([name], [result])[0] + cls.pending(name)
+        if operation == "increment" and stripe_count(result):
+            return cls._increment_striped(name, stripe_count(result), number, rollup=False)
+        return int(result)
+
+    @classmethod
+    def import_counters(cls, counters: list, overwrite: bool = False) -> list:
+        """Sets the values of many counters in a single pipeline
+
+        Arguments:
+            counters: a list of (name, value) tuples
+            overwrite: replace counters that exist instead of skipping them
+
+        Returns:
+            a list with True for every counter that was written and False
+            for every one that was skipped because it exists
+        """
+        operation = "set" if overwrite else "create"
+        try:
+            pipe = cls.redis.pipeline(transaction=False)
+            for name, value in counters:
+                cls.scripts[operation](
+                    keys=cls._keys(operation, name), args=cls._args(operation, name, value), client=pipe
+                )
+            results = pipe.execute()
+            written = []
+            for (name, _), result in zip(counters, results):
+                cls._forget(name)
+                if overwrite:
+                    if cls.write_behind:
+                        cls.write_behind.discard(name)
+                    cls._remove_stripes(name, result)
+                written.append(overwrite or result is not None)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return written
+
+    @classmethod
+    def find_many(cls, names: list) -> list:
+        """Finds many counters with one MGET, or one HMGET per bucket
+
+        Returns:
+            a list with a Counter or None for each name in the same order
+        """
+        try:
+            values = cls._counter_values(names, cls._read_many(names))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return [
+            None if value is None else cls._load(name, value + cls.pending(name))
+            for name, value in zip(names, values)
+        ]
+
+    ######################################################################
+    #  S T R I P E D   C O U N T E R S
+    ######################################################################
+
+    @classmethod
+    def _create_striped(cls, name: str, value: int, stripes: int):
+        """Creates a counter whose increments are spread over many keys
+
+        The marker is set first so that only one caller can create the
+        counter and then every stripe is set, the first to the value. The
+        change is published once the stripes hold the value.
+        """
+        try:
+            created = cls.scripts["create"](
+                keys=cls._keys("create", name),
+                args=script_args("create", name, f"{STRIPES_MARKER}{stripes}", buckets=cls.buckets),
+            )
+            if created:
+                cls._write_many(dict(zip(stripe_keys(name, stripes), [value] + [0] * (stripes - 1))))
+                cls._changed(name, value)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls._forget(name)
+        if not created:
+            return None
+        cls.stripe_counts[name] = stripes
+        return cls._load(name, value)
+
+    @classmethod
+    def _increment(cls, name: str, amount: int, rollup: bool = True):
+        """Increments a counter that exists and returns its new value
+
+        The stripes of counters that are known to be striped are incremented
+        directly and the others are learned from the marker that the script
+        returns. A stripe that is gone means that the counter was removed,
+        and maybe created again, so the name is tried once more. The rollups
+        are only added to once, unless rollup is False because the caller
+        already did.
+        """
+        stripes = cls.stripe_counts.get(name)
+        if stripes:
+            count = cls._increment_striped(name, stripes, amount, rollup)
+            if count is not None:
+                return count
+            cls.stripe_counts.pop(name, None)
+        count = cls._run_increment(name, amount, rollup)
+        if stripe_count(count):
+            cls.stripe_counts[name] = stripe_count(count)
+            return cls._increment_striped(name, stripe_count(count), amount, rollup=False)
+        return count
+
+    @classmethod
+    def _run_increment(cls, name: str, amount: int, rollup: bool = True):
+        """Runs the increment script and adds to the rollups in the same round trip"""
+        if not (rollup and cls.rates):
+            return cls.scripts["increment"](keys=cls._keys("increment", name), args=cls._args("increment", name, amount))
+        pipe = cls.redis.pipeline(transaction=False)
+        cls.scripts["increment"](keys=cls._keys("increment", name), args=cls._args("increment", name, amount), client=pipe)
+        cls._queue_rollups(pipe, name, amount)
+        return pipe.execute()[0]
+
+    @classmethod
+    def _increment_striped(cls, name: str, stripes: int, amount: int, rollup: bool = True):
+        """Increments one stripe and adds up all of them in one round trip"""
+        keys = stripe_keys(name, stripes)
+        stripe = keys[pick_stripe(stripes, cls.stripe_selection)]
+        pipe = cls.redis.pipeline(transaction=False)
+        cls.scripts["increment"](
+            keys=cls._keys("increment", stripe),
+            args=script_args("increment", stripe, amount, buckets=cls.buckets),
+            client=pipe,
+        )
+        queue_read(pipe, keys, cls.buckets)
+        if rollup:
+            cls._queue_rollups(pipe, name, amount)
+        results = pipe.execute()
+        count, values = results[0], read_results(keys, results[1:], cls.buckets)
+        if count is None:
+            return None
+        count = counter_values([f"{STRIPES_MARKER}{stripes}"], values)[0]
+        cls._changed(name, count)
+        return count
+
+    @classmethod
+    def _remove_stripes(cls, name: str, value):
+        """Removes the stripes of a counter that was deleted"""
+        cls.stripe_counts.pop(name, None)
+        stripes = stripe_count(value)
+        if stripes:
+            cls._delete_many(stripe_keys(name, stripes))
+
+    @classmethod
+    def _counter_values(cls, names: list, values: list) -> list:
+        """Converts values read from Redis adding up the stripes of striped counters"""
+        keys = striped_keys(names, values)
+        return counter_values(values, cls._read_many(keys))
+
+    @classmethod
+    def _changed(cls, name: str, value: int):
+        """Ranks, versions and publishes the new value of a counter that a script did not change
+
+        The stripes of a striped counter are changed one at a time so its
+        total is only known after they are read
+        """
+        cls.scripts["changed"](keys=cls._keys("changed", name), args=cls._args("changed", name, value))
+
+    ######################################################################
+    #  S T O R A G E   L A Y O U T
+    ######################################################################
+
+    @classmethod
+    def _keys(cls, operation: str, name: str) -> list:
+        """Returns the keys of the Lua script for an operation on a counter"""
+        return script_keys(operation, name, cls.buckets)
+
+    @classmethod
+    def _args(cls, operation: str, name: str, number: int = 0) -> list:
+        """Returns the arguments of the Lua script for an operation on a counter"""
+        return script_args(operation, name, number, cls.channel, cls.top_size, cls.buckets)
+
+    @classmethod
+    def _read(cls, name: str):
+        """Reads the raw value of one counter with the read script"""
+        return cls.scripts["read"](keys=cls._keys("read", name), args=cls._args("read", name))
+
+    @classmethod
+    def _read_many(cls, names: list, client=None) -> list:
+        """Reads the raw values of counters in one round trip
+
+        Arguments:
+            names: the names of the counters
+            client: the Redis node to read from or None for every shard
+        """
+        if not names:
+            return []
+        pipe = (client or cls.redis).pipeline(transaction=False)
+        queue_read(pipe, names, cls.buckets)
+        return read_results(names, pipe.execute(), cls.buckets)
+
+    @classmethod
+    def _write_many(cls, values: dict):
+        """Sets the raw values of counters with one MSET or one HSET per bucket"""
+        if not cls.buckets:
+            cls.redis.mset(values)
+            return
+        names = list(values)
+        pipe = cls.redis.pipeline(transaction=False)
+        for key, positions in group_by_bucket(names, cls.buckets).items():
+            pipe.hset(key, mapping={names[position]: values[names[position]] for position in positions})
+        pipe.execute()
+
+    @classmethod
+    def _delete_many(cls, names: list):
+        """Deletes counters with one DEL or one HDEL per bucket without a trace"""
+        if not cls.buckets:
+            cls.redis.delete(*names)
+            return
+        pipe = cls.redis.pipeline(transaction=False)
+        for key, positions in group_by_bucket(names, cls.buckets).items():
+            pipe.hdel(key, *[names[position] for position in positions])
+        pipe.execute()
+
+    ######################################################################
+    #  R A T E S
+    ######################################################################
+
+    @classmethod
+    def _queue_rollups(cls, pipe, name: str, amount: int):
+        """Queues adding an increment to the rollups of a counter when rates are kept"""
+        if cls.rates:
+            queue_rollups(pipe, name, amount, time.time())
+
+    @classmethod
+    def rate(cls, name: str, window: int) -> int:
+        """Returns the number of increments of a counter in the last window seconds
+
+        At most 60 rollups are added up, which are read with one MGET, so
+        the cost does not grow with the number of increments. See
+        service.common.rollups for how the window is rounded.
+        """
+        keys = window_keys(name, window, time.time())
+        try:
+            pipe = cls.redis.pipeline(transaction=False)
+            pipe.mget(keys)
+            values = pipe.execute()[0]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return sum(int(value or 0) for value in values)
+
+    ######################################################################
+    #  C H A N G E   N O T I F I C A T I O N S   A N D   C A C H I N G
+    ######################################################################
+
+    @classmethod
+    def subscribe(cls, handler, on_reset=None, channel: str = "counters:changes"):
+        """Calls handler(name, value) whenever any worker changes a counter
+
+        Every change is published on the pub/sub channel by the same script
+        that makes it and one subscription is shared by the whole process.
+        The value is None when the counter was deleted. The on_reset function
+        is called whenever changes could have been missed.
+        """
+        if cls.listener is None:
+            cls.channel = channel
+            cls.listener = ChangeListener(lambda: cls.redis, channel)
+            cls.listener.start()
+        cls.listener.add_handler(handler, on_reset)
+
+    @classmethod
+    def unsubscribe(cls, handler, on_reset=None):
+        """Stops calling a handler and stops listening when none are left"""
+        if cls.listener is None:
+            return
+        cls.listener.remove_handler(handler, on_reset)
+        if not cls.listener._handlers:
+            cls.listener.stop()
+            cls.listener = None
+            cls.channel = ""
+
+    @classmethod
+    def enable_cache(cls, max_size: int = 10000, ttl: float = 1.0, channel: str = "counters:changes"):
+        """Caches the values read by find() in this worker
+
+        The least recently used counters are evicted when there are more than
+        max_size of them and every value expires after ttl seconds. Entries are
+        invalidated when this or any other worker changes the counter.
+        """
+        cls.disable_cache()
+        cls.cache = LRUCache(max_size, ttl)
+        cls.subscribe(cls._invalidate, cls.cache.clear, channel)
+        logger.info("Caching up to %d counters for %ss", max_size, ttl)
+
+    @classmethod
+    def disable_cache(cls):
+        """Stops caching counter values"""
+        if cls.cache:
+            cls.unsubscribe(cls._invalidate, cls.cache.clear)
+            cls.cache = None
+
+    @classmethod
+    def enable_events(cls, channel: str = "counters:changes"):
+        """Passes the changes that this worker hears to Server-Sent Events streams
+
+        Every stream adds a subscription for its counters to the events hub,
+        which all of them share with the one pub/sub subscription of this
+        worker. See service.common.events.
+        """
+        cls.disable_events()
+        cls.events = EventHub()
+        cls.subscribe(cls.events.dispatch, cls.events.reset, channel)
+        logger.info("Streaming counter changes from %s", channel)
+
+    @classmethod
+    def disable_events(cls):
+        """Stops passing changes to Server-Sent Events streams"""
+        if cls.events is not None:
+            cls.unsubscribe(cls.events.dispatch, cls.events.reset)
+            cls.events = None
+
+    @classmethod
+    def _invalidate(cls, name: str, _value):
+        """Removes a counter that was changed from the cache"""
+        cls._forget(name)
+
+    @classmethod
+    def _forget(cls, name: str):
+        """Removes a counter from the cache if there is one"""
+        if cls.cache:
+            cls.cache.invalidate(name)
+
+    ######################################################################
+    #  C I R C U I T   B R E A K E R
+    ######################################################################
+
+    @classmethod
+    def enable_circuit_breaker(cls, **options):
+        """Fails the commands to a Redis node fast while it is down or too slow
+
+        Every shard gets a circuit breaker of its own, see
+        service.common.circuit_breaker.CircuitBreaker for the options
+        """
+        cls.breaker_options = options
+        cls._attach_breakers()
+        logger.info("Circuit breaker enabled with %s", options or "the default options")
+
+    @classmethod
+    def disable_circuit_breaker(cls):
+        """Sends every command to Redis again"""
+        cls.breaker_options = None
+        cls._attach_breakers()
+
+    @classmethod
+    def breakers(cls) -> list:
+        """Returns the circuit breaker of every shard, or an empty list"""
+        return [client.breaker for client in cls._node_clients() if client.breaker is not None]
+
+    @classmethod
+    def _node_clients(cls) -> list:
+        """Returns the client of every shard"""
+        if cls.redis is None:
+            return []
+        if isinstance(cls.redis, ShardedRedis):
+            return cls.redis.clients
+        return [cls.redis]
+
+    @classmethod
+    def _attach_breakers(cls):
+        """Gives the client of every shard a new circuit breaker, or takes it away"""
+        for client in cls._node_clients():
+            client.breaker = CircuitBreaker(**cls.breaker_options) if cls.breaker_options is not None else None
+
+    @classmethod
+    def enable_stale_reads(cls, max_size: int = 10000, max_age: float = 300.0):
+        """Serves the last value read by find() while Redis cannot be reached
+
+        Up to max_size counters are kept for max_age seconds after they were read
+        """
+        cls.last_known = LRUCache(max_size, max_age)
+        logger.info("Serving up to %d counters for %ss when Redis is down", max_size, max_age)
+
+    @classmethod
+    def disable_stale_reads(cls):
+        """Fails the reads while Redis cannot be reached again"""
+        cls.last_known = None
+
+    ######################################################################
+    #  W R I T E - B E H I N D   I N C R E M E N T S
+    ######################################################################
+
+    @classmethod
+    def enable_write_behind(cls, interval: float = 1.0, max_pending: int = 1000):
+        """Buffers increments in memory and writes them behind in batches
+
+        Increments of existing counters are added up per name and written
+        with one pipelined script call per name every ``interval`` seconds
+        or as soon as ``max_pending`` increments are buffered. A worker that
+        dies without running its exit handlers loses at most ``max_pending``
+        increments. See service.common.write_behind for the details.
+        """
+        cls.disable_write_behind()
+        cls.write_behind = WriteBehindBuffer(cls._flush_increments, interval, max_pending)
+        cls.write_behind.start()
+        logger.info("Write-behind enabled every %ss or %d increments", interval, max_pending)
+
+    @classmethod
+    def disable_write_behind(cls):
+        """Flushes the buffered increments and writes them directly again"""
+        if cls.write_behind:
+            cls.write_behind.stop()
+            cls.write_behind = None
+
+    @classmethod
+    def pending(cls, name: str) -> int:
+        """Returns the buffered increments of a counter not written yet"""
+        if cls.write_behind:
+            return cls.write_behind.pending(name)
+        return 0
+
+    @classmethod
+    def _buffer_increment(cls, name: str, amount: int):
+        """Buffers an increment and returns the estimated new value
+
+        The estimate is the value from the last flush or read plus the
+        increments this worker has buffered since then
+        """
+        count = cls.write_behind.value(name)
+        if count is None:
+            count = cls._counter_values([name], [cls._read(name)])[0]
+            if count is None:
+                return None
+            cls.write_behind.remember(name, count)
+        return count + cls.write_behind.add(name, amount)
+
+    @classmethod
+    def _flush_increments(cls, pending: dict) -> dict:
+        """Writes buffered increments in one pipeline skipping removed counters
+
+        Striped counters are incremented one at a time after the pipeline
+        """
+        names = [name for name in pending if name not in cls.stripe_counts]
+        pipe = cls.redis.pipeline(transaction=False)
+        for name in names:
+            cls.scripts["increment"](
+                keys=cls._keys("increment", name), args=cls._args("increment", name, pending[name]), client=pipe
+            )
+        for name in names:
+            cls._queue_rollups(pipe, name, pending[name])
+        counts = dict(zip(names, pipe.execute()))
+        for name, amount in pending.items():
+            if name not in counts or stripe_count(counts[name]):
+                counts[name] = cls._increment(name, amount, rollup=name not in counts)
+        return counts
 
     ######################################################################
     #  F I N D E R   M E T H O D S
@@ -83,31 +1075,150 @@ class Counter:
 
     @classmethod
     def all(cls):
-        """Returns all of the counters"""
+        """Returns all of the counters in the order of their names"""
+        return [counter for page in cls.pages() for counter in page]
+
+    @classmethod
+    def pages(cls, limit: int = 1000, prefix: str = ""):
+        """Yields all of the counters one page at a time
+
+        Only one page is read into memory at a time so that the counters
+        can be streamed however many of them there are
+        """
+        after = ""
+        while True:
+            after, page = cls.page(after, limit, prefix)
+            if page:
+                yield page
+            if not after:
+                break
+
+    @classmethod
+    def page(cls, after: str = "", limit: int = 1000, prefix: str = ""):
+        """Returns a page of counters and the name to start the next page after
+
+        The names are read from the index with ZRANGEBYLEX, which takes
+        O(log n + limit) on each shard, and their values with a single MGET
+        or one HMGET per bucket.
+        A page may hold fewer counters than the limit if some were removed
+        while it was read. A returned name of "" means there are no more pages.
+
+        Arguments:
+            after: the last name of the previous page or "" for the first page
+            limit: the number of counters in a page
+            prefix: only list the counters whose names start with it
+        """
         try:
-            counters = [
-                {"name": key, "counter": int(cls.redis.get(key))}
-                for key in cls.redis.keys("*")
-            ]
+            names = cls.redis.zrangebylex(INDEX_KEY, *lex_range(prefix, after), start=0, num=limit)
+            counters = cls._fetch_all(names)
         except Exception as err:
             raise DatabaseConnectionError(err) from err
-        return counters
+        return (names[-1] if len(names) == limit else ""), counters
 
     @classmethod
-    def find(cls, name):
-        """Finds a counter with the name or returns None"""
-        counter = None
+    def top(cls, k: int = 10) -> list:
+        """Returns the k highest counters from the highest down
+
+        The leaderboard of every shard is read with ZREVRANGE, which takes
+        O(log n + k), and the counters come with the values they were ranked
+        by. Each shard only ranks its top_size highest counters so k should
+        not be larger than top_size.
+        """
         try:
-            count = cls.redis.get(name)
-            if count:
-                counter = Counter(name, count)
+            ranked = cls.redis.zrevrange(TOP_KEY, 0, k - 1, withscores=True)
         except Exception as err:
             raise DatabaseConnectionError(err) from err
+        return [{"name": name, "counter": int(score)} for name, score in ranked]
+
+    @classmethod
+    def _fetch_all(cls, names: list) -> list:
+        """Fetches the values of the names with one MGET skipping missing ones"""
+        values = cls._counter_values(names, cls._read_many(names))
+        return [
+            {"name": name, "counter": value}
+            for name, value in zip(names, values)
+            if value is not None
+        ]
+
+    @classmethod
+    def find(cls, name):
+        """Finds a counter with the name and its version or returns None
+
+        When Redis cannot be reached and stale reads are enabled, the last
+        value that this worker read is returned with its age in seconds
+        """
+        found = cls.cache.get(name) if cls.cache else None
+        if found is None:
+            try:
+                found = cls._find(name)
+            except (RedisConnectionError, RedisTimeoutError) as err:
+                return cls._stale(name, err)
+            except Exception as err:
+                raise DatabaseConnectionError(err) from err
+            cls._remember(name, found)
+            if found is None:
+                return None
+        count, version = found
+        return cls._load(name, count + cls.pending(name), version)
+
+    @classmethod
+    def _remember(cls, name: str, found):
+        """Keeps what find() read in the caches that it serves from"""
+        if found is not None and cls.cache:
+            cls.cache.set(name, found)
+        if cls.last_known is None:
+            return
+        if found is None:
+            cls.last_known.invalidate(name)
+        else:
+            cls.last_known.set(name, (found, cls.last_known.clock()))
+
+    @classmethod
+    def _stale(cls, name: str, err: Exception):
+        """Returns the last known value of a counter with its age
+
+        Raises:
+            DatabaseConnectionError: the counter was not read while stale reads were enabled
+        """
+        remembered = None
+        if cls.last_known is not None:
+            remembered = cls.last_known.get(name)
+        if remembered is None:
+            raise DatabaseConnectionError(err) from err
+        (count, version), read_at = remembered
+        counter = cls._load(name, count + cls.pending(name), version)
+        counter.age = cls.last_known.clock() - read_at
         return counter
 
+    @classmethod
+    def _find(cls, name: str):
+        """Reads the value and version of a counter with one script or returns None"""
+        found = cls.scripts["find"](keys=cls._keys("find", name), args=cls._args("find", name))
+        if found is None:
+            return None
+        value, version = found
+        return cls._counter_values([name], [value])[0], version
+
+    @classmethod
+    def generation(cls) -> str:
+        """Returns a tag that changes whenever any counter is created, changed or removed
+
+        It is made of the generation of every shard, which are read with one
+        GET on each shard in parallel
+        """
+        try:
+            if isinstance(cls.redis, ShardedRedis):
+                generations = cls.redis.fan_out(lambda client: client.get(GENERATION_KEY))
+            else:
+                generations = [cls.redis.get(GENERATION_KEY)]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return ".".join(generation or "0" for generation in generations)
+
     @classmethod
     def remove_all(cls):
-        """Removes all of the keys in the database"""
+        """Removes all of the keys in every shard of the database"""
+        cls.stripe_counts.clear()
         try:
             cls.redis.flushall()
         except Exception as err:
@@ -130,11 +1241,28 @@ class Counter:
         return success
 
     @classmethod
-    def connect(cls, database_uri=None):
+    def register_scripts(cls):
+        """Registers the Lua scripts with the current connection
+
+        Scripts are sent with EVALSHA and only loaded into Redis the
+        first time that they are not found in its script cache
+        """
+        cls.scripts = {
+            name: cls.redis.register_script(script)
+            for name, script in LUA_SCRIPTS.items()
+        }
+
+    @classmethod
+    def connect(cls, database_uri=None, virtual_nodes=160, **pool_options):
         """Established database connection
 
         Arguments:
-            database_uri: a uri to the Redis database
+            database_uri: a uri to the Redis database, or a list or comma
+                separated string of uris to shard the counters across
+            virtual_nodes: the number of points of each shard on the hash ring
+            pool_options: max_connections, pool_timeout, socket_timeout,
+                socket_connect_timeout, socket_keepalive, health_check_interval
+                and any other option of service.common.connection_pool.create_pool
 
         Raises:
             DatabaseConnectionError: Could not connect
@@ -149,9 +1277,11 @@ class Counter:
 
         logger.info("Attempting to connecting to Redis...")
 
-        cls.redis = Redis.from_url(
-            database_uri, encoding="utf-8", decode_responses=True
-        )
+        cls.database_uri = split_uris(database_uri)
+        cls.virtual_nodes = virtual_nodes
+        cls.pool_options = pool_options
+        cls.redis = cls._make_client()
+        cls._attach_breakers()
 
         if not cls.test_connection():
             # if you end up here, redis instance is down.
@@ -159,5 +1289,178 @@ class Counter:
             logger.fatal("*** FATAL ERROR: Could not connect to the Redis Service")
             raise DatabaseConnectionError("Could not connect to the Redis Service")
 
+        cls.register_scripts()
         logger.info("Successfully connected to Redis")
         return cls.redis
+
+    @classmethod
+    def _make_client(cls):
+        """Makes a Redis client for the database or a sharded one for many
+
+        Each shard gets a connection pool of its own
+        """
+        clients = [
+            MeteredRedis(connection_pool=create_pool(database_uri, **cls.pool_options))
+            for database_uri in cls.database_uri
+        ]
+        if len(clients) == 1:
+            return clients[0]
+        logger.info("Sharding counters across %d Redis nodes", len(clients))
+        return ShardedRedis(clients, cls.database_uri, cls.virtual_nodes)
+
+    @classmethod
+    def rebalance(cls, dry_run: bool = False) -> dict:
+        """Moves every counter to the shard that owns it after shards were added
+
+        See service.common.sharding.ShardedRedis.rebalance(). The NODE_KEYS
+        of every shard are kept where they are, and the index and leaderboard
+        are brought up to date once the counters have moved
+        """
+        if not isinstance(cls.redis, ShardedRedis):
+            return {"scanned": 0, "moved": 0, "conflicts": 0}
+        try:
+            totals = cls.redis.rebalance(dry_run, keep=NODE_KEYS)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        if not dry_run:
+            cls.reindex()
+        return totals
+
+    @classmethod
+    def reindex(cls) -> dict:
+        """Brings the name index and leaderboard of every shard up to date
+
+        Every counter is added to the index and ranked on the leaderboard,
+        and the names of counters that are gone are removed from both. Run
+        this once on a database with counters that were created before the
+        index or the leaderboard existed.
+
+        Returns:
+            the number of names that were added to and removed from the index
+        """
+        clients = cls.redis.clients if isinstance(cls.redis, ShardedRedis) else [cls.redis]
+        totals = {"indexed": 0, "removed": 0}
+        try:
+            for client in clients:
+                indexed, removed = cls._reindex_node(client)
+                totals["indexed"] += indexed
+                totals["removed"] += removed
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return totals
+
+    @classmethod
+    def _reindex_node(cls, client, count: int = 1000) -> tuple:
+        """Indexes and ranks the counters of one shard a page of keys at a time"""
+        indexed = removed = 0
+        keys = iter(client.scan_iter(count=count))
+        while True:
+            page = list(itertools.islice(keys, count))
+            if not page:
+                break
+            counters = cls._node_counters(client, page)
+            if not counters:
+                continue
+            indexed += client.zadd(INDEX_KEY, dict.fromkeys(counters, 0))
+            if cls.top_size:
+                values = cls._counter_values(list(counters), list(counters.values()))
+                client.zadd(TOP_KEY, dict(zip(counters, values)))
+                client.zremrangebyrank(TOP_KEY, 0, -cls.top_size - 1)
+        for key in (INDEX_KEY, TOP_KEY):
+            stale = cls._stale_members(client, key, count)
+            for start in range(0, len(stale), count):
+                deleted = client.zrem(key, *stale[start:start + count])
+                if key == INDEX_KEY:
+                    removed += deleted
+        if indexed or removed:
+            # counters moved here or away so the listings of clients are out of date
+            client.incr(GENERATION_KEY)
+        return indexed, removed
+
+    @staticmethod
+    def _node_counters(client, keys: list) -> dict:
+        """Returns the counters in a page of keys of one shard by name
+
+        Counters are read from string keys and from every field of the
+        buckets, so that shards that are half migrated are indexed too
+        """
+        counters = {key: value for key, value in zip(keys, client.mget(keys)) if is_counter(key, value)}
+        for key in filter(is_bucket_key, keys):
+            counters.update((name, value) for name, value in client.hgetall(key).items() if is_counter(name, value))
+        return counters
+
+    @classmethod
+    def _stale_members(cls, client, key: str, count: int = 1000) -> list:
+        """Returns the names in a sorted set of one shard whose counters are gone"""
+        stale = []
+        members = iter(client.zscan_iter(key, count=count))
+        while True:
+            page = [name for name, _ in itertools.islice(members, count)]
+            if not page:
+                return stale
+            stale.extend(name for name, value in zip(page, cls._read_many(page, client)) if value is None)
+
+    @classmethod
+    def migrate_to_buckets(cls) -> dict:
+        """Moves the counters kept in keys of their own into their buckets
+
+        Every string key that holds a counter or a stripe is copied into its
+        bucket with HSETNX and then deleted while it is watched, so that an
+        increment during the move is never lost. Keys that hold anything else
+        are left alone. A counter that is already in its bucket is a conflict
+        and its key is left alone. The index and the leaderboard are brought
+        up to date afterwards.
+
+        Returns:
+            the number of keys scanned, moved to buckets and in conflict
+        """
+        totals = {"scanned": 0, "moved": 0, "conflicts": 0}
+        if not cls.buckets:
+            return totals
+        clients = cls.redis.clients if isinstance(cls.redis, ShardedRedis) else [cls.redis]
+        try:
+            for client in clients:
+                for key in client.scan_iter(count=1000):
+                    if is_bucket_key(key) or is_rollup_key(key) or is_sketch_key(key) or key in NODE_KEYS:
+                        continue
+                    if client.type(key) != "string" or not is_counter_key(key, client.get(key)):
+                        continue
+                    totals["scanned"] += 1
+                    bucket = bucket_key(key, cls.buckets)
+                    target = cls.redis.client_for(bucket) if isinstance(cls.redis, ShardedRedis) else cls.redis
+                    if move_to_bucket(client, target, key, bucket):
+                        totals["moved"] += 1
+                    else:
+                        totals["conflicts"] += 1
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls.reindex()
+        return totals
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        """Returns the utilization of the connection pools of this worker
+
+        The statistics of every shard are added up
+        """
+        if cls.redis is None:
+            return {}
+        if isinstance(cls.redis, ShardedRedis):
+            return cls.redis.pool_stats()
+        return cls.redis.connection_pool.stats()
+
+    @classmethod
+    def _after_fork(cls):
+        """Gives a forked worker a connection pool of its own
+
+        Connections that were opened before the fork are shared with the
+        parent process so the child never uses them and opens its own
+        """
+        if cls.redis is not None:
+            cls.redis = cls._make_client()
+            cls._attach_breakers()
+            cls.register_scripts()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Counter._after_fork)
@@ -19,10 +19,42 @@ Counter Service
 
 This service keeps track of named counters
 """
-from flask import jsonify, abort, url_for
+import hmac
+import json
+import itertools
+from functools import partial
+from flask import Response, g, jsonify, abort, request, url_for
 from flask import current_app as app
+from werkzeug.exceptions import ServiceUnavailable
 from service.common import status  # HTTP Status Codes
-from service.models import Counter
+from service.common.admission import route_class
+from service.common.helpers import (
+    parse_int,
+    parse_items,
+    parse_item_counts,
+    parse_sources,
+    plan_batch,
+    finish_batch,
+    EXPORT_FORMATS,
+    export_header,
+    export_chunk,
+    ImportParser,
+    ImportReport,
+)
+from service.common.json_provider import JsonTemplate
+from service.common.events import Subscription, KEEPALIVE, format_events, resync_names
+from service.common.metrics import start_request, record_request, generate_metrics
+from service.common.tracing import start_trace, stop_trace
+from service.common.rollups import parse_window
+from service.common.sketches import sketch_dimensions
+from service.models import Counter, DatabaseConnectionError
+from service.sketch_models import UniqueCounter, FrequencySketch
+
+# the index document with everything but its link encoded once
+INDEX = JsonTemplate({"name": "Counter Service REST API", "version": "1.0"}, "paths")
+
+# bytes of an import body that are read and parsed at a time
+IMPORT_CHUNK_SIZE = 64 * 1024
 
 
 ######################################################################
@@ -32,15 +64,128 @@ from service.models import Counter
 def index():
     """Root URL response"""
     app.logger.info("Request for Root URL")
-    return (
-        jsonify(
-            name="Counter Service REST API",
-            version="1.0",
-            paths=url_for("list_counters", _external=True),
-        ),
-        status.HTTP_200_OK,
+    return Response(
+        INDEX.render(paths=url_for("list_counters", _external=True)),
+        status=status.HTTP_200_OK,
+        mimetype="application/json",
     )
 
+
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Returns the metrics of every worker in the Prometheus text format"""
+    data, content_type = generate_metrics()
+    return Response(data, status=status.HTTP_200_OK, content_type=content_type)
+
+
+@app.before_request
+def start_timer():
+    """Notes when a request started and starts tracing and profiling it"""
+    g.request_start = start_request()
+    if app.config["REDIS_TRACING"]:
+        start_trace()
+    profiler = app.extensions.get("profiler")
+    if profiler is not None and (profiler.should_profile() or is_admin("X-Profile")):
+        g.profile = profiler.begin()
+
+
+@app.before_request
+def admit_request():
+    """Turns a request away when its route class is at its limit in this worker"""
+    admission = app.extensions.get("admission")
+    if admission is None:
+        return
+    name = route_class(request.endpoint, request.method)
+    if not admission.admit(name):
+        raise ServiceUnavailable(
+            f"Too many {name} requests, please retry later", retry_after=app.config["ADMISSION_RETRY_AFTER"]
+        )
+    g.route_class = name
+
+
+@app.teardown_request
+def release_request(_error):
+    """Lets the next request of the route class in"""
+    name = g.pop("route_class", None)
+    if name is not None:
+        app.extensions["admission"].release(name)
+
+
+def release_on_close(response):
+    """Keeps the admission slot of a request until its streamed response is closed
+
+    The request is torn down as soon as the view returns, before a
+    streamed response sends anything, so the slot is released when the
+    server closes the response instead.
+    """
+    name = g.pop("route_class", None)
+    if name is not None:
+        response.call_on_close(partial(app.extensions["admission"].release, name))
+    return response
+
+
+@app.teardown_request
+def stop_profile(_error):
+    """Adds the profile of a profiled request to those of the worker"""
+    profile = g.pop("profile", None)
+    if profile is not None:
+        app.extensions["profiler"].end(profile)
+
+
+@app.after_request
+def count_request(response):
+    """Counts every request by route and status, errors included"""
+    if "request_start" in g:
+        rule = request.url_rule.rule if request.url_rule else None
+        record_request(request.method, rule, response.status_code, g.request_start)
+    return response
+
+
+@app.after_request
+def send_trace(response):
+    """Sends the Redis round trips of a traced request in a Server-Timing header"""
+    trace = stop_trace()
+    if trace is not None:
+        response.headers.add("Server-Timing", trace.server_timing())
+        if app.config["REDIS_TRACE_LOG"]:
+            app.logger.info("Redis trace of %s %s: %s", request.method, request.path, json.dumps(trace.serialize()))
+    return response
+
+
+######################################################################
+# PROFILING
+######################################################################
+@app.route("/admin/profiling", methods=["GET"])
+def read_profiling():
+    """Returns the settings of the profiler of this worker"""
+    profiler = get_profiler()
+    return jsonify(profiler.status()), status.HTTP_200_OK
+
+
+@app.route("/admin/profiling", methods=["PUT"])
+def update_profiling():
+    """Changes the share of requests that every worker profiles
+
+    The body is like {"rate": 0.01}
+    """
+    profiler = get_profiler()
+    check_content_type("application/json")
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or "rate" not in data or isinstance(data["rate"], bool):
+        error(status.HTTP_400_BAD_REQUEST, "The body must be like {\"rate\": 0.01}")
+    try:
+        profiler.set_rate(data["rate"])
+    except (TypeError, ValueError) as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+    except Exception as err:
+        raise DatabaseConnectionError(err) from err
+    app.logger.info("Profiling %s of the requests", profiler.rate)
+    return jsonify(profiler.status()), status.HTTP_200_OK
+
+
 ############################################################
 #           R E S T   A P I   M E T H O D S
 ############################################################
@@ -51,13 +196,341 @@ def index():
 ############################################################
 @app.route("/counters", methods=["GET"])
 def list_counters():
-    """List counters"""
+    """List counters
+
+    The counters are returned one page at a time in the order of their
+    names. Pass ``prefix`` to only list the counters whose names start
+    with it, the ``after`` name from the ``Link`` header of the previous
+    page to get the next one and ``limit`` to change the size of the page.
+
+    The ETag changes whenever any counter does, so a client that sends it
+    back in If-None-Match gets 304_NOT_MODIFIED for an unchanged listing
+    after one Redis call instead of the whole page.
+    """
     app.logger.info("Request to list all counters...")
 
-    counters = Counter.all()
+    prefix = request.args.get("prefix", "")
+    after = request.args.get("after", "")
+    limit = get_int_arg(
+        "limit", app.config["COUNTERS_PAGE_SIZE"], 1, app.config["COUNTERS_MAX_PAGE_SIZE"]
+    )
+
+    etag = Counter.generation()
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    after, counters = Counter.page(after, limit, prefix)
+
+    headers = {"ETag": f'"{etag}"'}
+    if after:
+        args = {"prefix": prefix} if prefix else {}
+        next_url = url_for("list_counters", after=after, limit=limit, _external=True, **args)
+        headers["Link"] = f'<{next_url}>; rel="next"'
 
     app.logger.info("Returning %d counters...", len(counters))
-    return jsonify(counters)
+    return jsonify(counters), status.HTTP_200_OK, headers
+
+
+############################################################
+# Top counters
+############################################################
+@app.route("/counters/_top", methods=["GET"])
+def top_counters():
+    """List the k highest counters from the highest down
+
+    The counters are read from a leaderboard that every increment
+    updates, so this costs O(log n + k) however many counters there are.
+    ``k`` can be at most the ``COUNTERS_TOP_SIZE`` that is ranked.
+    """
+    app.logger.info("Request to list the top counters...")
+    k = get_int_arg("k", 10, 1, max(app.config["COUNTERS_TOP_SIZE"], 1))
+
+    counters = Counter.top(k)
+
+    app.logger.info("Returning %d counters...", len(counters))
+    return jsonify(counters), status.HTTP_200_OK
+
+
+############################################################
+# Export counters
+############################################################
+@app.route("/counters/_export", methods=["GET"])
+def export_counters():
+    """Stream every counter as NDJSON or CSV
+
+    The counters are read from the name index one page at a time and
+    every page is sent as soon as it is read, so a worker only ever
+    holds one page. Pass ``prefix`` to only export some of the counters.
+    The export keeps its admission slot until the last page is sent.
+    """
+    app.logger.info("Request to export all counters...")
+
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        error(status.HTTP_400_BAD_REQUEST, f"Invalid value for 'format': {export_format}")
+    limit = get_int_arg(
+        "limit", app.config["COUNTERS_PAGE_SIZE"], 1, app.config["COUNTERS_MAX_PAGE_SIZE"]
+    )
+
+    # the first page is read before the response starts so that a
+    # database that is down is still reported with a 503
+    pages = Counter.pages(limit, request.args.get("prefix", ""))
+    first = next(pages, [])
+
+    def generate():
+        yield export_header(export_format)
+        for page in itertools.chain([first], pages):
+            yield export_chunk(page, export_format)
+
+    return release_on_close(
+        app.response_class(
+            generate(),
+            mimetype=EXPORT_FORMATS[export_format],
+            headers={"Content-Disposition": f"attachment; filename=counters.{export_format}"},
+        )
+    )
+
+
+############################################################
+# Import counters
+############################################################
+@app.route("/counters/_import", methods=["POST"])
+def import_counters():
+    """Load counters from a streamed body of NDJSON or CSV
+
+    The body is read and parsed one chunk at a time and the counters
+    are written in pipelined batches of ``batch_size``. With
+    ``mode=skip`` counters that exist are left alone and with
+    ``mode=overwrite`` they are replaced. The response reports how many
+    counters were imported, the lines that failed and the throughput.
+    """
+    app.logger.info("Request to import counters...")
+    import_format, overwrite, parser = start_import()
+
+    while True:
+        chunk = request.stream.read(IMPORT_CHUNK_SIZE)
+        batches = parser.feed(chunk) if chunk else parser.close()
+        for batch in batches:
+            parser.report.add(Counter.import_counters(batch, overwrite))
+        if not chunk:
+            break
+
+    report = parser.report.serialize()
+    app.logger.info(
+        "Imported %d counters from %s at %.1f counters/second",
+        report["imported"], import_format, report["counters_per_second"],
+    )
+    return jsonify(report), status.HTTP_200_OK
+
+
+############################################################
+# Batch counters
+############################################################
+@app.route("/counters/_batch", methods=["POST"])
+def batch_counters():
+    """Run many counter operations in one request
+
+    The body is a list of operations like:
+
+        [{"op": "create", "name": "foo", "value": 0},
+         {"op": "increment", "name": "foo", "amount": 5},
+         {"op": "read", "name": "foo"},
+         {"op": "delete", "name": "foo"}]
+
+    All of the valid operations run in a single Redis pipeline and a
+    list with the status and result of each operation is returned
+    """
+    app.logger.info("Request to run a batch of counter operations...")
+    check_content_type("application/json")
+
+    try:
+        results, operations = plan_batch(request.get_json(), app.config["BATCH_MAX_OPERATIONS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    values = Counter.batch([operation for _, operation in operations])
+    finish_batch(results, operations, values)
+
+    app.logger.info("Ran %d of %d batch operations", len(operations), len(results))
+    return jsonify(results), status.HTTP_200_OK
+
+
+############################################################
+# Stream the changes of many counters
+############################################################
+@app.route("/counters/_events", methods=["GET"])
+def stream_counters():
+    """Stream the values of many counters whenever they change
+
+    Pass a ``name`` parameter for every counter to watch. See
+    stream_counter() for the events.
+    """
+    names = request.args.getlist("name")
+    app.logger.info("Request to stream %d counters...", len(names))
+    if not 0 < len(names) <= app.config["EVENTS_MAX_COUNTERS"]:
+        error(status.HTTP_400_BAD_REQUEST, f"Pass 1 to {app.config['EVENTS_MAX_COUNTERS']} 'name' parameters")
+
+    return stream_events(names)
+
+
+############################################################
+# Add items to a unique counter
+############################################################
+@app.route("/counters/_unique/<name>", methods=["POST"])
+def add_unique_items(name):
+    """Add items to a unique counter, which is created if it does not exist
+
+    The body is ``{"items": ["a", "b"]}``. A unique counter takes at most
+    12 KB however many distinct items it sees and its estimate has a
+    standard error of 0.81%.
+    """
+    app.logger.info("Request to add items to unique counter: '%s'...", name)
+    check_content_type("application/json")
+    try:
+        items = parse_items(request.get_json(), app.config["SKETCH_MAX_ITEMS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    counter = UniqueCounter.add(name, items)
+
+    app.logger.info("Unique counter '%s' estimates %d items", name, counter.estimate)
+    return jsonify(counter.serialize()), status.HTTP_200_OK
+
+
+############################################################
+# Merge unique counters
+############################################################
+@app.route("/counters/_unique/<name>/_merge", methods=["POST"])
+def merge_unique_counters(name):
+    """Add every item of other unique counters to a unique counter
+
+    The body is ``{"sources": ["a", "b"]}``
+    """
+    app.logger.info("Request to merge into unique counter: '%s'...", name)
+    check_content_type("application/json")
+    try:
+        sources = parse_sources(request.get_json(), app.config["SKETCH_MAX_ITEMS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    counter = UniqueCounter.merge(name, sources)
+    if counter is None:
+        error(status.HTTP_404_NOT_FOUND, f"Unique counters {', '.join(sources)} must all exist")
+
+    app.logger.info("Unique counter '%s' estimates %d items", name, counter.estimate)
+    return jsonify(counter.serialize()), status.HTTP_200_OK
+
+
+############################################################
+# Read a unique counter
+############################################################
+@app.route("/counters/_unique/<name>", methods=["GET"])
+def read_unique_counter(name):
+    """Read the estimated number of distinct items of a unique counter"""
+    app.logger.info("Request to Read unique counter: '%s'...", name)
+
+    counter = UniqueCounter.find(name)
+    if not counter:
+        error(status.HTTP_404_NOT_FOUND, f"Unique counter '{name}' does not exist")
+
+    return jsonify(counter.serialize())
+
+
+############################################################
+# Delete a unique counter
+############################################################
+@app.route("/counters/_unique/<name>", methods=["DELETE"])
+def delete_unique_counter(name):
+    """Delete a unique counter"""
+    app.logger.info("Request to Delete unique counter: '%s'...", name)
+
+    if UniqueCounter.remove(name):
+        app.logger.info("Unique counter '%s' deleted", name)
+
+    return "", status.HTTP_204_NO_CONTENT
+
+
+############################################################
+# Create a frequency sketch
+############################################################
+@app.route("/counters/_frequency/<name>", methods=["POST"])
+def create_frequency_sketch(name):
+    """Create a frequency sketch
+
+    ``error`` and ``confidence`` set how far an estimate may be too high
+    as a fraction of the total of all counts and how likely it is to be
+    within that. They fix the size of the sketch, which never grows.
+    """
+    app.logger.info("Request to Create frequency sketch: '%s'...", name)
+    width, depth = get_sketch_args()
+
+    sketch = FrequencySketch.create(name, width, depth)
+    if sketch is None:
+        error(status.HTTP_409_CONFLICT, f"Frequency sketch '{name}' already exists")
+
+    location_url = url_for("read_frequency_sketch", name=name, _external=True)
+    app.logger.info("Frequency sketch '%s' created with %d x %d counters", name, depth, width)
+    return (
+        jsonify(sketch.serialize()),
+        status.HTTP_201_CREATED,
+        {"Location": location_url},
+    )
+
+
+############################################################
+# Add items to a frequency sketch
+############################################################
+@app.route("/counters/_frequency/<name>", methods=["PUT"])
+def add_frequency_items(name):
+    """Add counts of items to a frequency sketch
+
+    The body is ``{"items": {"a": 3, "b": 1}}`` or ``{"items": ["a", "a",
+    "b"]}`` and the new estimates of the items are returned
+    """
+    app.logger.info("Request to add items to frequency sketch: '%s'...", name)
+    check_content_type("application/json")
+    try:
+        items = parse_item_counts(request.get_json(), app.config["SKETCH_MAX_ITEMS"])
+    except ValueError as err:
+        error(status.HTTP_400_BAD_REQUEST, str(err))
+
+    sketch = FrequencySketch.add(name, items)
+    if sketch is None:
+        error(status.HTTP_404_NOT_FOUND, f"Frequency sketch '{name}' does not exist")
+
+    app.logger.info("Added %d items to frequency sketch '%s'", len(items), name)
+    return jsonify(sketch.serialize())
+
+
+############################################################
+# Read a frequency sketch
+############################################################
+@app.route("/counters/_frequency/<name>", methods=["GET"])
+def read_frequency_sketch(name):
+    """Read a frequency sketch and the estimates of the ``item`` parameters"""
+    app.logger.info("Request to Read frequency sketch: '%s'...", name)
+    items = request.args.getlist("item")[:app.config["SKETCH_MAX_ITEMS"]]
+
+    sketch = FrequencySketch.find(name, items)
+    if not sketch:
+        error(status.HTTP_404_NOT_FOUND, f"Frequency sketch '{name}' does not exist")
+
+    return jsonify(sketch.serialize())
+
+
+############################################################
+# Delete a frequency sketch
+############################################################
+@app.route("/counters/_frequency/<name>", methods=["DELETE"])
+def delete_frequency_sketch(name):
+    """Delete a frequency sketch"""
+    app.logger.info("Request to Delete frequency sketch: '%s'...", name)
+
+    if FrequencySketch.remove(name):
+        app.logger.info("Frequency sketch '%s' deleted", name)
+
+    return "", status.HTTP_204_NO_CONTENT
 
 
 ############################################################
@@ -65,7 +538,12 @@ def list_counters():
 ############################################################
 @app.route("/counters/<name>", methods=["GET"])
 def read_counters(name):
-    """Read a counter"""
+    """Read a counter
+
+    The ETag is the version of the counter, so a client that sends it back
+    in If-None-Match gets 304_NOT_MODIFIED while the counter is unchanged.
+    A value served while Redis is down says how old it is in Age and Warning
+    """
     app.logger.info("Request to Read counter: '%s'...", name)
 
     counter = Counter.find(name)
@@ -73,8 +551,59 @@ def read_counters(name):
     if not counter:
         error(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
 
-    app.logger.info("Returning: %d...", counter.value)
-    return jsonify(counter.serialize())
+    cached = not_modified(counter.etag)
+    if cached:
+        return cached
+
+    data = counter.serialize()
+    app.logger.info("Returning: %d...", data["counter"])
+    headers = {"ETag": f'"{counter.etag}"'}
+    if counter.age is not None:
+        headers["Age"] = str(int(counter.age))
+        headers["Warning"] = '110 - "Response is Stale"'
+    return jsonify(data), status.HTTP_200_OK, headers
+
+
+############################################################
+# Read the rate of a counter
+############################################################
+@app.route("/counters/<name>/rate", methods=["GET"])
+def read_rate(name):
+    """Read how many times a counter was incremented in a window of time
+
+    ``window`` is a number of seconds or a length like ``30s``, ``5m``,
+    ``1h`` or ``1d`` of at most a day. The increments are added up from
+    at most 60 rollups, so this costs the same however busy the counter is.
+    """
+    app.logger.info("Request for the rate of counter: '%s'...", name)
+
+    if not Counter.rates:
+        error(status.HTTP_501_NOT_IMPLEMENTED, "Rates are not kept, set RATES_ENABLED to keep them")
+    window = get_window_arg()
+    if not Counter.find(name):
+        error(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    count = Counter.rate(name, window)
+    app.logger.info("Counter '%s' was incremented %d times in %ds", name, count, window)
+    return jsonify(name=name, window=window, count=count, per_second=round(count / window, 3))
+
+
+############################################################
+# Stream the changes of a counter
+############################################################
+@app.route("/counters/<name>/events", methods=["GET"])
+def stream_counter(name):
+    """Stream the value of a counter whenever it changes
+
+    The response is a ``text/event-stream`` of Server-Sent Events that
+    starts with the current value and then sends an event whenever the
+    counter is changed or deleted, when its value is null. Changes are
+    gathered for ``EVENTS_WINDOW`` seconds, so a hot counter only sends
+    its latest value once per window.
+    """
+    app.logger.info("Request to stream counter: '%s'...", name)
+
+    return stream_events([name], must_exist=True)
 
 
 ############################################################
@@ -82,15 +611,18 @@ def read_counters(name):
 ############################################################
 @app.route("/counters/<name>", methods=["POST"])
 def create_counters(name):
-    """Create a counter"""
+    """Create a counter
+
+    A stripes query parameter greater than 1 spreads the increments of a
+    hot counter over that many keys
+    """
     app.logger.info("Request to Create counter: '%s'...", name)
 
-    counter = Counter.find(name)
-    if counter is not None:
+    stripes = get_int_arg("stripes", 1, 1, app.config["COUNTERS_MAX_STRIPES"])
+    counter = Counter.create(name, stripes=stripes)
+    if counter is None:
         error(status.HTTP_409_CONFLICT, f"Counter '{name}' already exists")
 
-    counter = Counter(name)
-
     location_url = url_for("read_counters", name=name, _external=True)
     app.logger.info("Counter '%s' created", name)
     return (
@@ -108,12 +640,10 @@ def update_counters(name):
     """Update a counter"""
     app.logger.info("Request to Update counter: '%s'...", name)
 
-    counter = Counter.find(name)
-    if counter is None:
+    count = Counter.increment_existing(name)
+    if count is None:
         error(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
 
-    count = counter.increment()
-
     app.logger.info("Counter '%s' updated to %d", name, count)
     return jsonify(name=name, counter=count)
 
@@ -126,9 +656,7 @@ def delete_counters(name):
     """Delete a counter"""
     app.logger.info("Request to Delete counter: '%s'...", name)
 
-    counter = Counter.find(name)
-    if counter:
-        del counter.value
+    if Counter.remove(name):
         app.logger.info("Counter '%s' deleted", name)
 
     return "", status.HTTP_204_NO_CONTENT
@@ -143,3 +671,138 @@ def error(status_code, reason):
     """Logs the error and then aborts"""
     app.logger.error(reason)
     abort(status_code, reason)
+
+
+def not_modified(etag: str):
+    """Returns 304_NOT_MODIFIED if the client already has the entity with the tag or None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def get_int_arg(name, default, minimum=0, maximum=None):
+    """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+    try:
+        return parse_int(request.args.get(name, default), name, minimum, maximum)
+    except ValueError as err:
+        return error(status.HTTP_400_BAD_REQUEST, str(err))
+
+
+def get_window_arg():
+    """Returns the window query parameter in seconds or aborts with 400_BAD_REQUEST"""
+    try:
+        return parse_window(request.args.get("window", "1m"))
+    except ValueError as err:
+        return error(status.HTTP_400_BAD_REQUEST, str(err))
+
+
+def get_sketch_args():
+    """Returns the width and depth of a sketch with the error and confidence parameters or aborts"""
+    try:
+        return sketch_dimensions(
+            request.args.get("error", app.config["SKETCH_ERROR"]),
+            request.args.get("confidence", app.config["SKETCH_CONFIDENCE"]),
+        )
+    except ValueError as err:
+        return error(status.HTTP_400_BAD_REQUEST, str(err))
+
+
+def read_values(names: list) -> dict:
+    """Returns the values of counters by name with None for the missing ones"""
+    counters = Counter.find_many(names)
+    return {name: counter.serialize()["counter"] if counter else None for name, counter in zip(names, counters)}
+
+
+def stream_events(names: list, must_exist: bool = False):
+    """Returns a response that streams the values of counters whenever they change
+
+    The subscription is added before the counters are read so that no
+    change is missed, and removed when the client goes away. Every open
+    stream holds a thread of the worker, so a worker that already streams
+    EVENTS_MAX_STREAMS times turns the stream away.
+    """
+    hub = Counter.events
+    if hub is None:
+        error(status.HTTP_501_NOT_IMPLEMENTED, "Events are not streamed, set EVENTS_ENABLED to stream them")
+    subscription = Subscription(names, app.config["EVENTS_WINDOW"])
+    if not hub.add(subscription, app.config["EVENTS_MAX_STREAMS"]):
+        raise ServiceUnavailable(
+            "Too many open event streams, please retry later", retry_after=app.config["EVENTS_RETRY_AFTER"]
+        )
+    try:
+        first = read_values(names)
+    except DatabaseConnectionError:
+        hub.remove(subscription)
+        raise
+    if must_exist and first[names[0]] is None:
+        hub.remove(subscription)
+        error(status.HTTP_404_NOT_FOUND, f"Counter '{names[0]}' does not exist")
+    keepalive = app.config["EVENTS_KEEPALIVE"]
+
+    def generate():
+        try:
+            yield format_events(first)
+            while True:
+                changes = subscription.get(keepalive)
+                changes.update(read_values(resync_names(changes)))
+                yield format_events(changes) if changes else KEEPALIVE
+        finally:
+            hub.remove(subscription)
+
+    return app.response_class(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def start_import():
+    """Returns the format, mode and parser of an import or aborts"""
+    formats = {mimetype: name for name, mimetype in EXPORT_FORMATS.items()}
+    if request.mimetype not in formats:
+        error(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            f"Content-Type must be one of {', '.join(formats)}",
+        )
+    mode = request.args.get("mode", "skip")
+    if mode not in ("skip", "overwrite"):
+        error(status.HTTP_400_BAD_REQUEST, f"Invalid value for 'mode': {mode}")
+    batch_size = get_int_arg(
+        "batch_size", app.config["IMPORT_BATCH_SIZE"], 1, app.config["IMPORT_MAX_BATCH_SIZE"]
+    )
+    report = ImportReport(app.config["IMPORT_MAX_ERRORS"])
+    import_format = formats[request.mimetype]
+    return import_format, mode == "overwrite", ImportParser(import_format, batch_size, report)
+
+
+def is_admin(header: str = "Authorization") -> bool:
+    """Returns True if a request header holds the admin token
+
+    The Authorization header holds it as a bearer token
+    """
+    token = app.config["PROFILE_TOKEN"]
+    value = request.headers.get(header, "")
+    if header == "Authorization":
+        value = value.removeprefix("Bearer ")
+    return bool(token) and hmac.compare_digest(value.encode(), token.encode())
+
+
+def get_profiler():
+    """Returns the profiler of this worker for an admin request"""
+    profiler = app.extensions.get("profiler")
+    if profiler is None:
+        error(status.HTTP_501_NOT_IMPLEMENTED, "Profiling is not enabled")
+    if not is_admin():
+        error(status.HTTP_401_UNAUTHORIZED, "The admin token is missing or wrong")
+    return profiler
+
+
+def check_content_type(content_type):
+    """Checks that the media type is correct"""
+    if request.mimetype != content_type:
+        error(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            f"Content-Type must be {content_type}",
+        )
@@ -0,0 +1,393 @@
+######################################################################
+# Copyright 2016, 2024 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Probabilistic Counter Models
+
+Counters that estimate instead of counting exactly so that they take the
+same memory however many items they see. A UniqueCounter estimates how
+many distinct items were added to it and a FrequencySketch estimates how
+often each item was added. Both share the Redis connection and the Lua
+scripts of service.models.Counter, and their asynchronous twins those of
+service.async_models.AsyncCounter. See service.common.sketches for how
+they are stored.
+"""
+# pylint: disable=duplicate-code
+import math
+import uuid
+from service.common.sharding import ShardedBase
+from service.common.sketches import (
+    unique_key,
+    sketch_key,
+    sketch_bounds,
+    unique_error,
+    add_args,
+    read_args,
+    chunks,
+)
+from service.models import Counter, DatabaseConnectionError
+from service.async_models import AsyncCounter
+
+# milliseconds that the copy of a unique counter from another shard lives for a merge
+MERGE_COPY_TTL = 60000
+
+
+def merge_copy_key(key: str) -> str:
+    """Returns a key of its own for a copy that one merge into a unique counter makes
+
+    Concurrent merges into the same counter must never share copies, or
+    one could overwrite or delete the copy of the other before its PFMERGE
+    """
+    return f"{key}/merge/{uuid.uuid4().hex}"
+
+
+def node_client(client, key: str):
+    """Returns the client of the node that owns a key, which is the client itself without shards"""
+    return client.client_for(key) if isinstance(client, ShardedBase) else client
+
+
+######################################################################
+#  U N I Q U E   C O U N T E R S
+######################################################################
+
+
+class UniqueCounter:
+    """Estimates the number of distinct items added to it with a HyperLogLog"""
+
+    def __init__(self, name: str, estimate: int):
+        """Constructor"""
+        self.name = name
+        self.estimate = int(estimate)
+
+    def serialize(self):
+        """Converts a unique counter into a dictionary with its standard error"""
+        return {"name": self.name, "type": "unique", "estimate": self.estimate, "error": unique_error(self.estimate)}
+
+    @classmethod
+    def add(cls, name: str, items: list) -> "UniqueCounter":
+        """Adds items to a unique counter, which is created if it does not exist"""
+        key = unique_key(name)
+        try:
+            pipe = node_client(Counter.redis, key).pipeline(transaction=False)
+            pipe.pfadd(key, *items)
+            pipe.pfcount(key)
+            estimate = pipe.execute()[1]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, estimate)
+
+    @classmethod
+    def find(cls, name: str):
+        """Finds a unique counter with the name or returns None"""
+        key = unique_key(name)
+        try:
+            pipe = node_client(Counter.redis, key).pipeline(transaction=False)
+            pipe.exists(key)
+            pipe.pfcount(key)
+            exists, estimate = pipe.execute()
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, estimate) if exists else None
+
+    @classmethod
+    def merge(cls, name: str, sources: list):
+        """Adds every item of other unique counters to a unique counter
+
+        The counter is created if it does not exist. Sources on other shards
+        are copied to its shard with DUMP and RESTORE for the PFMERGE.
+
+        Returns:
+            the UniqueCounter or None if one of the sources does not exist
+        """
+        key = unique_key(name)
+        keys = [unique_key(source) for source in sources]
+        target = node_client(Counter.redis, key)
+        copies = []
+        try:
+            if Counter.redis.exists(*keys) < len(set(keys)):
+                return None
+            local = [source for source in keys if node_client(Counter.redis, source) is target]
+            for source in set(keys).difference(local):
+                copy = merge_copy_key(key)
+                data = node_client(Counter.redis, source).dump(source)
+                if data is not None:
+                    target.restore(copy, MERGE_COPY_TTL, data)
+                    copies.append(copy)
+            pipe = target.pipeline(transaction=False)
+            pipe.pfmerge(key, *local, *copies)
+            pipe.pfcount(key)
+            if copies:
+                pipe.delete(*copies)
+            estimate = pipe.execute()[1]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, estimate)
+
+    @classmethod
+    def remove(cls, name: str) -> bool:
+        """Removes a unique counter and returns True if it existed"""
+        try:
+            return bool(Counter.redis.delete(unique_key(name)))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+
+######################################################################
+#  F R E Q U E N C Y   S K E T C H E S
+######################################################################
+
+
+class FrequencySketch:
+    """Estimates how often each item was added to it with a count-min sketch
+
+    Arguments:
+        name: the name of the sketch
+        width: the number of counters in each row
+        depth: the number of rows
+        total: the sum of the counts of every item that was added
+        estimates: the estimated count of some items by item
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self, name: str, width: int, depth: int, total: int, estimates: dict = None
+    ):
+        """Constructor"""
+        self.name = name
+        self.width = int(width)
+        self.depth = int(depth)
+        self.total = int(total)
+        self.estimates = estimates or {}
+
+    def serialize(self):
+        """Converts a sketch into a dictionary
+
+        The error is how much any estimate may be too high with the
+        confidence. An estimate is never too low.
+        """
+        error, confidence = sketch_bounds(self.width, self.depth)
+        data = {
+            "name": self.name,
+            "type": "frequency",
+            "total": self.total,
+            "width": self.width,
+            "depth": self.depth,
+            "error": math.ceil(error * self.total),
+            "confidence": round(confidence, 4),
+        }
+        if self.estimates:
+            data["estimates"] = self.estimates
+        return data
+
+    @classmethod
+    def _load(cls, name: str, items: list, result: list):
+        """Makes a sketch from the result of the add or read script"""
+        if result is None:
+            return None
+        width, depth, total, *estimates = result
+        return cls(name, width, depth, total, dict(zip(items, estimates)))
+
+    @classmethod
+    def create(cls, name: str, width: int, depth: int):
+        """Creates an empty sketch unless it already exists
+
+        Returns:
+            the new FrequencySketch or None if the sketch already exists
+        """
+        try:
+            created = Counter.scripts["sketch_create"](keys=[sketch_key(name)], args=[width, depth])
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, width, depth, 0) if created else None
+
+    @classmethod
+    def add(cls, name: str, items: dict):
+        """Adds counts of items to a sketch
+
+        The items are added in chunks of one script call each, which run
+        in one pipeline.
+
+        Arguments:
+            name: the name of the sketch
+            items: the positive count to add for each item
+
+        Returns:
+            the FrequencySketch with the new estimates of the items or None
+            if the sketch does not exist
+        """
+        sketch = cls.find(name)
+        if sketch is None or not items:
+            return sketch
+        key = sketch_key(name)
+        try:
+            pipe = Counter.redis.pipeline(transaction=False)
+            for chunk in chunks(items, sketch.depth):
+                Counter.scripts["sketch_add"](keys=[key], args=add_args(chunk), client=pipe)
+            results = pipe.execute()
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls._merge_results(name, items, results)
+
+    @classmethod
+    def _merge_results(cls, name: str, items: dict, results: list):
+        """Makes a sketch from the results of the add script for every chunk"""
+        if any(result is None for result in results):
+            return None
+        width, depth, total = results[-1][:3]
+        estimates = [estimate for result in results for estimate in result[3:]]
+        return cls(name, width, depth, total, dict(zip(items, estimates)))
+
+    @classmethod
+    def find(cls, name: str, items: list = ()):
+        """Finds a sketch with the name and estimates the counts of some items
+
+        Returns:
+            the FrequencySketch or None if it does not exist
+        """
+        try:
+            result = Counter.scripts["sketch_read"](keys=[sketch_key(name)], args=read_args(items))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls._load(name, items, result)
+
+    @classmethod
+    def remove(cls, name: str) -> bool:
+        """Removes a sketch and returns True if it existed"""
+        try:
+            return bool(Counter.redis.delete(sketch_key(name)))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+
+######################################################################
+#  A S Y N C H R O N O U S   T W I N S
+######################################################################
+# The twins share the constructors and serialize() and only replace the
+# methods that talk to Redis with coroutines
+# pylint: disable=invalid-overridden-method
+
+
+class AsyncUniqueCounter(UniqueCounter):
+    """A UniqueCounter that is read and written with redis.asyncio"""
+
+    @classmethod
+    async def add(cls, name: str, items: list) -> "AsyncUniqueCounter":
+        """Adds items to a unique counter, which is created if it does not exist"""
+        key = unique_key(name)
+        try:
+            async with node_client(AsyncCounter.redis, key).pipeline(transaction=False) as pipe:
+                pipe.pfadd(key, *items)
+                pipe.pfcount(key)
+                estimate = (await pipe.execute())[1]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, estimate)
+
+    @classmethod
+    async def find(cls, name: str):
+        """Finds a unique counter with the name or returns None"""
+        key = unique_key(name)
+        try:
+            async with node_client(AsyncCounter.redis, key).pipeline(transaction=False) as pipe:
+                pipe.exists(key)
+                pipe.pfcount(key)
+                exists, estimate = await pipe.execute()
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, estimate) if exists else None
+
+    @classmethod
+    async def merge(cls, name: str, sources: list):
+        """Adds every item of other unique counters to a unique counter
+
+        Returns:
+            the AsyncUniqueCounter or None if one of the sources does not exist
+        """
+        key = unique_key(name)
+        keys = [unique_key(source) for source in sources]
+        target = node_client(AsyncCounter.redis, key)
+        copies = []
+        try:
+            if await AsyncCounter.redis.exists(*keys) < len(set(keys)):
+                return None
+            local = [source for source in keys if node_client(AsyncCounter.redis, source) is target]
+            for source in set(keys).difference(local):
+                copy = merge_copy_key(key)
+                data = await node_client(AsyncCounter.redis, source).dump(source)
+                if data is not None:
+                    await target.restore(copy, MERGE_COPY_TTL, data)
+                    copies.append(copy)
+            async with target.pipeline(transaction=False) as pipe:
+                pipe.pfmerge(key, *local, *copies)
+                pipe.pfcount(key)
+                if copies:
+                    pipe.delete(*copies)
+                estimate = (await pipe.execute())[1]
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, estimate)
+
+    @classmethod
+    async def remove(cls, name: str) -> bool:
+        """Removes a unique counter and returns True if it existed"""
+        try:
+            return bool(await AsyncCounter.redis.delete(unique_key(name)))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+
+class AsyncFrequencySketch(FrequencySketch):
+    """A FrequencySketch that is read and written with redis.asyncio"""
+
+    @classmethod
+    async def create(cls, name: str, width: int, depth: int):
+        """Creates an empty sketch unless it already exists"""
+        try:
+            created = await AsyncCounter.scripts["sketch_create"](keys=[sketch_key(name)], args=[width, depth])
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, width, depth, 0) if created else None
+
+    @classmethod
+    async def add(cls, name: str, items: dict):
+        """Adds counts of items to a sketch or returns None if it does not exist"""
+        sketch = await cls.find(name)
+        if sketch is None or not items:
+            return sketch
+        key = sketch_key(name)
+        try:
+            async with AsyncCounter.redis.pipeline(transaction=False) as pipe:
+                for chunk in chunks(items, sketch.depth):
+                    await AsyncCounter.scripts["sketch_add"](keys=[key], args=add_args(chunk), client=pipe)
+                results = await pipe.execute()
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls._merge_results(name, items, results)
+
+    @classmethod
+    async def find(cls, name: str, items: list = ()):
+        """Finds a sketch with the name and estimates the counts of some items"""
+        try:
+            result = await AsyncCounter.scripts["sketch_read"](keys=[sketch_key(name)], args=read_args(items))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls._load(name, items, result)
+
+    @classmethod
+    async def remove(cls, name: str) -> bool:
+        """Removes a sketch and returns True if it existed"""
+        try:
+            return bool(await AsyncCounter.redis.delete(sketch_key(name)))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for Admission Control
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import time
+import runpy
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from service import config
+from service.common.admission import AdmissionController, Limiter, route_class, READ, WRITE, LISTING
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class AdmissionTests(TestCase):
+    """Admission Control Tests"""
+
+    def test_route_classes(self):
+        """It should Sort requests into reads, writes and listings"""
+        self.assertEqual(route_class("read_counters", "GET"), READ)
+        self.assertEqual(route_class("update_counters", "PUT"), WRITE)
+        self.assertEqual(route_class("batch_counters", "POST"), WRITE)
+        self.assertEqual(route_class("list_counters", "GET"), LISTING)
+        for endpoint in ["index", "metrics", "stream_counters", None]:
+            self.assertIsNone(route_class(endpoint, "GET"))
+
+    def test_turn_away_when_queue_is_full(self):
+        """It should Turn requests away at once when the queue is full"""
+        limiter = Limiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        start = time.monotonic()
+        self.assertFalse(limiter.acquire())
+        self.assertLess(time.monotonic() - start, 0.05)
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.status(), {"limit": 2, "in_flight": 2, "waiting": 0, "standing": False})
+
+    def test_wait_for_a_request_to_finish(self):
+        """It should Let a waiting request in when another one finishes"""
+        limiter = Limiter(1, max_queue=1, interval=5.0)
+        self.assertTrue(limiter.acquire())
+        threading.Timer(0.05, limiter.release).start()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_shorten_waits_while_queue_stands(self):
+        """It should Only let requests wait for the target once no request waited less in an interval"""
+        limiter = Limiter(1, max_queue=1, target=0.01, interval=0.05)
+        self.assertTrue(limiter.acquire())
+        for _ in range(2):
+            self.assertFalse(limiter.acquire())
+        self.assertTrue(limiter.standing)
+        start = time.monotonic()
+        self.assertFalse(limiter.acquire())
+        self.assertLess(time.monotonic() - start, 0.04)
+        limiter.release()
+        time.sleep(0.06)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.standing)
+
+    def test_controller(self):
+        """It should Limit only the route classes that have a limit"""
+        controller = AdmissionController({READ: 1, WRITE: 0}, max_queue=0)
+        self.assertEqual(list(controller.status()), [READ])
+        self.assertTrue(controller.admit(READ))
+        self.assertFalse(controller.admit(READ))
+        self.assertTrue(controller.admit(WRITE))
+        controller.release(WRITE)
+        controller.release(READ)
+        self.assertEqual(controller.status()[READ]["in_flight"], 0)
+        self.assertRaises(ValueError, AdmissionController, {"search": 1})
+
+    def test_warn_single_threaded_workers(self):
+        """It should Warn at startup when admission control is on but workers run one thread"""
+        hooks = runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py"))
+        self.assertGreater(hooks["threads"], config.ADMISSION_READ_LIMIT)
+        server = MagicMock()
+        for admission, threads, warned in [(True, 1, True), (True, 16, False), (False, 1, False)]:
+            server.reset_mock()
+            server.cfg.threads = threads
+            with patch.object(config, "ADMISSION_CONTROL", admission):
+                hooks["when_ready"](server)
+            self.assertEqual(server.log.warning.called, warned)
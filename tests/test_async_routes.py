@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous Counter API Service Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import json
+import logging
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from redis.exceptions import ConnectionError as RedisConnectionError
+from asgi import app
+from wsgi import app as wsgi_app
+from service.async_models import AsyncCounter
+from service.models import DatabaseConnectionError
+from service.common import status
+
+logging.disable(logging.CRITICAL)
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class AsyncServiceTest(IsolatedAsyncioTestCase):
+    """Asynchronous REST API Server Tests"""
+
+    async def asyncSetUp(self):
+        """This runs before each test"""
+        await AsyncCounter.connect(DATABASE_URI, max_connections=10, pool_timeout=1.0)
+        await AsyncCounter.remove_all()
+        self.client = app.test_client()
+
+    async def asyncTearDown(self):
+        """This runs after each test"""
+        await AsyncCounter.disconnect()
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    async def test_index(self):
+        """It should return the home page"""
+        resp = await self.client.get("/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = await resp.get_json()
+        self.assertIn("/counters", data["paths"])
+
+    async def test_metrics(self):
+        """It should Count requests, errors and Redis commands for GET /metrics"""
+        await self.client.get("/counters/bar")
+        resp = await self.client.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = await resp.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",route="/counters/<name>",status="404"}', data)
+        self.assertIn('http_errors_total{handler="http_error"}', data)
+
+    async def test_redis_round_trips(self):
+        """It should Send the Redis round trips of each request in a Server-Timing header"""
+        await AsyncCounter.create("foo")
+        with patch.dict(app.config, {"REDIS_TRACING": True, "REDIS_TRACE_LOG": True}):
+            resp = await self.client.get("/counters/foo")
+        self.assertIn('desc="round trips: 1, commands: 1"', resp.headers["Server-Timing"])
+        resp = await self.client.get("/counters/foo")
+        self.assertNotIn("Server-Timing", resp.headers)
+
+    async def test_counter_lifecycle(self):
+        """It should Create, Read, Update and Delete a counter"""
+        resp = await self.client.post("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn("/counters/foo", resp.headers["Location"])
+        self.assertEqual(await resp.get_json(), {"name": "foo", "counter": 0})
+        resp = await self.client.post("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = await self.client.put("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual((await resp.get_json())["counter"], 1)
+        resp = await self.client.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual((await resp.get_json())["counter"], 1)
+        resp = await self.client.delete("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = await self.client.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.put("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.delete("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    async def test_conditional_get(self):
+        """It should Answer If-None-Match with 304 until the counter or listing changes"""
+        await self.client.post("/counters/foo")
+        for url in ["/counters/foo", "/counters"]:
+            etag = (await self.client.get(url)).headers["ETag"]
+            resp = await self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED, url)
+            await self.client.put("/counters/foo")
+            resp = await self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK, url)
+
+    async def test_striped_counter(self):
+        """It should Create, Update, Read and Delete a striped counter"""
+        resp = await self.client.post("/counters/hot", query_string={"stripes": 3})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = await self.client.post("/counters/hot", query_string={"stripes": 3})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        for _ in range(4):
+            resp = await self.client.put("/counters/hot")
+        self.assertEqual(await resp.get_json(), {"name": "hot", "counter": 4})
+        AsyncCounter.stripe_counts.clear()
+        resp = await self.client.put("/counters/hot")
+        self.assertEqual((await resp.get_json())["counter"], 5)
+        resp = await self.client.get("/counters")
+        self.assertEqual(await resp.get_json(), [{"name": "hot", "counter": 5}])
+        resp = await self.client.delete("/counters/hot")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(await AsyncCounter.redis.exists("hot/0", "hot/1", "hot/2"), 0)
+        AsyncCounter.stripe_counts["hot"] = 3
+        resp = await self.client.put("/counters/hot")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_list_counters_in_pages(self):
+        """It should List counters one page at a time"""
+        for i in range(15):
+            await AsyncCounter.create(f"foo{i}")
+        names = []
+        resp = await self.client.get("/counters", query_string={"limit": 5})
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            names.extend(counter["name"] for counter in await resp.get_json())
+            if "Link" not in resp.headers:
+                break
+            next_url = resp.headers["Link"].split(";")[0].strip("<>")
+            resp = await self.client.get(next_url)
+        self.assertEqual(sorted(names), sorted(f"foo{i}" for i in range(15)))
+        self.assertEqual(len(await AsyncCounter.all()), 15)
+
+    async def test_export_counters(self):
+        """It should Stream all of the counters as NDJSON or CSV"""
+        for i in range(15):
+            await AsyncCounter.create(f"foo{i}", i)
+        resp = await self.client.get("/counters/_export", query_string={"limit": 4})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = (await resp.get_data(as_text=True)).splitlines()
+        self.assertCountEqual(lines, [json.dumps({"name": f"foo{i}", "counter": i}) for i in range(15)])
+        resp = await self.client.get("/counters/_export", query_string={"format": "csv"})
+        self.assertEqual(resp.mimetype, "text/csv")
+        lines = (await resp.get_data(as_text=True)).splitlines()
+        self.assertEqual(len(lines), 16)
+        self.assertEqual(lines[0], "name,counter")
+        resp = await self.client.get("/counters/_export", query_string={"format": "xml"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_import_counters(self):
+        """It should Import a stream of NDJSON or CSV counters"""
+        await AsyncCounter.create("foo1", 10)
+        await AsyncCounter.create("bar", 1, stripes=3)
+        body = "".join(json.dumps({"name": f"foo{i}", "counter": i}) + "\n" for i in range(15)) + "bad\n"
+        resp = await self.client.post(
+            "/counters/_import",
+            data=body,
+            headers={"Content-Type": "application/x-ndjson"},
+            query_string={"batch_size": 4},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = await resp.get_json()
+        self.assertEqual((data["imported"], data["skipped"], data["failed"]), (14, 1, 1))
+        resp = await self.client.post(
+            "/counters/_import",
+            data="foo1,3\nbar,4",
+            headers={"Content-Type": "text/csv"},
+            query_string={"mode": "overwrite"},
+        )
+        self.assertEqual((await resp.get_json())["imported"], 2)
+        self.assertEqual((await AsyncCounter.find("foo1")).count, 3)
+        self.assertEqual((await AsyncCounter.find("bar")).count, 4)
+        self.assertEqual(await AsyncCounter.redis.exists("bar/0", "bar/1", "bar/2"), 0)
+        resp = await self.client.post("/counters/_import", json=[])
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = await self.client.post(
+            "/counters/_import", data="", headers={"Content-Type": "text/csv"}, query_string={"mode": "merge"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_top_counters(self):
+        """It should List the highest counters from the highest down"""
+        await AsyncCounter.create("foo", 2)
+        await AsyncCounter.create("bar", 1)
+        await AsyncCounter.create("hot", stripes=3)
+        for _ in range(3):
+            await AsyncCounter.increment_existing("hot")
+        resp = await self.client.get("/counters/_top", query_string={"k": 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(await resp.get_json(), [{"name": "hot", "counter": 3}, {"name": "foo", "counter": 2}])
+        with patch.object(AsyncCounter.redis, "zrevrange", side_effect=DatabaseConnectionError()):
+            resp = await self.client.get("/counters/_top")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    async def test_redis_outage(self):
+        """It should Fail fast with Retry-After once the circuit to Redis opens"""
+        AsyncCounter.enable_circuit_breaker(window=4, min_calls=4)
+        try:
+            await AsyncCounter.connect(DATABASE_URI)
+            with patch("redis.asyncio.Redis.execute_command", side_effect=RedisConnectionError()):
+                for _ in range(3):
+                    resp = await self.client.get("/counters/foo")
+                    self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+                self.assertNotIn("Retry-After", resp.headers)
+                resp = await self.client.post("/counters/foo")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+                self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+        finally:
+            AsyncCounter.disable_circuit_breaker()
+
+    @patch("service.async_models.AsyncCounter.rates", True)
+    async def test_rate_of_counter(self):
+        """It should Count the increments of a counter in a window of time"""
+        await AsyncCounter.create("foo")
+        await AsyncCounter.create("hot", stripes=3)
+        for _ in range(2):
+            await self.client.put("/counters/foo")
+            await self.client.put("/counters/hot")
+        await AsyncCounter.batch([("increment", "foo", 3)])
+        AsyncCounter.stripe_counts.clear()
+        await AsyncCounter.increment_existing("hot")
+        resp = await self.client.get("/counters/foo/rate", query_string={"window": "1h"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual((await resp.get_json())["count"], 5)
+        self.assertEqual((await (await self.client.get("/counters/hot/rate")).get_json())["count"], 3)
+        resp = await self.client.get("/counters/foo/rate", query_string={"window": "soon"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.get("/counters/bar/rate")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        with patch.object(AsyncCounter.redis, "pipeline", side_effect=DatabaseConnectionError()):
+            resp = await self.client.get("/counters/foo/rate")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        with patch.object(AsyncCounter, "rates", False):
+            resp = await self.client.get("/counters/foo/rate")
+            self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    async def test_stream_counter_events(self):
+        """It should Stream the changes of counters as Server-Sent Events"""
+        resp = await self.client.get("/counters/foo/events")
+        self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        await AsyncCounter.create("foo", 1)
+        AsyncCounter.channel = "test:changes"
+        AsyncCounter.enable_events()
+        try:
+            self.assertTrue(await AsyncCounter.listener.wait_until_subscribed(2))
+            resp = await self.client.get("/counters/bar/events")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+            resp = await self.client.get("/counters/_events")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            with patch.dict(app.config, {"EVENTS_WINDOW": 0.01}):
+                async with self.client.request("/counters/_events", query_string={"name": ["foo", "bar"]}) as stream:
+                    await stream.send_complete()
+                    self.assertIn(b'{"name": "bar", "counter": null}', await stream.receive())
+                    await AsyncCounter.increment_existing("foo", 2)
+                    self.assertEqual(await stream.receive(), b'event: counter\ndata: {"name": "foo", "counter": 3}\n\n')
+                    AsyncCounter.events.reset()
+                    self.assertIn(b'"counter": 3', await stream.receive())
+                    await stream.disconnect()
+            with patch.object(AsyncCounter.redis, "pipeline", side_effect=DatabaseConnectionError()):
+                resp = await self.client.get("/counters/foo/events")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            await AsyncCounter.disable_events()
+            AsyncCounter.channel = ""
+        self.assertIsNone(AsyncCounter.listener)
+
+    async def test_unique_counters(self):
+        """It should Add items to, Merge, Read and Delete unique counters"""
+        resp = await self.client.post("/counters/_unique/monday", json={"items": ["a", "b", "a"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(await resp.get_json(), {"name": "monday", "type": "unique", "estimate": 2, "error": 1})
+        resp = await self.client.post("/counters/_unique/monday", json={"items": "a"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.post("/counters/_unique/week/_merge", json={"sources": ["monday"]})
+        self.assertEqual((await resp.get_json())["estimate"], 2)
+        resp = await self.client.post("/counters/_unique/week/_merge", json={"sources": ["sunday"]})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.post("/counters/_unique/week/_merge", json={})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual((await (await self.client.get("/counters/_unique/week")).get_json())["estimate"], 2)
+        resp = await self.client.delete("/counters/_unique/week")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = await self.client.get("/counters/_unique/week")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_frequency_sketches(self):
+        """It should Create, Add items to, Read and Delete frequency sketches"""
+        resp = await self.client.post("/counters/_frequency/pages", query_string={"error": "0.01"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((await resp.get_json())["width"], 272)
+        resp = await self.client.post("/counters/_frequency/pages")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = await self.client.post("/counters/_frequency/books", query_string={"confidence": "1"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.put("/counters/_frequency/pages", json={"items": {"home": 3}})
+        self.assertGreaterEqual((await resp.get_json())["estimates"]["home"], 3)
+        resp = await self.client.put("/counters/_frequency/pages", json={"items": None})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.put("/counters/_frequency/books", json={"items": ["home"]})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.get("/counters/_frequency/pages", query_string={"item": "home"})
+        self.assertEqual((await resp.get_json())["total"], 3)
+        resp = await self.client.delete("/counters/_frequency/pages")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = await self.client.get("/counters/_frequency/pages")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_batch_operations(self):
+        """It should Run a batch of counter operations"""
+        operations = [
+            {"op": "create", "name": "foo", "value": 2},
+            {"op": "increment", "name": "foo", "amount": 3},
+            {"op": "read", "name": "foo"},
+            {"op": "read", "name": "bar"},
+            {"op": "delete", "name": "foo"},
+            {"op": "jump", "name": "foo"},
+        ]
+        resp = await self.client.post("/counters/_batch", json=operations)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = await resp.get_json()
+        self.assertEqual([result["status"] for result in data], [201, 200, 200, 404, 204, 400])
+        self.assertEqual(data[2]["counter"], 5)
+
+    async def test_bad_requests(self):
+        """It should not accept bad requests"""
+        resp = await self.client.get("/counters", query_string={"limit": "foo"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.post("/counters/_batch", data="foo")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = await self.client.post("/counters/_batch", json={"op": "read"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        too_many = [{"op": "read", "name": "foo"}] * (app.config["BATCH_MAX_OPERATIONS"] + 1)
+        resp = await self.client.post("/counters/_batch", json=too_many)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.post("/counters")
+        self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    async def test_same_error_bodies(self):
+        """It should send the same error bodies as the WSGI service"""
+        wsgi_client = wsgi_app.test_client()
+        requests = [
+            ("GET", "/counters/foo", {}),
+            ("POST", "/counters", {}),
+            ("GET", "/counters?limit=foo", {}),
+            ("POST", "/counters/_batch", {"data": "foo"}),
+        ]
+        for method, path, kwargs in requests:
+            resp = await self.client.open(path, method=method, **kwargs)
+            expected = wsgi_client.open(path, method=method, **kwargs)
+            self.assertEqual(resp.status_code, expected.status_code)
+            self.assertEqual(await resp.get_json(), expected.get_json())
+
+    async def test_unknown_http_error(self):
+        """It should leave errors without a JSON body alone"""
+        await AsyncCounter.create("foo")
+        resp = await self.client.post("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertNotEqual(resp.mimetype, "application/json")
+
+    ######################################################################
+    #  T E S T   E R R O R   H A N D L E R S
+    ######################################################################
+
+    async def test_failed_requests(self):
+        """It should handle Errors for failed Redis calls"""
+        with patch.object(AsyncCounter.redis, "evalsha", side_effect=DatabaseConnectionError()):
+            resp = await self.client.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            data = await resp.get_json()
+            self.assertEqual(data["error"], "Service is unavailable")
+        with patch.object(AsyncCounter.redis, "zrangebylex", side_effect=DatabaseConnectionError()):
+            resp = await self.client.get("/counters")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        with patch.object(AsyncCounter.redis, "pipeline", side_effect=DatabaseConnectionError()):
+            resp = await self.client.post("/counters/_batch", json=[{"op": "read", "name": "foo"}])
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        with patch.object(AsyncCounter.redis, "flushall", side_effect=DatabaseConnectionError()):
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.remove_all()
+
+    async def test_no_connection(self):
+        """It should Handle a failed connection"""
+        await AsyncCounter.disconnect()
+        with patch("redis.asyncio.Redis.ping", side_effect=ConnectionError()):
+            with self.assertRaises(ConnectionError):
+                await AsyncCounter.connect(DATABASE_URI)
+        with patch.dict(os.environ, {"DATABASE_URI": ""}):
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.connect()
+
+    async def test_serving_lifecycle(self):
+        """It should Connect before serving and disconnect after"""
+        await AsyncCounter.disconnect()
+        async with app.test_app():
+            self.assertIsNotNone(AsyncCounter.redis)
+        self.assertIsNone(AsyncCounter.redis)
+        with patch.object(AsyncCounter, "connect", side_effect=DatabaseConnectionError("down")):
+            async with app.test_app():
+                self.assertIsNone(AsyncCounter.redis)
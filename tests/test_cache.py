@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the LRU Cache and Change Listener
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import gc
+import time
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from redis import Redis
+from service.common.cache import LRUCache
+from service.common import notifications
+from service.common.notifications import ChangeListener
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+def wait_for(condition, timeout=2.0):
+    """Waits for a condition set by a background thread"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+class LRUCacheTests(TestCase):
+    """LRU Cache Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.now = 0.0
+        self.cache = LRUCache(max_size=2, ttl=1.0, clock=lambda: self.now)
+
+    def test_hit_and_miss(self):
+        """It should count hits and misses"""
+        self.assertIsNone(self.cache.get("foo"))
+        self.cache.set("foo", 1)
+        self.assertEqual(self.cache.get("foo"), 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used entry"""
+        self.cache.set("foo", 1)
+        self.cache.set("bar", 2)
+        self.cache.get("foo")
+        self.cache.set("baz", 3)
+        self.assertEqual(self.cache.stats()["size"], 2)
+        self.assertIsNone(self.cache.get("bar"))
+        self.assertEqual(self.cache.get("foo"), 1)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_expire_entries(self):
+        """It should expire entries after their time to live"""
+        self.cache.set("foo", 1)
+        self.now = 1.0
+        self.assertIsNone(self.cache.get("foo"))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_invalidate_and_clear(self):
+        """It should invalidate and clear entries"""
+        self.cache.set("foo", 1)
+        self.cache.set("bar", 2)
+        self.cache.invalidate("foo")
+        self.cache.invalidate("foo")
+        self.assertIsNone(self.cache.get("foo"))
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+
+######################################################################
+#  C H A N G E   L I S T E N E R   T E S T   C A S E S
+######################################################################
+class ChangeListenerTests(TestCase):
+    """Change Listener Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.redis = Redis.from_url(DATABASE_URI, decode_responses=True)
+        self.changes = []
+        self.resets = 0
+        self.listener = ChangeListener(lambda: self.redis, "test:changes", 0.01)
+        self.listener.add_handler(self.on_change, self.on_reset)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.listener.stop()
+        self.redis.close()
+
+    def on_change(self, name, value):
+        """Records a change"""
+        self.changes.append((name, value))
+
+    def on_reset(self):
+        """Records a reset"""
+        self.resets += 1
+
+    def test_dispatch_changes(self):
+        """It should pass published changes to its handlers"""
+        self.listener.start()
+        self.assertTrue(self.listener.wait_until_subscribed(2))
+        self.assertEqual(self.resets, 1)
+        self.redis.publish("test:changes", '{"name": "foo", "counter": 5}')
+        self.redis.publish("test:changes", '{"name": "foo", "counter": null}')
+        self.assertTrue(wait_for(lambda: len(self.changes) == 2))
+        self.assertEqual(self.changes, [("foo", 5), ("foo", None)])
+
+    def test_ignore_bad_messages(self):
+        """It should ignore messages that are not changes"""
+        self.listener.dispatch("foo")
+        self.listener.dispatch('{"name": "foo"}')
+        self.assertEqual(self.changes, [])
+
+    def test_remove_handler(self):
+        """It should stop calling a removed handler"""
+        self.listener.remove_handler(self.on_change, self.on_reset)
+        self.listener.remove_handler(self.on_change)
+        self.listener.dispatch('{"name": "foo", "counter": 1}')
+        self.assertEqual(self.changes, [])
+
+    def test_resubscribe_after_error(self):
+        """It should subscribe again after losing the connection"""
+        calls = []
+
+        def connection():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ConnectionError("Redis is down")
+            return self.redis
+
+        self.listener.connection_fn = connection
+        self.listener.start()
+        self.assertTrue(self.listener.wait_until_subscribed(2))
+        self.assertEqual(len(calls), 2)
+
+    def test_one_fork_hook(self):
+        """It should Restart every live listener from one fork hook"""
+        gc.collect()
+        live = len(notifications._listeners)
+        listener = ChangeListener(lambda: self.redis, "test:other")
+        self.assertIn(listener, notifications._listeners)
+        with patch.object(ChangeListener, "_after_fork") as after_fork:
+            notifications._after_fork()
+        self.assertGreaterEqual(after_fork.call_count, 2)
+        del listener
+        gc.collect()
+        self.assertEqual(len(notifications._listeners), live)
+
+    def test_after_fork(self):
+        """It should subscribe again in a forked child"""
+        self.listener.start()
+        self.assertTrue(self.listener.wait_until_subscribed(2))
+        self.listener._after_fork()
+        self.assertTrue(self.listener.wait_until_subscribed(2))
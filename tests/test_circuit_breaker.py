@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Circuit Breaker
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import asyncio
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from service.common.circuit_breaker import CircuitBreaker, CircuitOpenError, retry_after, CLOSED, OPEN, HALF_OPEN
+from service.models import Counter, DatabaseConnectionError
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+class Clock:
+    """A clock that only moves when it is told to"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def fail():
+    """Fails like a Redis node that is down"""
+    raise RedisConnectionError("Connection refused")
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class CircuitBreakerTests(TestCase):
+    """Circuit Breaker Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(window=4, min_calls=4, open_seconds=2.0, max_open_seconds=8.0, clock=self.clock)
+
+    def test_open_on_failures(self):
+        """It should Open once enough of the recent calls failed and then fail fast"""
+        for _ in range(2):
+            self.assertEqual(self.breaker.call(lambda: "OK"), "OK")
+        self.assertRaises(RedisConnectionError, self.breaker.call, fail)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertRaises(RedisConnectionError, self.breaker.call, fail)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as context:
+            self.breaker.call(self.fail_test)
+        self.assertTrue(1.0 <= context.exception.retry_after <= 2.0)
+        self.assertEqual(self.breaker.status()["state"], OPEN)
+
+    def test_other_errors_are_successes(self):
+        """It should Count errors that Redis replied with as successful calls"""
+        for _ in range(4):
+            self.assertRaises(ValueError, self.breaker.call, int, "foo")
+        self.assertEqual(self.breaker.status(), {"state": CLOSED, "calls": 4, "failures": 0, "retry_after": 0.0})
+
+    def test_open_on_slow_calls(self):
+        """It should Count calls slower than slow_seconds as failed"""
+        self.breaker.slow_seconds = 0.0
+        for _ in range(4):
+            self.breaker.call(lambda: "OK")
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_probe_when_half_open(self):
+        """It should Let one probe through after a while and close when it succeeds"""
+        self.open()
+        self.clock.now += 2.0
+        self.breaker.before()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertRaises(CircuitOpenError, self.breaker.before)
+        self.breaker.record(False, 0.001)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.call(lambda: "OK"), "OK")
+
+    def test_back_off_after_failed_probes(self):
+        """It should Open for longer after every failed probe up to max_open_seconds"""
+        self.open()
+        for longest in [4.0, 8.0, 8.0]:
+            self.clock.now = self.breaker.retry_at
+            self.assertRaises(RedisTimeoutError, self.breaker.call, self.time_out)
+            self.assertEqual(self.breaker.state, OPEN)
+            self.assertTrue(longest / 2 <= self.breaker.retry_at - self.clock.now <= longest)
+
+    def test_call_async(self):
+        """It should Fail coroutine calls fast like the others"""
+
+        async def time_out():
+            raise RedisTimeoutError()
+
+        async def ok():
+            return "OK"
+
+        self.assertEqual(asyncio.run(self.breaker.call_async(ok)), "OK")
+        for _ in range(3):
+            self.assertRaises(RedisTimeoutError, asyncio.run, self.breaker.call_async(time_out))
+        self.assertRaises(CircuitOpenError, asyncio.run, self.breaker.call_async(ok))
+
+    def test_retry_after(self):
+        """It should Tell how many whole seconds to wait for errors caused by an open circuit"""
+        self.assertEqual(retry_after(CircuitOpenError(0.2)), "1")
+        try:
+            raise DatabaseConnectionError("down") from CircuitOpenError(2.5)
+        except DatabaseConnectionError as err:
+            self.assertEqual(retry_after(err), "3")
+        self.assertIsNone(retry_after(DatabaseConnectionError("down")))
+
+    def open(self):
+        """Opens the circuit of the test breaker"""
+        for _ in range(4):
+            self.assertRaises(RedisConnectionError, self.breaker.call, fail)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def fail_test(self):
+        """Fails the test if an open circuit calls it"""
+        self.fail("An open circuit made a call")
+
+    @staticmethod
+    def time_out():
+        """Fails like a Redis node that is too slow"""
+        raise RedisTimeoutError("Timeout reading from socket")
+
+
+######################################################################
+#  C O U N T E R S
+######################################################################
+class CounterOutageTests(TestCase):
+    """Counter Tests while Redis is down"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.enable_circuit_breaker(window=4, min_calls=4)
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+
+    def tearDown(self):
+        """This runs after each test"""
+        Counter.disable_circuit_breaker()
+        Counter.disable_stale_reads()
+
+    def test_fail_fast(self):
+        """It should Fail the commands of every client and pipeline fast once the circuit opens"""
+        self.assertEqual(len(Counter.breakers()), 1)
+        with patch("redis.Redis.execute_command", side_effect=RedisConnectionError()):
+            for _ in range(4):
+                self.assertRaises(DatabaseConnectionError, Counter.find, "foo")
+        with patch("redis.client.Pipeline.execute") as execute:
+            with self.assertRaises(DatabaseConnectionError) as context:
+                Counter.find_many(["foo", "bar"])
+            execute.assert_not_called()
+        self.assertIsInstance(context.exception.__cause__, CircuitOpenError)
+        Counter._after_fork()
+        self.assertEqual(Counter.breakers()[0].state, CLOSED)
+        Counter.disable_circuit_breaker()
+        self.assertEqual(Counter.breakers(), [])
+
+    def test_serve_stale_reads(self):
+        """It should Serve the last value read of a counter with its age while Redis is down"""
+        Counter.enable_stale_reads(max_size=10, max_age=60)
+        Counter.create("foo", 5)
+        Counter.create("bar", 1)
+        fresh = Counter.find("foo")
+        self.assertIsNone(fresh.age)
+        Counter.find("bar")
+        Counter.remove("bar")
+        self.assertIsNone(Counter.find("gone"))
+        with patch("redis.Redis.execute_command", side_effect=RedisConnectionError()):
+            stale = Counter.find("foo")
+            self.assertEqual(stale.serialize(), {"name": "foo", "counter": 5})
+            self.assertEqual(stale.etag, fresh.etag)
+            self.assertGreaterEqual(stale.age, 0)
+            for name in ["bar", "gone"]:
+                self.assertRaises(DatabaseConnectionError, Counter.find, name)
+            self.assertRaises(DatabaseConnectionError, Counter.increment_existing, "foo")
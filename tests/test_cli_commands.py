@@ -0,0 +1,93 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+CLI Command Extensions for Flask
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+
+logging.disable(logging.CRITICAL)
+
+
+class TestFlaskCLI(TestCase):
+    """Flask CLI Command Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.runner = app.test_cli_runner()
+
+    @patch("service.models.Counter.rebalance")
+    def test_rebalance(self, rebalance_mock):
+        """It should Move counters with the rebalance command"""
+        rebalance_mock.return_value = {"scanned": 10, "moved": 3, "conflicts": 1}
+        result = self.runner.invoke(args=["rebalance"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Moved 3 of 10 keys, 1 conflicts", result.output)
+        rebalance_mock.assert_called_once_with(False)
+
+    @patch("service.models.Counter.rebalance")
+    def test_rebalance_dry_run(self, rebalance_mock):
+        """It should only count the counters to move with --dry-run"""
+        rebalance_mock.return_value = {"scanned": 10, "moved": 3, "conflicts": 0}
+        result = self.runner.invoke(args=["rebalance", "--dry-run"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Would move 3 of 10 keys", result.output)
+        rebalance_mock.assert_called_once_with(True)
+
+    @patch("service.models.Counter.reindex")
+    def test_reindex(self, reindex_mock):
+        """It should Index the counters with the reindex command"""
+        reindex_mock.return_value = {"indexed": 7, "removed": 2}
+        result = self.runner.invoke(args=["reindex"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Indexed 7 counters, removed 2 names", result.output)
+
+    @patch("service.models.Counter.buckets", 16)
+    @patch("service.models.Counter.migrate_to_buckets")
+    def test_migrate_buckets(self, migrate_mock):
+        """It should Move counters into buckets with the migrate-buckets command"""
+        migrate_mock.return_value = {"scanned": 10, "moved": 9, "conflicts": 1}
+        result = self.runner.invoke(args=["migrate-buckets"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Moved 9 of 10 keys into 16 buckets, 1 conflicts", result.output)
+
+    def test_migrate_without_buckets(self):
+        """It should not migrate when there are no buckets"""
+        result = self.runner.invoke(args=["migrate-buckets"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("COUNTERS_BUCKETS", result.output)
+
+    @patch("service.common.cli_commands.measure_storage")
+    def test_storage_benchmark(self, measure_mock):
+        """It should Print the bytes per counter with the storage-benchmark command"""
+        measure_mock.return_value = {
+            "counters": 500, "buckets": 5, "key_bytes_per_counter": 70.5, "bucket_bytes_per_counter": 12.1
+        }
+        result = self.runner.invoke(args=["storage-benchmark", "--counters", "500"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("500 counters in 5 buckets", result.output)
+        self.assertIn("70.5 bytes per counter", result.output)
+        self.assertEqual(measure_mock.call_args.args[1:], (500, 100))
+
+    def test_json_benchmark(self):
+        """It should Print the CPU time of each JSON provider with the json-benchmark command"""
+        result = self.runner.invoke(args=["json-benchmark", "--responses", "10"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("orjson", result.output)
+        self.assertIn("list of 100", result.output)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Connection Pools
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.common.connection_pool import (
+    create_pool,
+    ConnectionPool,
+    BlockingConnectionPool,
+)
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class ConnectionPoolTests(TestCase):
+    """Connection Pool Tests"""
+
+    def test_create_pools(self):
+        """It should create a blocking pool only when it has a timeout"""
+        pool = create_pool(DATABASE_URI, max_connections=3, socket_timeout=1.0)
+        self.assertIsInstance(pool, ConnectionPool)
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 1.0)
+        pool = create_pool(DATABASE_URI, max_connections=3, pool_timeout=0.5)
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        self.assertEqual(pool.timeout, 0.5)
+
+    def test_pool_stats(self):
+        """It should count the connections that are used"""
+        pool = create_pool(DATABASE_URI, max_connections=2, pool_timeout=0.5)
+        client = Redis(connection_pool=pool)
+        client.ping()
+        client.ping()
+        stats = pool.stats()
+        self.assertEqual(stats["max_connections"], 2)
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["peak_in_use"], 1)
+        pool.disconnect()
+
+    def test_pool_exhausted(self):
+        """It should count timeouts when the pool is exhausted"""
+        pool = create_pool(DATABASE_URI, max_connections=1, pool_timeout=0.01)
+        connection = pool.get_connection("PING")
+        self.assertEqual(pool.stats()["in_use"], 1)
+        self.assertRaises(RedisConnectionError, pool.get_connection, "PING")
+        self.assertEqual(pool.stats()["timeouts"], 1)
+        pool.release(connection)
+        self.assertEqual(pool.stats()["in_use"], 0)
+        pool.disconnect()
+
+    def test_connect_errors_are_not_timeouts(self):
+        """It should count refused connections apart from timeouts"""
+        for pool_timeout in [None, 0.01]:
+            pool = create_pool("redis://localhost:1/0", pool_timeout=pool_timeout, socket_connect_timeout=0.1)
+            self.assertRaises(RedisConnectionError, pool.get_connection, "PING")
+            stats = pool.stats()
+            self.assertEqual((stats["timeouts"], stats["connect_errors"]), (0, 1))
+        pool = create_pool(DATABASE_URI, max_connections=1)
+        connection = pool.get_connection("PING")
+        self.assertRaises(RedisConnectionError, pool.get_connection, "PING")
+        self.assertEqual((pool.stats()["timeouts"], pool.stats()["connect_errors"]), (1, 0))
+        pool.release(connection)
+        pool.disconnect()
+
+    def test_failed_connect_is_not_returned(self):
+        """It should not count a connection that failed to connect as returned"""
+        for pool_timeout in [None, 0.01]:
+            pool = create_pool(DATABASE_URI, pool_timeout=pool_timeout)
+            connection = pool.get_connection("PING")
+            with patch("redis.connection.AbstractConnection.connect", side_effect=RedisConnectionError("refused")):
+                self.assertRaises(RedisConnectionError, pool.get_connection, "PING")
+            self.assertEqual(pool.stats()["in_use"], 1)
+            pool.release(connection)
+            pool.release(connection)
+            self.assertEqual(pool.stats()["in_use"], 0)
+            pool.disconnect()
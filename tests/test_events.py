@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Change Events Hub
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import time
+import logging
+import threading
+from unittest import TestCase, IsolatedAsyncioTestCase
+from service.common.events import (
+    EventHub, Subscription, AsyncSubscription, RESYNC, format_events, resync_names
+)
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class EventHubTests(TestCase):
+    """Change Events Hub Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.hub = EventHub()
+
+    def test_dispatch_to_watchers(self):
+        """It should Pass a change only to the subscriptions that watch the counter"""
+        foo = Subscription(["foo"], window=0)
+        both = Subscription(["foo", "bar"], window=0)
+        self.hub.add(foo)
+        self.hub.add(both)
+        self.assertEqual(len(self.hub), 2)
+        self.hub.dispatch("bar", 1)
+        self.hub.dispatch("baz", 2)
+        self.assertEqual(foo.get(0), {})
+        self.assertEqual(both.get(0), {"bar": 1})
+        self.hub.remove(both)
+        self.hub.remove(foo)
+        self.hub.dispatch("foo", 3)
+        self.assertEqual(len(self.hub), 0)
+        self.assertEqual(foo.get(0), {})
+
+    def test_limit_subscriptions(self):
+        """It should Not add a subscription once the hub has as many as its limit"""
+        first = Subscription(["foo"], window=0)
+        self.assertTrue(self.hub.add(first, limit=1))
+        self.assertFalse(self.hub.add(Subscription(["bar"], window=0), limit=1))
+        self.assertEqual(len(self.hub), 1)
+        self.hub.dispatch("bar", 1)
+        self.hub.remove(first)
+        self.assertTrue(self.hub.add(Subscription(["bar"], window=0), limit=1))
+
+    def test_coalesce_changes(self):
+        """It should Only keep the latest value of a counter within a window"""
+        subscription = Subscription(["foo", "bar"], window=0.05)
+        self.hub.add(subscription)
+
+        def increment():
+            for value in range(1, 11):
+                self.hub.dispatch("foo", value)
+                time.sleep(0.001)
+            self.hub.dispatch("bar", None)
+
+        thread = threading.Thread(target=increment)
+        thread.start()
+        changes = subscription.get(1)
+        thread.join()
+        changes.update(subscription.get(0.1))
+        self.assertEqual(changes, {"foo": 10, "bar": None})
+
+    def test_reset(self):
+        """It should Ask every subscription to read its counters again"""
+        subscription = Subscription(["foo", "bar"], window=0)
+        self.hub.add(subscription)
+        self.hub.dispatch("foo", 1)
+        self.hub.reset()
+        changes = subscription.get(0)
+        self.assertEqual(sorted(resync_names(changes)), ["bar", "foo"])
+
+    def test_format_events(self):
+        """It should Format changes as Server-Sent Events"""
+        self.assertEqual(
+            format_events({"foo": 1, "bar": None}),
+            'event: counter\ndata: {"name": "foo", "counter": 1}\n\n'
+            'event: counter\ndata: {"name": "bar", "counter": null}\n\n',
+        )
+        self.assertEqual(format_events({}), "")
+
+
+class AsyncSubscriptionTests(IsolatedAsyncioTestCase):
+    """Asynchronous Subscription Tests"""
+
+    async def test_coalesce_changes(self):
+        """It should Gather the changes of a window in an event loop"""
+        hub = EventHub()
+        subscription = AsyncSubscription(["foo"], window=0.01)
+        hub.add(subscription)
+        self.assertEqual(await subscription.get(0.01), {})
+        hub.dispatch("foo", 1)
+        hub.dispatch("foo", 2)
+        self.assertEqual(await subscription.get(1), {"foo": 2})
+        hub.reset()
+        self.assertIs((await subscription.get(1))["foo"], RESYNC)
+        self.assertEqual(await subscription.get(0.01), {})
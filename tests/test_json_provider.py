@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Fast JSON provider
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import json
+import uuid
+from decimal import Decimal
+from unittest import TestCase
+from flask import Flask, jsonify
+from service.common.json_provider import OrjsonProvider, JsonTemplate, init_json
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class JsonProviderTests(TestCase):
+    """Fast JSON Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.app = Flask(__name__)
+        self.app.config["JSON_PROVIDER"] = "orjson"
+        init_json(self.app)
+
+    def test_init_json(self):
+        """It should Install the provider that JSON_PROVIDER names"""
+        self.assertIsInstance(self.app.json, OrjsonProvider)
+        app = Flask(__name__)
+        app.config["JSON_PROVIDER"] = "flask"
+        init_json(app)
+        self.assertNotIsInstance(app.json, OrjsonProvider)
+        app.config["JSON_PROVIDER"] = "ujson"
+        self.assertRaises(ValueError, init_json, app)
+
+    def test_jsonify(self):
+        """It should Encode responses like jsonify does"""
+        with self.app.app_context():
+            resp = jsonify(name="foo", counter=5, id=uuid.UUID(int=1), price=Decimal("1.5"), tally={1: 2})
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(
+            resp.get_data(),
+            b'{"name":"foo","counter":5,"id":"00000000-0000-0000-0000-000000000001","price":"1.5","tally":{"1":2}}\n',
+        )
+        self.app.debug = True
+        with self.app.app_context():
+            resp = jsonify([1])
+        self.assertEqual(resp.get_data(), b"[\n  1\n]\n")
+
+    def test_dumps_and_loads(self):
+        """It should Read and write JSON text with or without the options of the json module"""
+        provider = self.app.json
+        self.assertEqual(provider.dumps({"name": "café"}), '{"name":"café"}')
+        self.assertEqual(provider.dumps({"b": 1, "a": 2}, indent=1), '{\n "a": 2,\n "b": 1\n}')
+        self.assertEqual(provider.loads(b'{"counter": 5}'), {"counter": 5})
+        self.assertEqual(provider.loads('{"counter": 1.5}', parse_float=Decimal), {"counter": Decimal("1.5")})
+        self.assertRaises(ValueError, provider.loads, "{")
+
+    def test_templates(self):
+        """It should Render templates that encode their fixed members once"""
+        template = JsonTemplate({"status": 404, "error": "Not Found"}, "message")
+        body = template.render(message='Counter "foo" not found')
+        self.assertEqual(json.loads(body), {"status": 404, "error": "Not Found", "message": 'Counter "foo" not found'})
+        body = JsonTemplate({}, "name", "counter").render(name="foo", counter=1)
+        self.assertEqual(json.loads(body), {"name": "foo", "counter": 1})
+        self.assertEqual(JsonTemplate({"version": "1.0"}).render(), b'{"version":"1.0"}\n')
+        self.assertEqual(JsonTemplate({}).render(), b"{}\n")
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Log Handlers
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import gc
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service.common import log_handlers
+from service.common.log_handlers import (
+    init_logging,
+    parse_sample_rates,
+    DroppingQueueHandler,
+    SamplingLogger,
+)
+
+
+class ListHandler(logging.Handler):
+    """Keeps the messages of the records it handles and the threads that wrote them"""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class LogHandlerTests(TestCase):
+    """Log Handler Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        logging.disable(logging.NOTSET)
+        self.handler = ListHandler()
+        self.server_logger = logging.getLogger("test.server")
+        self.server_logger.handlers = [self.handler]
+        self.server_logger.setLevel(logging.INFO)
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        """This runs after each test"""
+        init_logging(self.app, "test.server")
+        logging.disable(logging.CRITICAL)
+
+    def test_log_in_request_thread(self):
+        """It should Write records in the thread that logs them by default"""
+        init_logging(self.app, "test.server")
+        self.app.logger.info("Hello %s", "world")
+        self.assertTrue(self.handler.messages[-1].endswith("Hello world"))
+        self.assertEqual(self.handler.threads, {threading.current_thread().name})
+
+    def test_log_through_queue(self):
+        """It should Write records from a listener thread"""
+        init_logging(self.app, "test.server", queue_size=100)
+        queue_handler = self.app.logger.handlers[0]
+        self.assertIsInstance(queue_handler, DroppingQueueHandler)
+        for i in range(10):
+            self.app.logger.info("Record %d", i)
+        queue_handler.stop()
+        self.assertEqual(self.handler.messages[-1][-8:], "Record 9")
+        self.assertNotIn(threading.current_thread().name, self.handler.threads)
+
+    def test_drop_when_queue_is_full(self):
+        """It should Drop and count records instead of waiting for a full queue"""
+        init_logging(self.app, "test.server", queue_size=2)
+        queue_handler = self.app.logger.handlers[0]
+        queue_handler.stop()
+        for i in range(5):
+            self.app.logger.info("Record %d", i)
+        self.assertEqual(queue_handler.dropped, 3)
+        queue_handler.start()
+        queue_handler.stop()
+        self.assertTrue(self.handler.messages[-3].endswith("Dropped 3 log records because the log queue was full"))
+        self.assertEqual([message[-8:] for message in self.handler.messages[-2:]], ["Record 0", "Record 1"])
+        self.assertEqual(queue_handler.take_dropped(), 0)
+        queue_handler._after_fork()
+        self.assertEqual(queue_handler.queue.qsize(), 0)
+        queue_handler.start()
+        listener = queue_handler._listener
+        queue_handler._after_fork()
+        self.assertIsNot(queue_handler._listener, listener)
+        listener.stop()
+
+    def test_one_fork_hook(self):
+        """It should Restart every live queue handler from one fork hook"""
+        gc.collect()
+        live = len(log_handlers._handlers)
+        queue_handler = DroppingQueueHandler(2, [self.handler])
+        self.assertIn(queue_handler, log_handlers._handlers)
+        with patch.object(DroppingQueueHandler, "_after_fork") as after_fork:
+            log_handlers._after_fork()
+        after_fork.assert_called()
+        del queue_handler
+        gc.collect()
+        self.assertEqual(len(log_handlers._handlers), live)
+
+    def test_sample_records(self):
+        """It should Keep only a share of the records of sampled levels"""
+        self.assertEqual(parse_sample_rates(" info=0.5, DEBUG=0 ,"), {logging.INFO: 0.5, logging.DEBUG: 0.0})
+        self.assertEqual(parse_sample_rates(""), {})
+        for text in ["LOUD=1", "INFO=2", "INFO=foo"]:
+            self.assertRaises(ValueError, parse_sample_rates, text)
+        init_logging(self.app, "test.server", sample_rates={logging.INFO: 0})
+        self.assertIsInstance(self.app.logger, SamplingLogger)
+        count = len(self.handler.messages)
+        for i in range(10):
+            self.app.logger.info("Record %d", i)
+        self.app.logger.warning("Careful")
+        self.assertEqual(len(self.handler.messages), count + 1)
+        init_logging(self.app, "test.server")
+        self.assertNotIsInstance(self.app.logger, SamplingLogger)
+        self.app.logger.info("Everything")
+        self.assertEqual(len(self.handler.messages), count + 3)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Metrics
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import sys
+import logging
+import tempfile
+import subprocess
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+from prometheus_client import REGISTRY
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.common.cache import LRUCache
+from service.common.connection_pool import create_pool
+from service.common.metrics import (
+    MeteredRedis,
+    AsyncMeteredRedis,
+    PIPELINE,
+    UNMATCHED,
+    count_errors,
+    record_request,
+    start_request,
+    generate_metrics,
+    clear_metrics,
+    worker_exited,
+)
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+# a worker process that handles one request
+WORKER = "from service.common.metrics import *; record_request('GET', '/workers', 200, start_request())"
+
+
+def sample(name: str, **labels) -> float:
+    """Returns the value of a sample or 0 if it was never recorded"""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class MetricsTests(TestCase):
+    """Metrics Tests"""
+
+    def test_count_commands(self):
+        """It should Count the commands and pipelines sent to Redis"""
+        client = MeteredRedis(connection_pool=create_pool(DATABASE_URI))
+        sets, gets = sample("redis_commands_total", command="SET"), sample("redis_commands_total", command="GET")
+        pipelines = sample("redis_command_duration_seconds_count", command=PIPELINE)
+        client.set("metrics", 1)
+        with client.pipeline() as pipe:
+            pipe.get("metrics").get("metrics").set("metrics", 2)
+            self.assertEqual(pipe.execute(), ["1", "1", True])
+        self.assertEqual(sample("redis_commands_total", command="SET"), sets + 2)
+        self.assertEqual(sample("redis_commands_total", command="GET"), gets + 2)
+        self.assertEqual(sample("redis_command_duration_seconds_count", command=PIPELINE), pipelines + 1)
+        client.delete("metrics")
+
+    def test_count_pool_connections(self):
+        """It should Count the connections that the pools hand out"""
+        client = MeteredRedis(connection_pool=create_pool(DATABASE_URI, max_connections=1, pool_timeout=0.1))
+        checkouts, timeouts = sample("redis_pool_checkouts_total"), sample("redis_pool_timeouts_total")
+        in_use = sample("redis_pool_connections_in_use")
+        client.ping()
+        self.assertEqual(sample("redis_pool_checkouts_total"), checkouts + 1)
+        self.assertEqual(sample("redis_pool_connections_in_use"), in_use)
+        connection = client.connection_pool.get_connection()
+        self.assertEqual(sample("redis_pool_connections_in_use"), in_use + 1)
+        self.assertRaises(RedisConnectionError, client.ping)
+        self.assertEqual(sample("redis_pool_timeouts_total"), timeouts + 1)
+        client.connection_pool.release(connection)
+        self.assertEqual(sample("redis_pool_connections_in_use"), in_use)
+
+    def test_count_cache(self):
+        """It should Count the hits, misses and evictions of the counter caches"""
+        names = ["hits", "misses", "evictions", "expirations", "invalidations"]
+        before = {name: sample(f"counter_cache_{name}_total") for name in names}
+        cache = LRUCache(max_size=1, ttl=60)
+        cache.set("foo", 1)
+        self.assertEqual(cache.get("foo"), 1)
+        self.assertIsNone(cache.get("bar"))
+        cache.set("bar", 2)
+        cache.invalidate("bar")
+        cache.ttl = 0
+        cache.set("baz", 3)
+        self.assertIsNone(cache.get("baz"))
+        counted = {name: sample(f"counter_cache_{name}_total") - before[name] for name in names}
+        self.assertEqual(counted, {name: cache.stats()[name] for name in names})
+        self.assertEqual(counted, {"hits": 1, "misses": 2, "evictions": 1, "expirations": 1, "invalidations": 1})
+
+    def test_record_requests(self):
+        """It should Count requests and errors by route"""
+        requests = sample("http_requests_total", method="GET", route=UNMATCHED, status="404")
+        record_request("GET", None, 404, start_request())
+        self.assertEqual(sample("http_requests_total", method="GET", route=UNMATCHED, status="404"), requests + 1)
+
+        @count_errors
+        def teapot(error):
+            """Handles an error"""
+            return error, 418
+
+        errors = sample("http_errors_total", handler="teapot")
+        self.assertEqual(teapot("short and stout"), ("short and stout", 418))
+        self.assertEqual(teapot.__name__, "teapot")
+        self.assertEqual(sample("http_errors_total", handler="teapot"), errors + 1)
+
+    def test_add_up_workers(self):
+        """It should Add up the samples that every worker wrote"""
+        data, content_type = generate_metrics()
+        self.assertIn(b"http_requests_total", data)
+        self.assertTrue(content_type.startswith("text/plain"))
+        with tempfile.TemporaryDirectory() as path:
+            env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": path}
+            for _ in range(2):
+                subprocess.run([sys.executable, "-c", WORKER], env=env, check=True)
+            self.assertTrue(os.listdir(path))
+            with patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": path}):
+                data, _ = generate_metrics()
+                self.assertIn(b'http_requests_total{method="GET",route="/workers",status="200"} 2.0', data)
+                worker_exited(os.getpid())
+                clear_metrics()
+            self.assertEqual(os.listdir(path), [])
+        clear_metrics()
+        worker_exited(101)
+
+
+class AsyncMetricsTests(IsolatedAsyncioTestCase):
+    """Asynchronous Metrics Tests"""
+
+    async def test_count_commands(self):
+        """It should Count the commands and pipelines sent with redis.asyncio"""
+        client = AsyncMeteredRedis.from_url(DATABASE_URI, decode_responses=True)
+        gets = sample("redis_commands_total", command="GET")
+        await client.get("metrics")
+        async with client.pipeline() as pipe:
+            await pipe.get("metrics").execute()
+        self.assertEqual(sample("redis_commands_total", command="GET"), gets + 2)
+
+        @count_errors
+        async def teapot(error):
+            """Handles an error"""
+            return error, 418
+
+        self.assertEqual(await teapot("short and stout"), ("short and stout", 418))
+        await client.aclose()
@@ -22,11 +22,18 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import time
 import logging
 from unittest import TestCase
 from unittest.mock import patch
 from redis.exceptions import ConnectionError as RedisConnectionError
-from service.models import Counter, DatabaseConnectionError
+from service.common.buckets import bucket_key, move_to_bucket, measure_storage
+from service.common.rollups import parse_window, window_keys, rollup_key
+from service.common.sketches import sketch_key
+from service.models import (
+    Counter, DatabaseConnectionError, NODE_KEYS, INDEX_KEY, TOP_KEY, VERSIONS_KEY,
+    stripe_keys, pick_stripe, is_stripe_key, lex_range
+)
 
 DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
 
@@ -85,6 +92,136 @@ class CounterTests(TestCase):
         counters = Counter.all()
         self.assertEqual(len(counters), 3)
 
+    def test_page_through_counters(self):
+        """It should Page through all of the counters in the order of their names"""
+        for i in range(25):
+            _ = Counter(f"foo{i}")
+        names = []
+        after, page = Counter.page(limit=10)
+        names.extend(counter["name"] for counter in page)
+        while after:
+            after, page = Counter.page(after, limit=10)
+            names.extend(counter["name"] for counter in page)
+        self.assertEqual(names, sorted(["hits"] + [f"foo{i}" for i in range(25)]))
+
+    def test_page_by_prefix(self):
+        """It should Page through the counters whose names start with a prefix"""
+        for name in ["fo", "foo", "foo_0", "fooé", "fop", "é"]:
+            Counter.create(name)
+        self.assertEqual(Counter.page(prefix="foo"), ("", [
+            {"name": "foo", "counter": 0}, {"name": "foo_0", "counter": 0}, {"name": "fooé", "counter": 0}
+        ]))
+        self.assertEqual(Counter.page("foo", limit=1, prefix="foo"), ("foo_0", [{"name": "foo_0", "counter": 0}]))
+        self.assertEqual(Counter.page("fop", prefix="foo"), ("", []))
+        self.assertEqual([counter["name"] for counter in Counter.page("fop")[1]], ["hits", "é"])
+        self.assertEqual(lex_range(), (b"-", b"+"))
+        self.assertEqual(lex_range("a", "0"), (b"[a", b"[a\xff"))
+
+    def test_pages_of_counters(self):
+        """It should Yield all of the counters one page at a time"""
+        for i in range(25):
+            _ = Counter(f"foo{i}")
+        pages = list(Counter.pages(limit=10))
+        self.assertGreater(len(pages), 1)
+        self.assertTrue(all(pages))
+        self.assertEqual(len({counter["name"] for page in pages for counter in page}), 26)
+
+    def test_page_skips_missing_values(self):
+        """It should skip keys that vanish or are not counters"""
+        _ = Counter("foo")
+        Counter.redis.sadd("bar", "baz")
+        Counter.redis.zadd(INDEX_KEY, {"gone": 0})
+        after, counters = Counter.page()
+        self.assertEqual(after, "")
+        self.assertEqual([counter["name"] for counter in counters], ["foo", "hits"])
+
+    def test_index_counters(self):
+        """It should Keep the names of the counters in the index"""
+        Counter.create("foo")
+        Counter.create("hot", stripes=3)
+        Counter.import_counters([("bar", 1)])
+        Counter.batch([("create", "baz", 0), ("delete", "foo", 0)])
+        self.assertEqual(Counter.redis.zrange(INDEX_KEY, 0, -1), ["bar", "baz", "hits", "hot"])
+        Counter.remove("hot")
+        del self.counter.value
+        self.assertEqual(Counter.redis.zrange(INDEX_KEY, 0, -1), ["bar", "baz"])
+
+    def test_top_counters(self):
+        """It should Rank the highest counters as they change"""
+        Counter.top_size = 3
+        try:
+            for name, value in [("a", 5), ("b", 1), ("c", 3)]:
+                Counter.create(name, value)
+            Counter.create("hot", 2, stripes=2)
+            self.assertEqual(Counter.redis.zcard(TOP_KEY), 3)
+            self.assertEqual(Counter.top(2), [{"name": "a", "counter": 5}, {"name": "c", "counter": 3}])
+            for _ in range(5):
+                Counter.increment_existing("hot")
+            Counter.batch([("increment", "b", 10), ("delete", "a", 0)])
+            # c was dropped when b went up and only comes back when it changes
+            self.assertEqual(Counter.top(), [{"name": "b", "counter": 11}, {"name": "hot", "counter": 7}])
+            Counter.increment_existing("c")
+            self.assertEqual(Counter.top()[2], {"name": "c", "counter": 4})
+        finally:
+            Counter.top_size = 1000
+        with patch.object(Counter.redis, "zrevrange", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.top)
+
+    def test_reindex_counters(self):
+        """It should Index counters created before the index and drop names that are gone"""
+        Counter.create("hot", 2, stripes=3)
+        Counter.redis.mset({"old": "5", "older": "-1", "text": "foo", "star": "*x"})
+        Counter.redis.sadd("set", "foo")
+        Counter.redis.zadd(INDEX_KEY, {"gone": 0})
+        Counter.redis.zadd(TOP_KEY, {"gone": 9})
+        generation = Counter.generation()
+        self.assertEqual(Counter.reindex(), {"indexed": 2, "removed": 1})
+        self.assertEqual(Counter.redis.zrange(INDEX_KEY, 0, -1), ["hits", "hot", "old", "older"])
+        self.assertEqual([counter["name"] for counter in Counter.top()], ["old", "hot", "hits", "older"])
+        self.assertNotEqual(Counter.generation(), generation)
+        generation = Counter.generation()
+        self.assertEqual(Counter.reindex(), {"indexed": 0, "removed": 0})
+        self.assertEqual(Counter.generation(), generation)
+        with patch.object(Counter.redis, "scan_iter", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.reindex)
+
+    @patch("service.models.time.time", return_value=7200.0)
+    def test_rates(self, time_mock):
+        """It should Count the increments of counters in windows of time"""
+        Counter.rates = True
+        try:
+            Counter.create("foo")
+            Counter.create("hot", stripes=3)
+            self.assertEqual(Counter("hits").increment(), 1)
+            for _ in range(3):
+                Counter.increment_existing("foo")
+                Counter.increment_existing("hot", 2)
+            Counter.stripe_counts.clear()
+            self.assertEqual(Counter.batch([("increment", "foo", 5), ("increment", "hot", 1), ("read", "foo", 0)]), [8, 7, 8])
+            Counter.stripe_counts.clear()
+            self.assertEqual(Counter._flush_increments({"foo": 2, "hot": 1, "gone": 1}), {"foo": 10, "hot": 8, "gone": None})
+            self.assertEqual((Counter.rate("foo", 60), Counter.rate("hot", 60), Counter.rate("hits", 1)), (10, 8, 1))
+            self.assertEqual(Counter.redis.ttl(rollup_key("foo", 1, 7200)), 61)
+            time_mock.return_value = 7200.0 + 120
+            self.assertEqual((Counter.rate("foo", 60), Counter.rate("foo", 180), Counter.rate("foo", 86400)), (0, 10, 10))
+            time_mock.return_value = 7200.0 + 3600
+            self.assertEqual((Counter.rate("foo", 3600), Counter.rate("foo", 7200)), (0, 10))
+            with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+                self.assertRaises(DatabaseConnectionError, Counter.rate, "foo", 60)
+        finally:
+            Counter.rates = False
+        Counter.increment_existing("foo")
+        self.assertEqual(Counter.rate("foo", 60), 0)
+
+    def test_windows(self):
+        """It should Parse windows and pick the rollups that add up to them"""
+        self.assertEqual([parse_window(text) for text in ("90", "30s", "5M", "1h", " 1d ")], [90, 30, 300, 3600, 86400])
+        for text in ("0", "2d", "-1m", "m", "1.5h", "1w"):
+            self.assertRaises(ValueError, parse_window, text)
+        self.assertEqual(window_keys("foo", 3, 100.5), ["rates/1/98/foo", "rates/1/99/foo", "rates/1/100/foo"])
+        self.assertEqual(window_keys("foo", 90, 7200), ["rates/60/119/foo", "rates/60/120/foo"])
+        self.assertEqual(len(window_keys("foo", 86400, 7200)), 24)
+
     def test_set_find_counter(self):
         """It should Find a counter"""
         _ = Counter("foo")
@@ -134,13 +271,457 @@ class CounterTests(TestCase):
         counter.increment()
         self.assertEqual(counter.value, 2)
 
+    def test_create_if_absent(self):
+        """It should Create a counter only if it does not exist"""
+        counter = Counter.create("foo", 5)
+        self.assertEqual(counter.serialize(), {"name": "foo", "counter": 5})
+        self.assertIsNone(Counter.create("foo"))
+        self.assertEqual(Counter.find("foo").serialize()["counter"], 5)
+
+    def test_increment_existing(self):
+        """It should Increment a counter only if it exists"""
+        self.assertEqual(Counter.increment_existing("hits"), 1)
+        self.assertEqual(Counter.increment_existing("hits", 5), 6)
+        self.assertIsNone(Counter.increment_existing("foo"))
+        self.assertIsNone(Counter.find("foo"))
+
+    def test_remove_counter(self):
+        """It should Remove a counter by name"""
+        self.assertTrue(Counter.remove("hits"))
+        self.assertFalse(Counter.remove("hits"))
+        self.assertIsNone(Counter.find("hits"))
+
+    def test_generation_connection_error(self):
+        """It should Handle a failed connection when reading the generation"""
+        with patch.object(Counter.redis, "get", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.generation)
+
+    def test_find_does_not_write(self):
+        """It should Find a counter without writing to it"""
+        with patch.object(Counter.redis, "set") as set_mock:
+            counter = Counter.find("hits")
+            set_mock.assert_not_called()
+        self.assertEqual(counter.serialize(), {"name": "hits", "counter": 0})
+
+    def test_batch_operations(self):
+        """It should Run many operations in one pipeline"""
+        results = Counter.batch([
+            ("create", "foo", 2),
+            ("create", "hits", 0),
+            ("increment", "foo", 3),
+            ("increment", "bar", 1),
+            ("read", "foo", 0),
+            ("read", "bar", 0),
+            ("delete", "hits", 0),
+            ("delete", "hits", 0),
+        ])
+        self.assertEqual(results, [2, None, 5, None, 5, None, True, False])
+        self.assertEqual(Counter.batch([]), [])
+
+    def test_find_many(self):
+        """It should Find many counters with one call"""
+        _ = Counter("foo", 4)
+        foo, bar, hits = Counter.find_many(["foo", "bar", "hits"])
+        self.assertEqual(foo.serialize(), {"name": "foo", "counter": 4})
+        self.assertIsNone(bar)
+        self.assertEqual(hits.serialize()["counter"], 0)
+        self.assertEqual(Counter.find_many([]), [])
+
+    @patch("redis.Redis.mget")
+    def test_find_many_connection_error(self, mget_mock):
+        """It should Handle a failed MGET when finding many counters"""
+        mget_mock.side_effect = RedisConnectionError()
+        self.assertRaises(DatabaseConnectionError, Counter.find_many, ["foo"])
+
+    def test_import_counters(self):
+        """It should Import many counters skipping or overwriting the ones that exist"""
+        Counter.create("hot", 7, stripes=3)
+        counters = [("foo", 1), ("hits", 2), ("hot", 3)]
+        self.assertEqual(Counter.import_counters(counters), [True, False, False])
+        self.assertEqual(Counter.find("hits").serialize()["counter"], 0)
+        self.assertEqual(Counter.import_counters(counters, overwrite=True), [True, True, True])
+        self.assertEqual(Counter.redis.mget(["foo", "hits", "hot"]), ["1", "2", "3"])
+        self.assertEqual(Counter.redis.exists(*stripe_keys("hot", 3)), 0)
+        self.assertEqual(Counter.increment_existing("hot"), 4)
+        self.assertEqual(Counter.import_counters([]), [])
+        with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.import_counters, counters)
+
+    def test_striped_counter(self):
+        """It should Spread the increments of a striped counter over its stripes"""
+        counter = Counter.create("hot", 5, stripes=4)
+        self.assertEqual(counter.serialize(), {"name": "hot", "counter": 5})
+        self.assertEqual(Counter.redis.get("hot"), "*4")
+        self.assertEqual(Counter.redis.mget(stripe_keys("hot", 4)), ["5", "0", "0", "0"])
+        for count in range(6, 16):
+            self.assertEqual(Counter.increment_existing("hot"), count)
+        self.assertEqual(sum(int(value) for value in Counter.redis.mget(stripe_keys("hot", 4))), 15)
+        self.assertEqual(Counter.find("hot").serialize(), {"name": "hot", "counter": 15})
+        self.assertEqual(Counter.find_many(["hot"])[0].serialize()["counter"], 15)
+        self.assertCountEqual(
+            Counter.all(), [{"name": "hits", "counter": 0}, {"name": "hot", "counter": 15}]
+        )
+        self.assertIsNone(Counter.create("hot", stripes=2))
+        self.assertTrue(Counter.remove("hot"))
+        self.assertEqual(Counter.redis.exists(*stripe_keys("hot", 4)), 0)
+        self.assertIsNone(Counter.find("hot"))
+        self.assertIsNone(Counter.increment_existing("hot"))
+
+    def test_striped_counter_instance(self):
+        """It should Read and increment a striped counter through an instance"""
+        Counter.create("hot", 5, stripes=4)
+        Counter.stripe_counts.clear()
+        counter = Counter.__new__(Counter)
+        counter.name = "hot"
+        self.assertEqual(counter.value, 5)
+        self.assertEqual(counter.increment(), 6)
+        self.assertEqual(counter.increment(), 7)
+        self.assertEqual(counter.value, 7)
+        self.assertEqual(Counter.redis.get("hot"), "*4")
+        Counter.enable_write_behind(interval=60, max_pending=100)
+        try:
+            self.assertEqual(counter.increment(), 8)
+            self.assertEqual(counter.value, 8)
+        finally:
+            Counter.disable_write_behind()
+        self.assertEqual(Counter.find("hot").serialize()["counter"], 8)
+        missing = Counter.__new__(Counter)
+        missing.name = "new"
+        self.assertIsNone(missing.value)
+        self.assertEqual(missing.increment(), 1)
+        self.assertEqual(missing.increment(), 2)
+
+    def test_increment_counts_rollups(self):
+        """It should Add the increments of an instance to the rollups"""
+        with patch.object(Counter, "rates", True):
+            counter = Counter("foo")
+            counter.increment()
+            counter.increment()
+            self.assertEqual(Counter.rate("foo", 60), 2)
+
+    def test_versions(self):
+        """It should Give every change of a counter a new version and the database a new generation"""
+        counter = Counter.find("hits")
+        generation = Counter.generation()
+        self.assertEqual(counter.etag, f"{counter.version}-0")
+        Counter.increment_existing("hits")
+        self.assertGreater(int(Counter.find("hits").version), int(counter.version))
+        self.assertNotEqual(Counter.generation(), generation)
+        Counter.create("hot", stripes=3)
+        Counter.increment_existing("hot")
+        version = Counter.find("hot").version
+        Counter.increment_existing("hot")
+        self.assertGreater(int(Counter.find("hot").version), int(version))
+        self.assertIsNone(Counter.redis.hget(VERSIONS_KEY, "hot/0"))
+        generation = Counter.generation()
+        self.assertTrue(Counter.remove("hits"))
+        self.assertIsNone(Counter.redis.hget(VERSIONS_KEY, "hits"))
+        self.assertNotEqual(Counter.generation(), generation)
+        self.assertIsNone(Counter("new", 5).etag)
+        Counter.remove_all()
+        self.assertEqual(Counter.generation(), "0")
+        Counter.create("hits")
+        self.assertGreater(int(Counter.generation()), 10**15)
+
+    def test_striped_counter_in_batch(self):
+        """It should Read, increment and delete striped counters in a batch"""
+        Counter.create("hot", 2, stripes=3)
+        Counter.stripe_counts.clear()
+        results = Counter.batch([
+            ("increment", "hot", 3),
+            ("read", "hot", 0),
+            ("delete", "hot", 0),
+        ])
+        self.assertEqual(results, [5, 5, True])
+        self.assertEqual(Counter.redis.exists(*stripe_keys("hot", 3)), 0)
+
+    def test_stale_stripe_count(self):
+        """It should Increment a counter whose stripe count is out of date"""
+        Counter.stripe_counts["hits"] = 4
+        self.assertEqual(Counter.increment_existing("hits"), 1)
+        self.assertNotIn("hits", Counter.stripe_counts)
+        Counter.create("hot", stripes=2)
+        Counter.stripe_counts.clear()
+        self.assertEqual(Counter.increment_existing("hot"), 1)
+        self.assertEqual(Counter.stripe_counts["hot"], 2)
+
+    def test_pick_stripe(self):
+        """It should Pick a stripe at random or one per worker"""
+        self.assertEqual(pick_stripe(7, "worker"), os.getpid() % 7)
+        self.assertIn(pick_stripe(3), range(3))
+        self.assertTrue(is_stripe_key("hot/12"))
+        self.assertFalse(is_stripe_key("hot"))
+        self.assertFalse(is_stripe_key("/1"))
+        self.assertFalse(is_stripe_key("hot/x"))
+
+    def test_striped_write_behind(self):
+        """It should Write behind the increments of striped counters"""
+        Counter.create("hot", 1, stripes=2)
+        Counter.create("warm", 1, stripes=2)
+        Counter.stripe_counts.pop("warm")
+        Counter.enable_write_behind(interval=60, max_pending=100)
+        try:
+            self.assertEqual(Counter.increment_existing("hot", 2), 3)
+            self.assertEqual(Counter.increment_existing("warm", 4), 5)
+            self.assertEqual(Counter.increment_existing("hits"), 1)
+            self.assertEqual(Counter.write_behind.flush(), 3)
+        finally:
+            Counter.disable_write_behind()
+        counts = {counter.name: counter.serialize()["counter"] for counter in Counter.find_many(["hot", "warm", "hits"])}
+        self.assertEqual(counts, {"hot": 3, "warm": 5, "hits": 1})
+
+    def test_publish_striped_changes(self):
+        """It should Publish the changes of striped counters"""
+        changes = []
+        Counter.subscribe(lambda name, value: changes.append((name, value)), channel="test:changes")
+        try:
+            self.assertTrue(Counter.listener.wait_until_subscribed(2))
+            Counter.create("hot", 3, stripes=2)
+            Counter.increment_existing("hot", 2)
+            Counter.remove("hot")
+            for _ in range(200):
+                if len(changes) == 3:
+                    break
+                time.sleep(0.01)
+        finally:
+            Counter.unsubscribe(Counter.listener._handlers[0])
+        self.assertEqual(changes, [("hot", 3), ("hot", 5), ("hot", None)])
+
+    def test_write_behind_increments(self):
+        """It should Buffer increments and write them behind"""
+        Counter.enable_write_behind(interval=60, max_pending=100)
+        try:
+            self.assertEqual(Counter.increment_existing("hits"), 1)
+            self.assertEqual(Counter.increment_existing("hits", 2), 3)
+            self.assertIsNone(Counter.increment_existing("foo"))
+            self.assertEqual(Counter.redis.get("hits"), "0")
+            self.assertEqual(Counter.pending("hits"), 3)
+            self.assertEqual(Counter.find("hits").serialize()["counter"], 3)
+            Counter.write_behind.flush()
+            self.assertEqual(Counter.redis.get("hits"), "3")
+            self.assertEqual(Counter.increment_existing("hits"), 4)
+        finally:
+            Counter.disable_write_behind()
+        self.assertEqual(Counter.redis.get("hits"), "4")
+        self.assertEqual(Counter.pending("hits"), 0)
+
+    def test_write_behind_removed_counter(self):
+        """It should not bring back a counter removed with pending increments"""
+        Counter.enable_write_behind(interval=60, max_pending=100)
+        try:
+            _ = Counter("foo")
+            Counter.increment_existing("foo")
+            Counter.increment_existing("hits")
+            Counter.redis.delete("hits")
+            self.assertTrue(Counter.remove("foo"))
+            _ = Counter("bar")
+            Counter.increment_existing("bar")
+            self.assertEqual(Counter.batch([("read", "bar", 0), ("delete", "bar", 0)]), [1, True])
+            Counter.write_behind.flush()
+        finally:
+            Counter.disable_write_behind()
+        self.assertIsNone(Counter.find("foo"))
+        self.assertIsNone(Counter.find("hits"))
+
+    def test_cache_counters(self):
+        """It should Cache counters and invalidate them when they change"""
+        Counter.enable_cache(max_size=10, ttl=60, channel="test:changes")
+        try:
+            self.assertTrue(Counter.listener.wait_until_subscribed(2))
+            version = Counter.find("hits").version
+            self.assertEqual(Counter.find("hits").version, version)
+            self.assertEqual(Counter.cache.stats()["hits"], 1)
+            self.assertEqual(Counter.increment_existing("hits"), 1)
+            self.assertEqual(Counter.find("hits").serialize()["counter"], 1)
+            # a change made by another worker arrives through pub/sub
+            Counter.redis.set("hits", 5)
+            Counter.redis.publish("test:changes", '{"name": "hits", "counter": 5}')
+            for _ in range(200):
+                if "hits" not in Counter.cache._data:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(Counter.find("hits").serialize()["counter"], 5)
+            Counter.batch([("delete", "hits", 0)])
+            self.assertIsNone(Counter.find("hits"))
+        finally:
+            Counter.disable_cache()
+        self.assertIsNone(Counter.listener)
+        self.assertEqual(Counter.channel, "")
+
+    def test_publish_changes(self):
+        """It should Publish every change of a counter"""
+        changes = []
+        Counter.subscribe(lambda name, value: changes.append((name, value)), channel="test:changes")
+        try:
+            self.assertTrue(Counter.listener.wait_until_subscribed(2))
+            Counter.create("foo")
+            Counter.increment_existing("foo", 2)
+            Counter.remove("foo")
+            Counter.remove("foo")
+            for _ in range(200):
+                if len(changes) == 3:
+                    break
+                time.sleep(0.01)
+        finally:
+            Counter.unsubscribe(Counter.listener._handlers[0])
+        self.assertEqual(changes, [("foo", 0), ("foo", 2), ("foo", None)])
+        Counter.unsubscribe(None)
+
+    def test_connect_with_pool_options(self):
+        """It should Connect with a configured connection pool"""
+        Counter.connect(DATABASE_URI, max_connections=5, pool_timeout=1.0, socket_timeout=2.0)
+        pool = Counter.redis.connection_pool
+        self.assertEqual(pool.max_connections, 5)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 2.0)
+        self.assertIsNotNone(Counter.find("hits"))
+        stats = Counter.pool_stats()
+        self.assertEqual(stats["in_use"], 0)
+        self.assertGreater(stats["checkouts"], 0)
+
+    def test_new_pool_after_fork(self):
+        """It should Use a connection pool of its own in a forked worker"""
+        _ = Counter("hits")
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            code = 0 if Counter.redis.connection_pool.created == 0 else 1
+            code = code or (0 if Counter.increment_existing("hits") == 1 else 2)
+            os._exit(code)
+        _, code = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(code), 0)
+        self.assertEqual(Counter.find("hits").serialize()["counter"], 1)
+        old_pool = Counter.redis.connection_pool
+        Counter._after_fork()
+        self.assertIsNot(Counter.redis.connection_pool, old_pool)
+
     @patch("redis.Redis.ping")
     def test_no_connection(self, ping_mock):
         """It should Handle a failed connection"""
         ping_mock.side_effect = RedisConnectionError()
         self.assertRaises(DatabaseConnectionError, self.counter.connect, DATABASE_URI)
 
+    def test_pool_stats_without_connection(self):
+        """It should have no pool statistics when it is not connected"""
+        with patch.object(Counter, "redis", None):
+            self.assertEqual(Counter.pool_stats(), {})
+
     @patch.dict(os.environ, {"DATABASE_URI": ""})
     def test_missing_environment_creds(self):
         """It should detect Missing environment credentials"""
         self.assertRaises(DatabaseConnectionError, self.counter.connect)
+
+
+######################################################################
+#  H A S H   B U C K E T   T E S T   C A S E S
+######################################################################
+class BucketCounterTests(TestCase):
+    """Counter Model Tests with the counters kept in hash buckets"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+        Counter.buckets = 4
+
+    def tearDown(self):
+        """This runs after each test"""
+        Counter.buckets = 0
+
+    def test_counters_in_buckets(self):
+        """It should Keep counters as fields of their buckets"""
+        counter = Counter("hits", 3)
+        self.assertEqual(counter.value, 3)
+        self.assertEqual(counter.increment(), 4)
+        self.assertEqual(Counter.create("foo", 1).serialize(), {"name": "foo", "counter": 1})
+        self.assertIsNone(Counter.create("foo"))
+        self.assertEqual(Counter.increment_existing("foo", 5), 6)
+        self.assertEqual(Counter.batch([("create", "bar", 2), ("increment", "bar", 1), ("read", "bar", 0)]), [2, 3, 3])
+        self.assertEqual(Counter.import_counters([("baz", 9), ("foo", 0)]), [True, False])
+        self.assertEqual(Counter.redis.hget(bucket_key("baz", 4), "baz"), "9")
+        self.assertEqual(Counter.find("foo").serialize()["counter"], 6)
+        self.assertEqual([c and c.serialize()["counter"] for c in Counter.find_many(["bar", "nope", "hits"])], [3, None, 4])
+        self.assertEqual([counter["name"] for counter in Counter.all()], ["bar", "baz", "foo", "hits"])
+        self.assertEqual([counter["name"] for counter in Counter.top(2)], ["baz", "foo"])
+        self.assertTrue(Counter.remove("foo"))
+        self.assertIsNone(Counter.find("foo"))
+        del counter.value
+        self.assertIsNone(Counter.find("hits"))
+        keys = set(Counter.redis.scan_iter()) - set(NODE_KEYS)
+        self.assertTrue(keys)
+        self.assertTrue(all(key.startswith("counters/bucket/") for key in keys))
+
+    def test_striped_counter_in_buckets(self):
+        """It should Keep the stripes of a striped counter in buckets"""
+        Counter.create("hot", 5, stripes=4)
+        for count in range(6, 11):
+            self.assertEqual(Counter.increment_existing("hot"), count)
+        self.assertEqual(Counter.find("hot").serialize()["counter"], 10)
+        self.assertEqual(Counter.all(), [{"name": "hot", "counter": 10}])
+        fields = [Counter.redis.hget(bucket_key(key, 4), key) for key in stripe_keys("hot", 4)]
+        self.assertEqual(sum(int(value) for value in fields), 10)
+        self.assertTrue(Counter.remove("hot"))
+        self.assertEqual([Counter.redis.hget(bucket_key(key, 4), key) for key in stripe_keys("hot", 4)], [None] * 4)
+
+    def test_reindex_buckets(self):
+        """It should Index the counters in buckets and drop names that are gone"""
+        Counter.create("hot", 2, stripes=3)
+        Counter.redis.hset(bucket_key("old", 4), mapping={"old": "5", "text": "foo"})
+        Counter.redis.zadd(INDEX_KEY, {"gone": 0})
+        self.assertEqual(Counter.reindex(), {"indexed": 1, "removed": 1})
+        self.assertEqual(Counter.redis.zrange(INDEX_KEY, 0, -1), ["hot", "old"])
+        self.assertEqual(Counter.top(), [{"name": "old", "counter": 5}, {"name": "hot", "counter": 2}])
+
+    def test_migrate_to_buckets(self):
+        """It should Move counters from keys of their own into their buckets"""
+        Counter.buckets = 0
+        self.assertEqual(Counter.migrate_to_buckets(), {"scanned": 0, "moved": 0, "conflicts": 0})
+        Counter.create("foo", 3)
+        Counter.create("hot", 4, stripes=2)
+        Counter.redis.sadd("set", "foo")
+        Counter.redis.set("bar", 1)
+        Counter.redis.set(sketch_key("pages"), "sketch")
+        Counter.redis.set("session:abc", "token")
+        Counter.redis.set("admin/profile_rate", "0.01")
+        Counter.buckets = 4
+        Counter.redis.hset(bucket_key("bar", 4), "bar", 2)
+        self.assertEqual(Counter.migrate_to_buckets(), {"scanned": 5, "moved": 4, "conflicts": 1})
+        self.assertEqual(Counter.find("foo").serialize()["counter"], 3)
+        self.assertEqual(Counter.increment_existing("hot"), 5)
+        self.assertEqual(Counter.find("bar").serialize()["counter"], 2)
+        self.assertEqual(Counter.redis.get("bar"), "1")
+        self.assertEqual(Counter.redis.exists("foo", "hot", *stripe_keys("hot", 2)), 0)
+        self.assertEqual(Counter.redis.get(sketch_key("pages")), "sketch")
+        self.assertEqual(Counter.redis.get("session:abc"), "token")
+        self.assertEqual(Counter.redis.get("admin/profile_rate"), "0.01")
+        self.assertEqual([counter["name"] for counter in Counter.all()], ["bar", "foo", "hot"])
+        with patch.object(Counter.redis, "scan_iter", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.migrate_to_buckets)
+
+    def test_move_a_changing_counter(self):
+        """It should Copy a counter again when it changes while it is moved"""
+        client = Counter.redis
+        client.set("foo", 1)
+        hsetnx = client.hsetnx
+
+        def change_then_copy(*args):
+            client.incr("foo")
+            return hsetnx(*args)
+
+        with patch.object(client, "hsetnx", side_effect=change_then_copy):
+            self.assertFalse(move_to_bucket(client, client, "foo", "bucket", retries=1))
+        self.assertEqual(client.get("foo"), "2")
+        self.assertIsNone(client.hget("bucket", "foo"))
+        self.assertTrue(move_to_bucket(client, client, "foo", "bucket"))
+        self.assertEqual(client.hget("bucket", "foo"), "2")
+        self.assertTrue(move_to_bucket(client, client, "foo", "bucket"))
+
+    def test_measure_storage(self):
+        """It should Measure the bytes per counter of keys and of buckets"""
+        def memory_usage(_client, keys):
+            return sum(100 if key.startswith("benchmark/key/") else 1000 for key in keys)
+
+        with patch("service.common.buckets._memory_usage", side_effect=memory_usage):
+            result = measure_storage(Counter.redis, counters=250, per_bucket=100)
+        self.assertEqual(result, {
+            "counters": 250, "buckets": 2, "key_bytes_per_counter": 100.0, "bucket_bytes_per_counter": 8.0
+        })
+        self.assertEqual(list(Counter.redis.scan_iter()), [])
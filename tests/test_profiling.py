@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Request Profiler
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import gc
+import os
+import time
+import pstats
+import logging
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from service.common import profiling
+from service.common.profiling import Profiler, RATE_KEY, check_rate
+from service.models import Counter
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+def busy(seconds: float):
+    """Keeps the thread busy for some seconds"""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class ProfilerTests(TestCase):
+    """Request Profiler Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.directory = tempfile.mkdtemp()
+
+    def test_cprofile_requests(self):
+        """It should Add up the cProfile profiles of requests into one pstats file"""
+        profiler = Profiler(self.directory)
+        self.assertIsNone(profiler.write())
+        for _ in range(2):
+            profile = profiler.begin()
+            busy(0.01)
+            profiler.end(profile)
+        self.assertEqual(profiler.status()["pending"], 2)
+        filename = profiler.write()
+        self.assertTrue(filename.endswith(".pstats"))
+        stats = pstats.Stats(filename)
+        self.assertIn("busy", [function for _, _, function in stats.stats])
+        self.assertIsNone(profiler.write())
+
+    def test_sample_requests(self):
+        """It should Sample the stacks of requests into collapsed stacks"""
+        profiler = Profiler(self.directory, mode="sample", sample_interval=0.001)
+        profiler.start()
+        token = profiler.begin()
+        busy(0.1)
+        profiler.end(token)
+        profiler.stop()
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(".collapsed"))
+        with open(os.path.join(self.directory, files[0]), encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertIn("busy (test_profiling.py:", stack.split(";")[-1])
+        self.assertGreater(int(count), 1)
+
+    def test_sampling_rate(self):
+        """It should Share the sampling rate of every worker in Redis"""
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+        profiler = Profiler(self.directory, redis_fn=lambda: Counter.redis)
+        other = Profiler(self.directory, redis_fn=lambda: Counter.redis)
+        self.assertFalse(profiler.should_profile())
+        profiler.set_rate(1)
+        self.assertTrue(profiler.should_profile())
+        self.assertEqual(Counter.redis.get(RATE_KEY), "1.0")
+        other.refresh_rate()
+        self.assertEqual(other.rate, 1.0)
+        Counter.redis.delete(RATE_KEY)
+        other.refresh_rate()
+        self.assertEqual(other.rate, 1.0)
+        for rate in ["foo", -0.1, 2, "nan"]:
+            self.assertRaises(ValueError, check_rate, rate)
+        self.assertRaises(ValueError, Profiler, self.directory, mode="perf")
+        local = Profiler(self.directory, 0.5)
+        local.set_rate(0.25)
+        local.refresh_rate()
+        self.assertEqual(local.rate, 0.25)
+
+    def test_write_in_background(self):
+        """It should Refresh the rate and write the profiles from a thread"""
+        profiler = Profiler(self.directory, interval=0, redis_fn=lambda: None)
+        with patch.object(profiling, "RATE_REFRESH", 0.01):
+            profiler.start()
+            profiler.end(profiler.begin())
+            time.sleep(0.1)
+            with patch.object(profiler, "write", side_effect=OSError("disk full")):
+                time.sleep(0.05)
+            profiler.stop()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_one_fork_hook(self):
+        """It should Reset every live profiler from one fork hook"""
+        gc.collect()
+        live = len(profiling._profilers)
+        profiler = Profiler(self.directory)
+        self.assertIn(profiler, profiling._profilers)
+        with patch.object(Profiler, "_after_fork") as after_fork:
+            profiling._after_fork()
+        after_fork.assert_called()
+        del profiler
+        gc.collect()
+        self.assertEqual(len(profiling._profilers), live)
+
+    def test_after_fork(self):
+        """It should Give a forked worker empty profiles and threads of its own"""
+        profiler = Profiler(self.directory, mode="sample")
+        profiler.begin()
+        profiler._after_fork()
+        self.assertEqual(profiler.status()["pending"], 0)
+        self.assertEqual(profiler._threads, [])
+        profiler.start()
+        profiler._after_fork()
+        self.assertEqual(len(profiler._threads), 2)
+        profiler.stop()
+
+    def test_one_profiler_at_a_time(self):
+        """It should Skip a request when the interpreter is already profiling"""
+        profiler = Profiler(self.directory)
+        with patch("cProfile.Profile.enable", side_effect=ValueError()):
+            self.assertIsNone(profiler.begin())
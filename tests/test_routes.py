@@ -20,13 +20,21 @@ Test cases can be run with the following:
   nosetests -v --with-spec --spec-color
   coverage report -m
 """
+import io
 import os
+import csv
+import json
 import logging
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch
+from redis.exceptions import ConnectionError as RedisConnectionError
 from wsgi import app
 from service.models import Counter, DatabaseConnectionError
 from service.common import status
+from service.common.admission import AdmissionController
+from service.common.circuit_breaker import breaker_options
+from service.common.profiling import Profiler
 
 # logging.disable(logging.CRITICAL)
 
@@ -67,6 +75,66 @@ class ServiceTest(TestCase):
         resp = self.app.get("/")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_metrics(self):
+        """It should Count requests, errors and Redis commands for GET /metrics"""
+        self.app.post("/counters/foo")
+        self.app.get("/counters/bar")
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        data = resp.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="POST",route="/counters/<name>",status="201"}', data)
+        self.assertIn('http_request_duration_seconds_bucket{le="0.005",method="GET",route="/counters/<name>"}', data)
+        self.assertIn('http_errors_total{handler="not_found"}', data)
+        self.assertIn('redis_commands_total{command="EVALSHA"}', data)
+        self.assertIn("redis_pool_connections_in_use", data)
+
+    def test_profiling(self):
+        """It should Profile requests and change the sampling rate for admins"""
+        resp = self.app.get("/admin/profiling")
+        self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        profiler = Profiler(tempfile.mkdtemp(), redis_fn=lambda: Counter.redis)
+        admin = {"Authorization": "Bearer secret"}
+        with patch.dict(app.extensions, {"profiler": profiler}), patch.dict(app.config, {"PROFILE_TOKEN": "secret"}):
+            resp = self.app.get("/admin/profiling")
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+            resp = self.app.get("/admin/profiling", headers={"Authorization": "Bearer wrong"})
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+            resp = self.app.get("/admin/profiling", headers=admin)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["rate"], 0.0)
+            self.app.get("/counters", headers={"X-Profile": "secret"})
+            self.app.get("/counters", headers={"X-Profile": "wrong"})
+            self.assertEqual(profiler.status()["pending"], 1)
+            for body in [{"rate": 2}, {"rate": "foo"}, {"rate": True}, {"rate": None}, {}, []]:
+                resp = self.app.put("/admin/profiling", json=body, headers=admin)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+            resp = self.app.put("/admin/profiling", json={"rate": 1}, headers=admin)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["rate"], 1.0)
+            self.app.get("/counters")
+            self.assertEqual(profiler.status()["pending"], 2)
+            with patch.object(Counter.redis, "set", side_effect=ConnectionError()):
+                resp = self.app.put("/admin/profiling", json={"rate": 0}, headers=admin)
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertTrue(profiler.write().endswith(".pstats"))
+
+    def test_redis_round_trips(self):
+        """It should Send the Redis round trips of each request in a Server-Timing header"""
+        resp = self.app.post("/counters/foo")
+        self.assertNotIn("Server-Timing", resp.headers)
+        with patch.dict(app.config, {"REDIS_TRACING": True, "REDIS_TRACE_LOG": True}):
+            for method, url, round_trips in [
+                ("GET", "/counters/foo", 1),
+                ("PUT", "/counters/foo", 1),
+                ("GET", "/counters", 3),
+                ("GET", "/counters/_top", 1),
+                ("DELETE", "/counters/foo", 1),
+                ("GET", "/", 0),
+            ]:
+                resp = self.app.open(url, method=method)
+                self.assertIn(f'desc="round trips: {round_trips}, ', resp.headers["Server-Timing"], url)
+
     def test_create_counter(self):
         """It should Create a counter"""
         resp = self.app.post("/counters/foo")
@@ -81,6 +149,21 @@ class ServiceTest(TestCase):
         resp = self.app.post("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
 
+    def test_create_striped_counter(self):
+        """It should Create a striped counter that reads as one value"""
+        resp = self.app.post("/counters/hot", query_string={"stripes": 4})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json(), {"name": "hot", "counter": 0})
+        for _ in range(5):
+            resp = self.app.put("/counters/hot")
+        self.assertEqual(resp.get_json(), {"name": "hot", "counter": 5})
+        resp = self.app.get("/counters/hot")
+        self.assertEqual(resp.get_json(), {"name": "hot", "counter": 5})
+        resp = self.app.get("/counters")
+        self.assertEqual(resp.get_json(), [{"name": "hot", "counter": 5}])
+        resp = self.app.post("/counters/hot", query_string={"stripes": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_list_counters(self):
         """It should Get multiple counters"""
         resp = self.app.post("/counters/foo")
@@ -92,6 +175,324 @@ class ServiceTest(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 2)
 
+    def test_conditional_get(self):
+        """It should Answer If-None-Match with 304 until the counter or listing changes"""
+        self.app.post("/counters/foo")
+        for url in ["/counters/foo", "/counters"]:
+            resp = self.app.get(url)
+            etag = resp.headers["ETag"]
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED, url)
+            self.assertEqual(resp.headers["ETag"], etag)
+            self.assertEqual(resp.get_data(), b"")
+            self.app.put("/counters/foo")
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK, url)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+        with patch.dict(app.config, {"REDIS_TRACING": True}):
+            resp = self.app.get("/counters", headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn('desc="round trips: 1, ', resp.headers["Server-Timing"])
+
+    def test_list_counters_in_pages(self):
+        """It should Get counters one page at a time"""
+        for i in range(15):
+            resp = self.app.post(f"/counters/foo{i}")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        names = []
+        resp = self.app.get("/counters", query_string={"limit": 5})
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            names.extend(counter["name"] for counter in resp.get_json())
+            if "Link" not in resp.headers:
+                break
+            next_url = resp.headers["Link"].split(";")[0].strip("<>")
+            self.assertIn("limit=5", next_url)
+            resp = self.app.get(next_url)
+        self.assertEqual(names, sorted(f"foo{i}" for i in range(15)))
+
+    def test_list_counters_by_prefix(self):
+        """It should List only the counters whose names start with a prefix"""
+        for name in ["foo", "foo1", "foo2", "food", "fop", "bar"]:
+            Counter.create(name)
+        Counter.redis.set("other", "not a counter")
+        resp = self.app.get("/counters", query_string={"prefix": "foo", "limit": 2})
+        self.assertEqual([counter["name"] for counter in resp.get_json()], ["foo", "foo1"])
+        next_url = resp.headers["Link"].split(";")[0].strip("<>")
+        self.assertIn("prefix=foo", next_url)
+        resp = self.app.get(next_url)
+        self.assertEqual([counter["name"] for counter in resp.get_json()], ["foo2", "food"])
+        resp = self.app.get("/counters", query_string={"prefix": "foo", "after": "foo2"})
+        self.assertEqual([counter["name"] for counter in resp.get_json()], ["food"])
+        self.assertNotIn("Link", resp.headers)
+        resp = self.app.get("/counters")
+        self.assertEqual(len(resp.get_json()), 6)
+
+    def test_top_counters(self):
+        """It should List the highest counters from the highest down"""
+        for i in range(15):
+            Counter.create(f"foo{i}", i)
+        resp = self.app.get("/counters/_top", query_string={"k": 3})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"name": f"foo{i}", "counter": i} for i in (14, 13, 12)])
+        self.assertEqual(len(self.app.get("/counters/_top").get_json()), 10)
+        resp = self.app.get("/counters/_top", query_string={"k": app.config["COUNTERS_TOP_SIZE"] + 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch("service.models.Counter.rates", True)
+    def test_rate_of_counter(self):
+        """It should Count the increments of a counter in a window of time"""
+        self.app.post("/counters/foo")
+        for _ in range(3):
+            self.app.put("/counters/foo")
+        resp = self.app.get("/counters/foo/rate", query_string={"window": "5m"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"name": "foo", "window": 300, "count": 3, "per_second": 0.01})
+        self.assertEqual(self.app.get("/counters/foo/rate").get_json()["window"], 60)
+        resp = self.app.get("/counters/foo/rate", query_string={"window": "1w"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/counters/bar/rate")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rate_not_kept(self):
+        """It should not Count increments in windows when rates are not kept"""
+        self.app.post("/counters/foo")
+        resp = self.app.get("/counters/foo/rate")
+        self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    def test_stream_counter_events(self):
+        """It should Stream the changes of a counter as Server-Sent Events"""
+        resp = self.app.get("/counters/foo/events")
+        self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        Counter.create("foo", 1)
+        Counter.enable_events("test:changes")
+        try:
+            self.assertTrue(Counter.listener.wait_until_subscribed(2))
+            with patch.dict(app.config, {"EVENTS_WINDOW": 0.05, "EVENTS_KEEPALIVE": 0.05}):
+                resp = self.app.get("/counters/bar/events")
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+                resp = self.app.get("/counters/foo/events")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.mimetype, "text/event-stream")
+                events = iter(resp.response)
+                self.assertEqual(next(events), b'event: counter\ndata: {"name": "foo", "counter": 1}\n\n')
+                self.assertEqual(next(events), b": keepalive\n\n")
+                for _ in range(3):
+                    Counter.increment_existing("foo")
+                self.assertEqual(next(events), b'event: counter\ndata: {"name": "foo", "counter": 4}\n\n')
+                Counter.events.reset()
+                self.assertIn(b'"counter": 4', next(events))
+                self.assertEqual(len(Counter.events), 1)
+                resp.close()
+                self.assertEqual(len(Counter.events), 0)
+        finally:
+            Counter.disable_events()
+        self.assertIsNone(Counter.events)
+
+    def test_stream_many_counters(self):
+        """It should Stream the changes of many counters"""
+        Counter.create("foo", 1)
+        Counter.enable_events("test:changes")
+        try:
+            self.assertTrue(Counter.listener.wait_until_subscribed(2))
+            resp = self.app.get("/counters/_events", query_string={"name": ["foo", "bar"]})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            events = iter(resp.response)
+            self.assertEqual(
+                next(events),
+                b'event: counter\ndata: {"name": "foo", "counter": 1}\n\n'
+                b'event: counter\ndata: {"name": "bar", "counter": null}\n\n',
+            )
+            Counter.create("bar", 5)
+            self.assertEqual(next(events), b'event: counter\ndata: {"name": "bar", "counter": 5}\n\n')
+            Counter.remove("foo")
+            self.assertEqual(next(events), b'event: counter\ndata: {"name": "foo", "counter": null}\n\n')
+            resp.close()
+            resp = self.app.get("/counters/_events")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            with patch.object(Counter.redis, "pipeline", side_effect=DatabaseConnectionError()):
+                resp = self.app.get("/counters/_events", query_string={"name": "foo"})
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(len(Counter.events), 0)
+        finally:
+            Counter.disable_events()
+
+    def test_limit_open_streams(self):
+        """It should Turn a stream away when the worker already has EVENTS_MAX_STREAMS open"""
+        Counter.create("foo", 1)
+        Counter.enable_events("test:changes")
+        try:
+            with patch.dict(app.config, {"EVENTS_MAX_STREAMS": 1, "EVENTS_RETRY_AFTER": 7}):
+                first = self.app.get("/counters/foo/events")
+                self.assertEqual(first.status_code, status.HTTP_200_OK)
+                resp = self.app.get("/counters/_events", query_string={"name": "foo"})
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+                self.assertEqual(resp.headers["Retry-After"], "7")
+                self.assertEqual(len(Counter.events), 1)
+                first.close()
+                resp = self.app.get("/counters/_events", query_string={"name": "foo"})
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                resp.close()
+        finally:
+            Counter.disable_events()
+
+    def test_unique_counters(self):
+        """It should Add items to, Merge, Read and Delete unique counters"""
+        resp = self.app.post("/counters/_unique/monday", json={"items": ["a", "b", "a"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"name": "monday", "type": "unique", "estimate": 2, "error": 1})
+        self.app.post("/counters/_unique/tuesday", json={"items": ["b", "c"]})
+        resp = self.app.post("/counters/_unique/week/_merge", json={"sources": ["monday", "tuesday"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["estimate"], 3)
+        resp = self.app.post("/counters/_unique/week/_merge", json={"sources": ["sunday"]})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post("/counters/_unique/week/_merge", json={"sources": []})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/_unique/monday", json={"items": [1]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/_unique/monday", data="a", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertEqual(self.app.get("/counters/_unique/week").get_json()["estimate"], 3)
+        resp = self.app.delete("/counters/_unique/week")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("/counters/_unique/week")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_frequency_sketches(self):
+        """It should Create, Add items to, Read and Delete frequency sketches"""
+        resp = self.app.post("/counters/_frequency/pages", query_string={"error": "0.01", "confidence": "0.99"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn("/counters/_frequency/pages", resp.headers["Location"])
+        self.assertEqual(
+            resp.get_json(),
+            {"name": "pages", "type": "frequency", "total": 0, "width": 272, "depth": 5, "error": 0, "confidence": 0.9933},
+        )
+        resp = self.app.post("/counters/_frequency/pages")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.post("/counters/_frequency/books", query_string={"error": "0"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("/counters/_frequency/pages", json={"items": {"home": 3, "about": 1}})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["total"], 4)
+        self.assertGreaterEqual(resp.get_json()["estimates"]["home"], 3)
+        resp = self.app.put("/counters/_frequency/pages", json={"items": ["home", "home"]})
+        self.assertGreaterEqual(resp.get_json()["estimates"]["home"], 5)
+        resp = self.app.put("/counters/_frequency/pages", json={"items": {"home": -1}})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("/counters/_frequency/books", json={"items": ["home"]})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/counters/_frequency/pages", query_string={"item": ["home", "about"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["total"], 6)
+        self.assertEqual(sorted(resp.get_json()["estimates"]), ["about", "home"])
+        resp = self.app.delete("/counters/_frequency/pages")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("/counters/_frequency/pages")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_counters_bad_arguments(self):
+        """It should not List counters with a bad limit"""
+        resp = self.app.get("/counters", query_string={"limit": "foo"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["error"], "Bad Request")
+        resp = self.app.get("/counters", query_string={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/counters", query_string={"limit": 1000000})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_counters_as_ndjson(self):
+        """It should Stream all of the counters as NDJSON"""
+        for i in range(25):
+            Counter.create(f"foo{i}", i)
+        resp = self.app.get("/counters/_export", query_string={"limit": 10})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIn("counters.ndjson", resp.headers["Content-Disposition"])
+        counters = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertCountEqual(counters, [{"name": f"foo{i}", "counter": i} for i in range(25)])
+
+    def test_export_counters_as_csv(self):
+        """It should Stream all of the counters as CSV"""
+        Counter.create("foo", 3)
+        Counter.create("a,b", 4)
+        resp = self.app.get("/counters/_export", query_string={"format": "csv"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.reader(resp.get_data(as_text=True).splitlines()))
+        self.assertEqual(rows[0], ["name", "counter"])
+        self.assertCountEqual(rows[1:], [["foo", "3"], ["a,b", "4"]])
+
+    def test_export_no_counters(self):
+        """It should Export an empty keyspace"""
+        resp = self.app.get("/counters/_export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_data(as_text=True), "")
+        resp = self.app.get("/counters/_export", query_string={"format": "xml"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_counters_as_ndjson(self):
+        """It should Import a stream of NDJSON counters in batches"""
+        Counter.create("foo1", 10)
+        lines = [json.dumps({"name": f"foo{i}", "counter": i}) for i in range(25)]
+        lines += ["", "not json", "[1]", '{"name": "bad", "counter": "1"}', '{"name": "a/b", "counter": 1}']
+        body = ("\n".join(lines) + "\n").encode()
+        resp = self.app.post(
+            "/counters/_import",
+            input_stream=io.BytesIO(body),
+            content_type="application/x-ndjson",
+            query_string={"batch_size": 10},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["lines"], data["imported"], data["skipped"], data["failed"]), (30, 24, 1, 4))
+        self.assertEqual([error["line"] for error in data["errors"]], [27, 28, 29, 30])
+        self.assertGreaterEqual(data["counters_per_second"], 0)
+        self.assertEqual(Counter.find("foo1").serialize()["counter"], 10)
+        self.assertEqual(Counter.find("foo24").serialize()["counter"], 24)
+
+    def test_import_counters_as_csv(self):
+        """It should Import an export of CSV counters overwriting the ones that exist"""
+        Counter.create("foo", 10)
+        body = "name,counter\r\nfoo,3\r\n\"a,b\",4\r\nbar\r\nbaz,x\r\nlast,5".encode()
+        resp = self.app.post(
+            "/counters/_import",
+            data=body,
+            content_type="text/csv",
+            query_string={"mode": "overwrite"},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["lines"], data["imported"], data["failed"]), (6, 3, 2))
+        self.assertEqual(Counter.find("foo").serialize()["counter"], 3)
+        self.assertEqual(Counter.find("a,b").serialize()["counter"], 4)
+        self.assertEqual(Counter.find("last").serialize()["counter"], 5)
+
+    def test_import_values_out_of_range(self):
+        """It should not Import counters that do not fit in a signed 64 bit integer"""
+        for content_type, body, counts in [
+            ("text/csv", f"big,{10**23}\nsmall,{-2**63 - 1}\nlargest,{2**63 - 1}\n", (1, 2)),
+            ("application/x-ndjson", json.dumps({"name": "big", "counter": 10**23}) + "\n", (0, 1)),
+        ]:
+            resp = self.app.post("/counters/_import", data=body.encode(), content_type=content_type)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertEqual((data["imported"], data["failed"]), counts)
+            self.assertIn("between", data["errors"][0]["error"])
+        self.assertEqual(Counter.find("largest").serialize()["counter"], 2**63 - 1)
+        self.assertIsNone(Counter.find("big"))
+        self.assertEqual(self.app.get("/counters").status_code, status.HTTP_200_OK)
+
+    def test_import_bad_requests(self):
+        """It should not Import a body of the wrong type or with a bad mode"""
+        resp = self.app.post("/counters/_import", json=[])
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.post("/counters/_import", data="", content_type="text/csv", query_string={"mode": "merge"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/_import", data="", content_type="text/csv", query_string={"batch_size": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_counter(self):
         """It should Get a counter"""
         self.test_create_counter()
@@ -129,6 +530,78 @@ class ServiceTest(TestCase):
         self.test_create_counter()
         resp = self.app.delete("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.delete("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_batch_operations(self):
+        """It should Run a batch of counter operations"""
+        self.test_create_counter()
+        operations = [
+            {"op": "create", "name": "bar", "value": 5},
+            {"op": "create", "name": "foo"},
+            {"op": "increment", "name": "bar", "amount": 3},
+            {"op": "increment", "name": "baz"},
+            {"op": "read", "name": "bar"},
+            {"op": "read", "name": "baz"},
+            {"op": "delete", "name": "foo"},
+            {"op": "reset", "name": "foo"},
+            {"op": "read"},
+            {"op": "increment", "name": "bar", "amount": "3"},
+            "foo",
+        ]
+        resp = self.app.post("/counters/_batch", json=operations)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), len(operations))
+        self.assertEqual(
+            [result["status"] for result in data],
+            [201, 409, 200, 404, 200, 404, 204, 400, 400, 400, 400],
+        )
+        self.assertEqual(data[0]["counter"], 5)
+        self.assertEqual(data[2]["counter"], 8)
+        self.assertEqual(data[4]["counter"], 8)
+        resp = self.app.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_batch_bad_requests(self):
+        """It should not Run a batch that is not a list of operations"""
+        resp = self.app.post("/counters/_batch", data="foo", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.post("/counters/_batch", json={"op": "read", "name": "foo"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        too_many = [{"op": "read", "name": "foo"}] * (app.config["BATCH_MAX_OPERATIONS"] + 1)
+        resp = self.app.post("/counters/_batch", json=too_many)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_rejects_key_names(self):
+        """It should not Run batch operations on names with a '/' that are not counters"""
+        self.app.post("/counters/hot", query_string={"stripes": 4})
+        names = ["hot/0", "counters/generation", "counters/index", "counters/bucket/3", "a/b"]
+        operations = [{"op": op, "name": name} for op in ["create", "increment", "delete"] for name in names]
+        resp = self.app.post("/counters/_batch", json=operations)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        for result in resp.get_json():
+            self.assertEqual(result["status"], status.HTTP_400_BAD_REQUEST)
+            self.assertIn("without a '/'", result["error"])
+        self.assertEqual(self.app.get("/counters/hot").get_json()["counter"], 0)
+        self.assertEqual([counter["name"] for counter in self.app.get("/counters").get_json()], ["hot"])
+
+    def test_batch_values_out_of_range(self):
+        """It should not Queue batch operations with a value outside the signed 64 bit range"""
+        operations = [
+            {"op": "create", "name": "x", "value": 2**64 - 1},
+            {"op": "create", "name": "y", "value": -2**63},
+            {"op": "increment", "name": "y", "amount": 2**63},
+        ]
+        resp = self.app.post("/counters/_batch", json=operations)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual([result["status"] for result in results], [400, 201, 400])
+        self.assertIn("between", results[0]["error"])
+        self.assertEqual(self.app.get("/counters/x").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.app.get("/counters/y").get_json()["counter"], -2**63)
 
     def test_method_not_allowed(self):
         """It should not allow usuported Methods"""
@@ -139,7 +612,7 @@ class ServiceTest(TestCase):
     #  T E S T   E R R O R   H A N D L E R S
     ######################################################################
 
-    @patch("service.routes.Counter.redis.get")
+    @patch("service.routes.Counter.redis.evalsha")
     def test_failed_get_request(self, redis_mock):
         """It should handle Error for failed GET"""
         redis_mock.return_value = 0
@@ -147,24 +620,85 @@ class ServiceTest(TestCase):
         resp = self.app.get("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    @patch("service.models.Counter.increment")
-    def test_failed_update_request(self, value_mock):
+    def test_shed_load(self):
+        """It should Turn requests away with Retry-After once their route class is at its limit"""
+        admission = AdmissionController({"read": 1}, max_queue=0)
+        app.extensions["admission"] = admission
+        try:
+            self.assertTrue(admission.admit("read"))
+            resp = self.app.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers["Retry-After"], str(app.config["ADMISSION_RETRY_AFTER"]))
+            self.assertEqual(self.app.get("/").status_code, status.HTTP_200_OK)
+            self.assertEqual(self.app.post("/counters/foo").status_code, status.HTTP_201_CREATED)
+            admission.release("read")
+            self.assertEqual(self.app.get("/counters/foo").status_code, status.HTTP_200_OK)
+            self.assertEqual(admission.status()["read"]["in_flight"], 0)
+        finally:
+            del app.extensions["admission"]
+
+    def test_export_holds_listing_slot(self):
+        """It should Keep the listing slot of an export until its last page is sent"""
+        for i in range(3):
+            Counter.create(f"foo{i}", i)
+        admission = AdmissionController({"listing": 1}, max_queue=0)
+        app.extensions["admission"] = admission
+        try:
+            resp = self.app.get("/counters/_export", query_string={"limit": 1})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            chunks = iter(resp.response)
+            next(chunks)
+            self.assertEqual(admission.status()["listing"]["in_flight"], 1)
+            busy = self.app.get("/counters/_export")
+            self.assertEqual(busy.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(len(b"".join(chunks).splitlines()), 3)
+            resp.close()
+            self.assertEqual(admission.status()["listing"]["in_flight"], 0)
+        finally:
+            del app.extensions["admission"]
+
+    def test_redis_outage(self):
+        """It should Serve stale reads and fail writes fast with Retry-After while Redis is down"""
+        Counter.enable_circuit_breaker(**breaker_options(app.config))
+        Counter.enable_stale_reads()
+        try:
+            self.app.post("/counters/foo")
+            etag = self.app.get("/counters/foo").headers["ETag"]
+            with patch("redis.Redis.execute_command", side_effect=RedisConnectionError()):
+                for _ in range(app.config["CIRCUIT_MIN_CALLS"]):
+                    resp = self.app.get("/counters/foo")
+                    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.get_json(), {"name": "foo", "counter": 0})
+                self.assertEqual(resp.headers["ETag"], etag)
+                self.assertEqual(resp.headers["Age"], "0")
+                self.assertEqual(resp.headers["Warning"], '110 - "Response is Stale"')
+                resp = self.app.put("/counters/foo")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+                self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+                resp = self.app.get("/counters/bar")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            Counter.disable_circuit_breaker()
+            Counter.disable_stale_reads()
+
+    def test_failed_update_request(self):
         """It should handle Error for failed UPDATE"""
-        value_mock.return_value = 0
-        value_mock.side_effect = DatabaseConnectionError()
         self.test_create_counter()
-        resp = self.app.put("/counters/foo")
-        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        with patch("service.routes.Counter.redis.evalsha") as redis_mock:
+            redis_mock.return_value = 0
+            redis_mock.side_effect = DatabaseConnectionError()
+            resp = self.app.put("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    @patch("service.models.Counter.__init__")
-    def test_failed_post_request(self, value_mock):
+    @patch("service.routes.Counter.redis.evalsha")
+    def test_failed_post_request(self, redis_mock):
         """It should handle Error for failed POST"""
-        value_mock.return_value = 0
-        value_mock.side_effect = DatabaseConnectionError()
+        redis_mock.return_value = 0
+        redis_mock.side_effect = DatabaseConnectionError()
         resp = self.app.post("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    @patch("service.routes.Counter.redis.keys")
+    @patch("service.routes.Counter.redis.zrangebylex")
     def test_failed_list_request(self, redis_mock):
         """It should handle Error for failed LIST"""
         redis_mock.return_value = 0
@@ -172,10 +706,24 @@ class ServiceTest(TestCase):
         resp = self.app.get("/counters")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
+    @patch("service.routes.Counter.redis.zrangebylex")
+    def test_failed_export_request(self, redis_mock):
+        """It should handle Error for failed EXPORT"""
+        redis_mock.side_effect = Exception()
+        resp = self.app.get("/counters/_export")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @patch("service.routes.Counter.redis.pipeline")
+    def test_failed_batch_request(self, redis_mock):
+        """It should handle Error for failed BATCH"""
+        redis_mock.side_effect = DatabaseConnectionError()
+        resp = self.app.post("/counters/_batch", json=[{"op": "read", "name": "foo"}])
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
     def test_failed_delete_request(self):
         """It should handle Error for failed DELETE"""
         self.test_create_counter()
-        with patch("service.routes.Counter.redis.get") as redis_mock:
+        with patch("service.routes.Counter.redis.evalsha") as redis_mock:
             redis_mock.return_value = 0
             redis_mock.side_effect = DatabaseConnectionError()
             resp = self.app.delete("/counters/foo")
@@ -0,0 +1,379 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for consistent hash sharding
+
+The shards are separate databases of the test Redis server so that the
+tests run without starting more redis-server processes
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+from redis import Redis
+from service.common.sharding import HashRing, ShardedRedis, AsyncShardedRedis, split_uris, move_key
+from service.async_models import AsyncCounter
+from service.common.sketches import unique_key
+from service.sketch_models import UniqueCounter, FrequencySketch, AsyncUniqueCounter, AsyncFrequencySketch
+from service.models import Counter, NODE_KEYS, INDEX_KEY, TOP_KEY, stripe_keys, script_keys, script_args
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+def shard_uris(count: int) -> list:
+    """Returns the uris of databases 1 to count of the test Redis server"""
+    return [urlparse(DATABASE_URI)._replace(path=f"/{number}").geturl() for number in range(1, count + 1)]
+
+
+def node_keys(uri: str) -> set:
+    """Returns every key stored on one shard"""
+    client = Redis.from_url(uri, decode_responses=True)
+    try:
+        return set(client.scan_iter())
+    finally:
+        client.close()
+
+
+######################################################################
+#  H A S H   R I N G   T E S T   C A S E S
+######################################################################
+class HashRingTests(TestCase):
+    """Consistent Hash Ring Tests"""
+
+    def test_split_uris(self):
+        """It should Split a list of uris"""
+        self.assertEqual(split_uris("redis://a, redis://b,"), ["redis://a", "redis://b"])
+        self.assertEqual(split_uris(["redis://a", ""]), ["redis://a"])
+
+    def test_spread_keys_evenly(self):
+        """It should Spread keys evenly over the nodes"""
+        ring = HashRing(["a", "b", "c"])
+        groups = ring.group([f"counter{i}" for i in range(3000)])
+        self.assertEqual(sorted(groups), [0, 1, 2])
+        for positions in groups.values():
+            self.assertGreater(len(positions), 700)
+            self.assertLess(len(positions), 1300)
+        self.assertEqual(HashRing(["a", "b", "c"]).node_for("foo"), ring.node_for("foo"))
+
+    def test_add_node_moves_few_keys(self):
+        """It should only move keys to a node that is added"""
+        keys = [f"counter{i}" for i in range(3000)]
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+        self.assertLess(len(moved), 1000)
+        self.assertTrue(all(after.node_for(key) == 3 for key in moved))
+
+
+######################################################################
+#  S H A R D E D   C O U N T E R   T E S T   C A S E S
+######################################################################
+class ShardedCounterTests(TestCase):
+    """Counter Model Tests with many shards"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(",".join(shard_uris(4)), virtual_nodes=64)
+        Counter.remove_all()
+        Counter.redis.close()
+        self.uris = shard_uris(3)
+        Counter.connect(",".join(self.uris), virtual_nodes=64)
+
+    def tearDown(self):
+        """This runs after each test"""
+        Counter.redis.close()
+        Counter.connect(DATABASE_URI)
+
+    def test_route_counters_to_shards(self):
+        """It should Store every counter on the shard that owns it"""
+        self.assertIsInstance(Counter.redis, ShardedRedis)
+        names = [f"counter{i}" for i in range(60)]
+        for name in names:
+            Counter.create(name, 1)
+        for node, uri in enumerate(self.uris):
+            keys = node_keys(uri) - set(NODE_KEYS)
+            self.assertTrue(keys)
+            self.assertTrue(all(Counter.redis.ring.node_for(key) == node for key in keys))
+        self.assertEqual(Counter.increment_existing("counter7", 2), 3)
+        self.assertEqual(Counter.find("counter7").serialize()["counter"], 3)
+        self.assertEqual([counter.name for counter in Counter.find_many(names)], names)
+        self.assertTrue(Counter.remove("counter7"))
+        self.assertIsNone(Counter.find("counter7"))
+        self.assertTrue(Counter.test_connection())
+        created = sum(client.connection_pool.created for client in Counter.redis.clients)
+        self.assertEqual(Counter.pool_stats()["created"], created)
+
+    def test_all_and_pages_across_shards(self):
+        """It should List the counters of every shard"""
+        names = {f"counter{i}" for i in range(40)}
+        for name in names:
+            Counter.create(name)
+        self.assertEqual({counter["name"] for counter in Counter.all()}, names)
+        found = []
+        after = None
+        while after != "":
+            after, page = Counter.page(after or "", limit=7)
+            found.extend(counter["name"] for counter in page)
+        self.assertEqual(found, sorted(names))
+        after, page = Counter.page(limit=3, prefix="counter1")
+        self.assertEqual([counter["name"] for counter in page], ["counter1", "counter10", "counter11"])
+        Counter.increment_existing("counter7", 5)
+        Counter.increment_existing("counter3", 2)
+        self.assertEqual([counter["name"] for counter in Counter.top(2)], ["counter7", "counter3"])
+        self.assertEqual(Counter.redis.zrevrange(TOP_KEY, 0, -1)[:2], ["counter7", "counter3"])
+        Counter.remove_all()
+        self.assertEqual(Counter.all(), [])
+
+    def test_batch_across_shards(self):
+        """It should Run a batch that touches every shard"""
+        operations = [("create", f"counter{i}", i) for i in range(20)]
+        operations += [("increment", f"counter{i}", 1) for i in range(20)]
+        operations += [("read", "missing", 0), ("delete", "counter0", 0)]
+        results = Counter.batch(operations)
+        self.assertEqual(results[20:40], list(range(1, 21)))
+        self.assertEqual(results[40:], [None, True])
+
+    def test_striped_counter_across_shards(self):
+        """It should Spread the stripes of a counter over the shards"""
+        Counter.create("hot", stripes=12)
+        for _ in range(10):
+            Counter.increment_existing("hot")
+        self.assertEqual(Counter.find("hot").serialize()["counter"], 10)
+        self.assertEqual(Counter.generation().count("."), 2)
+        generation, version = Counter.generation(), Counter.find("hot").version
+        Counter.increment_existing("hot")
+        self.assertNotEqual(Counter.generation(), generation)
+        self.assertNotEqual(Counter.find("hot").version, version)
+        shards = {Counter.redis.ring.node_for(key) for key in stripe_keys("hot", 12)}
+        self.assertGreater(len(shards), 1)
+        self.assertTrue(Counter.remove("hot"))
+        self.assertEqual(Counter.redis.exists(*stripe_keys("hot", 12)), 0)
+
+    def test_cache_across_shards(self):
+        """It should Invalidate cached counters changed on any shard"""
+        Counter.enable_cache(max_size=100, ttl=60, channel="test:changes")
+        try:
+            self.assertTrue(Counter.listener.wait_until_subscribed(2))
+            names = [f"counter{i}" for i in range(10)]
+            for name in names:
+                Counter.create(name)
+                Counter.find(name)
+            for name in names:
+                Counter.scripts["increment"](
+                    keys=script_keys("increment", name), args=script_args("increment", name, 1, "test:changes")
+                )
+            for _ in range(200):
+                if not Counter.cache.stats()["size"]:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(Counter.cache.stats()["size"], 0)
+        finally:
+            Counter.disable_cache()
+
+    def test_rebalance_after_adding_a_shard(self):
+        """It should Move counters to a shard that was added"""
+        names = [f"counter{i}" for i in range(60)]
+        for name in names:
+            Counter.create(name, 5)
+        Counter.redis.close()
+        Counter.connect(",".join(shard_uris(4)), virtual_nodes=64)
+        self.assertIn(None, Counter.find_many(names))
+        dry_run = Counter.rebalance(dry_run=True)
+        self.assertGreater(dry_run["moved"], 0)
+        totals = Counter.rebalance()
+        self.assertEqual((totals["moved"], totals["conflicts"]), (dry_run["moved"], 0))
+        self.assertNotIn(None, Counter.find_many(names))
+        self.assertEqual(Counter.rebalance()["moved"], 0)
+        self.assertTrue(node_keys(shard_uris(4)[3]))
+        self.assertEqual([counter["name"] for counter in Counter.all()], sorted(names))
+        for node, client in enumerate(Counter.redis.clients):
+            self.assertTrue(all(Counter.redis.ring.node_for(name) == node for name in client.zrange(INDEX_KEY, 0, -1)))
+
+    def test_rebalance_conflicts(self):
+        """It should not overwrite a counter that is already on its new shard"""
+        client = Counter.redis.client_for("foo")
+        other = next(c for c in Counter.redis.clients if c is not client)
+        client.set("foo", 1)
+        other.set("foo", 2)
+        self.assertEqual(Counter.rebalance(), {"scanned": 2, "moved": 0, "conflicts": 1})
+        self.assertEqual(Counter.find("foo").serialize()["counter"], 1)
+
+    def test_move_a_changing_key(self):
+        """It should Copy a key again when it changes while it is moved"""
+        source, target = Counter.redis.clients[:2]
+        source.set("foo", 1)
+        restore = target.restore
+
+        def change_then_restore(*args):
+            source.incr("foo")
+            return restore(*args)
+
+        with patch.object(target, "restore", side_effect=change_then_restore):
+            self.assertFalse(move_key(source, target, "foo", retries=1))
+        self.assertEqual(source.get("foo"), "2")
+        self.assertIsNone(target.get("foo"))
+        self.assertTrue(move_key(source, target, "foo"))
+        self.assertEqual(target.get("foo"), "2")
+        self.assertTrue(move_key(source, target, "foo"))
+
+    def test_buckets_across_shards(self):
+        """It should Keep counters in buckets on the shards that own them"""
+        Counter.buckets = 8
+        try:
+            Counter.redis.client_for("old").set("old", 5)
+            for i in range(20):
+                Counter.create(f"counter{i}", i)
+            Counter.create("hot", 1, stripes=6)
+            self.assertEqual(Counter.increment_existing("hot", 2), 3)
+            self.assertEqual(Counter.migrate_to_buckets(), {"scanned": 1, "moved": 1, "conflicts": 0})
+            for node, uri in enumerate(self.uris):
+                keys = node_keys(uri) - set(NODE_KEYS)
+                self.assertTrue(all(key.startswith("counters/bucket/") for key in keys))
+                self.assertTrue(all(Counter.redis.ring.node_for(key) == node for key in keys))
+            self.assertEqual(len(Counter.all()), 22)
+            self.assertEqual(Counter.find("old").serialize()["counter"], 5)
+            self.assertEqual([counter["name"] for counter in Counter.top(2)], ["counter19", "counter18"])
+            self.assertTrue(Counter.remove("hot"))
+            self.assertEqual(Counter.reindex(), {"indexed": 0, "removed": 0})
+        finally:
+            Counter.buckets = 0
+
+    @patch("service.models.Counter.rates", True)
+    def test_rates_across_shards(self):
+        """It should Keep the rollups of counters on the shards that own them"""
+        for i in range(10):
+            Counter.create(f"counter{i}")
+            Counter.increment_existing(f"counter{i}", i)
+        self.assertEqual([Counter.rate(f"counter{i}", 60) for i in range(10)], list(range(10)))
+        for node, uri in enumerate(self.uris):
+            keys = node_keys(uri) - set(NODE_KEYS)
+            self.assertTrue(all(Counter.redis.ring.node_for(key) == node for key in keys))
+
+    def test_sketches_across_shards(self):
+        """It should Merge unique counters and add to sketches on many shards"""
+        days = [f"day{i}" for i in range(6)]
+        for day, name in enumerate(days):
+            UniqueCounter.add(name, [f"user{i}" for i in range(day * 100, day * 100 + 200)])
+        self.assertGreater(len({Counter.redis.ring.node_for(unique_key(name)) for name in days}), 1)
+        self.assertAlmostEqual(UniqueCounter.merge("week", days).estimate, 700, delta=25)
+        merges = [threading.Thread(target=UniqueCounter.merge, args=(f"week{i % 2}", days)) for i in range(8)]
+        for merge in merges:
+            merge.start()
+        for merge in merges:
+            merge.join()
+        estimate = UniqueCounter.find("week").estimate
+        self.assertEqual([UniqueCounter.find(f"week{i}").estimate for i in range(2)], [estimate, estimate])
+        self.assertFalse([key for uri in self.uris for key in node_keys(uri) if "/merge/" in key])
+        FrequencySketch.create("pages", 272, 5)
+        self.assertEqual(FrequencySketch.add("pages", {f"page{i}": 1 for i in range(300)}).total, 300)
+        for node, uri in enumerate(self.uris):
+            keys = node_keys(uri) - set(NODE_KEYS)
+            self.assertTrue(all(Counter.redis.ring.node_for(key) == node for key in keys))
+        self.assertTrue(UniqueCounter.remove("week"))
+
+    def test_rebalance_without_shards(self):
+        """It should have nothing to rebalance with a single node"""
+        Counter.redis.close()
+        Counter.connect(DATABASE_URI)
+        self.assertEqual(Counter.rebalance(), {"scanned": 0, "moved": 0, "conflicts": 0})
+
+
+######################################################################
+#  A S Y N C   S H A R D E D   C O U N T E R   T E S T   C A S E S
+######################################################################
+class AsyncShardedCounterTests(IsolatedAsyncioTestCase):
+    """Asynchronous Counter Model Tests with many shards"""
+
+    async def asyncSetUp(self):
+        """This runs before each test"""
+        await AsyncCounter.connect(",".join(shard_uris(3)), virtual_nodes=64)
+        await AsyncCounter.remove_all()
+
+    async def asyncTearDown(self):
+        """This runs after each test"""
+        await AsyncCounter.disconnect()
+
+    async def test_counters_across_shards(self):
+        """It should Create, Read, Update, List and Delete counters on many shards"""
+        self.assertIsInstance(AsyncCounter.redis, AsyncShardedRedis)
+        names = {f"counter{i}" for i in range(30)}
+        for name in names:
+            await AsyncCounter.create(name)
+        self.assertEqual(await AsyncCounter.increment_existing("counter3", 4), 4)
+        self.assertEqual((await AsyncCounter.find("counter3")).count, 4)
+        self.assertEqual(await AsyncCounter.top(1), [{"name": "counter3", "counter": 4}])
+        self.assertEqual(await AsyncCounter.redis.zrevrange(TOP_KEY, 0, 0), ["counter3"])
+        self.assertEqual({counter["name"] for counter in await AsyncCounter.all()}, names)
+        found = []
+        after = None
+        while after != "":
+            after, page = await AsyncCounter.page(after or "", limit=8)
+            found.extend(counter["name"] for counter in page)
+        self.assertEqual(found, sorted(names))
+        self.assertTrue(await AsyncCounter.remove("counter3"))
+        self.assertTrue(await AsyncCounter.test_connection())
+
+    async def test_batch_and_stripes_across_shards(self):
+        """It should Run batches and striped counters on many shards"""
+        results = await AsyncCounter.batch([("create", f"counter{i}", i) for i in range(10)])
+        self.assertEqual(results, list(range(10)))
+        await AsyncCounter.create("hot", stripes=12)
+        for _ in range(5):
+            await AsyncCounter.increment_existing("hot")
+        self.assertEqual((await AsyncCounter.find("hot")).count, 5)
+        generation = await AsyncCounter.generation()
+        self.assertEqual(generation.count("."), 2)
+        await AsyncCounter.increment_existing("hot")
+        self.assertNotEqual(await AsyncCounter.generation(), generation)
+        self.assertTrue(await AsyncCounter.remove("hot"))
+        self.assertEqual(await AsyncCounter.redis.exists(*stripe_keys("hot", 12)), 0)
+
+    async def test_sketches_across_shards(self):
+        """It should Merge unique counters on many shards"""
+        days = [f"day{i}" for i in range(6)]
+        for day, name in enumerate(days):
+            await AsyncUniqueCounter.add(name, [f"user{i}" for i in range(day * 100, day * 100 + 200)])
+        self.assertAlmostEqual((await AsyncUniqueCounter.merge("week", days)).estimate, 700, delta=25)
+        self.assertFalse([key for uri in shard_uris(3) for key in node_keys(uri) if "/merge/" in key])
+        await AsyncFrequencySketch.create("pages", 272, 5)
+        self.assertEqual((await AsyncFrequencySketch.add("pages", {"a": 2, "b": 1})).total, 3)
+
+    async def test_buckets_across_shards(self):
+        """It should Keep counters in buckets on many shards"""
+        AsyncCounter.buckets = 8
+        try:
+            results = await AsyncCounter.batch([("create", f"counter{i}", i) for i in range(10)])
+            self.assertEqual(results, list(range(10)))
+            self.assertEqual(await AsyncCounter.import_counters([("counter1", 7)], overwrite=True), [True])
+            await AsyncCounter.create("hot", 2, stripes=4)
+            self.assertEqual(await AsyncCounter.increment_existing("hot"), 3)
+            self.assertEqual((await AsyncCounter.find("counter1")).count, 7)
+            self.assertEqual(len(await AsyncCounter.all()), 11)
+            self.assertTrue(await AsyncCounter.remove("hot"))
+            self.assertIsNone(await AsyncCounter.find("hot"))
+            self.assertEqual(await AsyncCounter.redis.exists("counter1", *stripe_keys("hot", 4)), 0)
+        finally:
+            AsyncCounter.buckets = 0
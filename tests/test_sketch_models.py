@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Unique Counter and Frequency Sketch Models
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import logging
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.common.helpers import parse_items, parse_item_counts, parse_sources
+from service.common.sketches import sketch_dimensions, sketch_key, chunks
+from service.async_models import AsyncCounter
+from service.models import Counter, DatabaseConnectionError
+from service.sketch_models import UniqueCounter, FrequencySketch, AsyncUniqueCounter, AsyncFrequencySketch
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class SketchTests(TestCase):
+    """Unique Counter and Frequency Sketch Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+
+    def test_unique_counter(self):
+        """It should Estimate the number of distinct items"""
+        counter = UniqueCounter.add("visitors", [f"user{i}" for i in range(1000)] * 2)
+        self.assertAlmostEqual(counter.estimate, 1000, delta=30)
+        data = UniqueCounter.find("visitors").serialize()
+        self.assertEqual(data["type"], "unique")
+        self.assertEqual(data["estimate"], counter.estimate)
+        self.assertEqual(data["error"], 9)
+        self.assertIsNone(UniqueCounter.find("nobody"))
+        self.assertTrue(UniqueCounter.remove("visitors"))
+        self.assertFalse(UniqueCounter.remove("visitors"))
+
+    def test_merge_unique_counters(self):
+        """It should Merge unique counters into one"""
+        UniqueCounter.add("monday", [f"user{i}" for i in range(600)])
+        UniqueCounter.add("tuesday", [f"user{i}" for i in range(400, 1000)])
+        counter = UniqueCounter.merge("week", ["monday", "tuesday"])
+        self.assertAlmostEqual(counter.estimate, 1000, delta=30)
+        self.assertIsNone(UniqueCounter.merge("week", ["monday", "sunday"]))
+
+    def test_frequency_sketch(self):
+        """It should Estimate the counts of items that were added"""
+        width, depth = sketch_dimensions(0.01, 0.99)
+        self.assertEqual((width, depth), (272, 5))
+        sketch = FrequencySketch.create("pages", width, depth)
+        self.assertEqual(sketch.serialize()["total"], 0)
+        self.assertIsNone(FrequencySketch.create("pages", width, depth))
+        items = {f"page{i}": 1 for i in range(500)}
+        items["home"] = 5000
+        sketch = FrequencySketch.add("pages", items)
+        self.assertEqual(sketch.total, 5500)
+        self.assertGreaterEqual(sketch.estimates["home"], 5000)
+        data = FrequencySketch.find("pages", ["home", "page7", "missing"]).serialize()
+        self.assertEqual(data["type"], "frequency")
+        self.assertEqual(data["error"], 55)
+        self.assertEqual(data["confidence"], 0.9933)
+        self.assertLessEqual(data["estimates"]["home"], 5000 + data["error"])
+        self.assertGreaterEqual(data["estimates"]["page7"], 1)
+        self.assertEqual(FrequencySketch.add("pages", {}).total, 5500)
+        self.assertIsNone(FrequencySketch.add("books", {"a": 1}))
+        self.assertIsNone(FrequencySketch.find("books"))
+        self.assertEqual(Counter.redis.strlen(sketch_key("pages")), 4 * (4 + width * depth))
+        self.assertTrue(FrequencySketch.remove("pages"))
+        self.assertFalse(FrequencySketch.remove("pages"))
+
+    def test_sketch_counters_saturate(self):
+        """It should Stop the counters of a sketch at their largest value"""
+        FrequencySketch.create("hot", 100, 2)
+        FrequencySketch.add("hot", {"a": 2**32 - 1})
+        sketch = FrequencySketch.add("hot", {"a": 10})
+        self.assertEqual(sketch.estimates["a"], 2**32 - 1)
+        self.assertEqual(sketch.total, 2**32 + 9)
+
+    def test_sketch_dimensions(self):
+        """It should Size a sketch from its error bounds"""
+        self.assertEqual(sketch_dimensions("0.001", "0.99"), (2719, 5))
+        for error, confidence in [("foo", 0.9), (0.00001, 0.9), (1, 0.9), (0.1, 0), (0.1, 1), (0.1, "nan")]:
+            self.assertRaises(ValueError, sketch_dimensions, error, confidence)
+        self.assertEqual([len(chunk) for chunk in chunks({str(i): 1 for i in range(450)}, 5)], [200, 200, 50])
+
+    def test_parse_items(self):
+        """It should Check the items of a request body"""
+        self.assertEqual(parse_items({"items": ["a", "b"]}, 2), ["a", "b"])
+        self.assertEqual(parse_item_counts({"items": ["a", "b", "a"]}, 3), {"a": 2, "b": 1})
+        self.assertEqual(parse_item_counts({"items": {"a": 3}}, 3), {"a": 3})
+        self.assertEqual(parse_sources({"sources": ["a"]}, 1), ["a"])
+        for data in [None, [], {"items": "a"}, {"items": [1]}, {"items": ["a", "b", "c"]}]:
+            self.assertRaises(ValueError, parse_items, data, 2)
+        for data in [{"items": "a"}, {"items": {"a": 0}}, {"items": {"a": True}}, {"items": {"a": 1, "b": 1, "c": 1}}]:
+            self.assertRaises(ValueError, parse_item_counts, data, 2)
+        for data in [{"sources": []}, {"sources": "a"}, {"sources": ["a", "b"]}]:
+            self.assertRaises(ValueError, parse_sources, data, 1)
+
+    def test_sketch_connection_errors(self):
+        """It should Raise a DatabaseConnectionError when Redis is down"""
+        redis = Counter.redis
+        with patch.object(redis, "pipeline", side_effect=RedisConnectionError()), \
+                patch.object(redis, "delete", side_effect=RedisConnectionError()), \
+                patch.object(redis, "exists", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, UniqueCounter.add, "foo", ["a"])
+            self.assertRaises(DatabaseConnectionError, UniqueCounter.find, "foo")
+            self.assertRaises(DatabaseConnectionError, UniqueCounter.merge, "foo", ["bar"])
+            self.assertRaises(DatabaseConnectionError, UniqueCounter.remove, "foo")
+            self.assertRaises(DatabaseConnectionError, FrequencySketch.remove, "foo")
+        FrequencySketch.create("foo", 10, 2)
+        with patch.dict(Counter.scripts, {"sketch_create": None, "sketch_read": None}):
+            self.assertRaises(DatabaseConnectionError, FrequencySketch.create, "bar", 10, 2)
+            self.assertRaises(DatabaseConnectionError, FrequencySketch.find, "foo")
+        with patch.dict(Counter.scripts, {"sketch_add": None}):
+            self.assertRaises(DatabaseConnectionError, FrequencySketch.add, "foo", {"a": 1})
+
+
+######################################################################
+#  A S Y N C   T E S T   C A S E S
+######################################################################
+class AsyncSketchTests(IsolatedAsyncioTestCase):
+    """Asynchronous Unique Counter and Frequency Sketch Tests"""
+
+    async def asyncSetUp(self):
+        """This runs before each test"""
+        await AsyncCounter.connect(DATABASE_URI)
+        await AsyncCounter.remove_all()
+
+    async def asyncTearDown(self):
+        """This runs after each test"""
+        await AsyncCounter.disconnect()
+
+    async def test_unique_counter(self):
+        """It should Estimate and merge distinct items"""
+        counter = await AsyncUniqueCounter.add("monday", [f"user{i}" for i in range(600)])
+        self.assertAlmostEqual(counter.estimate, 600, delta=20)
+        await AsyncUniqueCounter.add("tuesday", [f"user{i}" for i in range(400, 1000)])
+        counter = await AsyncUniqueCounter.merge("week", ["monday", "tuesday"])
+        self.assertAlmostEqual(counter.estimate, 1000, delta=30)
+        self.assertIsNone(await AsyncUniqueCounter.merge("week", ["sunday"]))
+        self.assertEqual((await AsyncUniqueCounter.find("week")).estimate, counter.estimate)
+        self.assertIsNone(await AsyncUniqueCounter.find("sunday"))
+        self.assertTrue(await AsyncUniqueCounter.remove("week"))
+
+    async def test_frequency_sketch(self):
+        """It should Estimate the counts of items"""
+        self.assertIsNotNone(await AsyncFrequencySketch.create("pages", 272, 5))
+        self.assertIsNone(await AsyncFrequencySketch.create("pages", 272, 5))
+        sketch = await AsyncFrequencySketch.add("pages", {f"page{i}": 2 for i in range(300)})
+        self.assertEqual(sketch.total, 600)
+        sketch = await AsyncFrequencySketch.find("pages", ["page1"])
+        self.assertGreaterEqual(sketch.estimates["page1"], 2)
+        self.assertIsNone(await AsyncFrequencySketch.add("books", {"a": 1}))
+        self.assertTrue(await AsyncFrequencySketch.remove("pages"))
+
+    async def test_sketch_connection_errors(self):
+        """It should Raise a DatabaseConnectionError when Redis is down"""
+        await AsyncFrequencySketch.create("foo", 10, 2)
+        with patch.dict(AsyncCounter.scripts, {"sketch_create": None, "sketch_read": None}):
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncFrequencySketch.create("bar", 10, 2)
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncFrequencySketch.find("foo")
+        with patch.dict(AsyncCounter.scripts, {"sketch_add": None}):
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncFrequencySketch.add("foo", {"a": 1})
+        redis = AsyncCounter.redis
+        with patch.object(redis, "pipeline", side_effect=RedisConnectionError()), \
+                patch.object(redis, "delete", side_effect=RedisConnectionError()), \
+                patch.object(redis, "exists", side_effect=RedisConnectionError()):
+            for call in [
+                AsyncUniqueCounter.add("foo", ["a"]),
+                AsyncUniqueCounter.find("foo"),
+                AsyncUniqueCounter.merge("foo", ["bar"]),
+                AsyncUniqueCounter.remove("foo"),
+                AsyncFrequencySketch.remove("foo"),
+            ]:
+                with self.assertRaises(DatabaseConnectionError):
+                    await call
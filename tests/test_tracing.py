@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Redis Tracing
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import logging
+from urllib.parse import urlparse
+from unittest import TestCase, IsolatedAsyncioTestCase
+from service.async_models import AsyncCounter
+from service.common.tracing import RedisTrace, current_trace, start_trace, stop_trace, trace_redis
+from service.models import Counter
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class RedisTraceTests(TestCase):
+    """Redis Tracing Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+
+    def test_trace_round_trips(self):
+        """It should Record every round trip and the commands it sent"""
+        Counter.create("foo")
+        with trace_redis() as trace:
+            self.assertIs(current_trace(), trace)
+            Counter.find("foo").increment()
+            with Counter.redis.pipeline() as pipe:
+                pipe.get("foo").get("bar").execute()
+        self.assertIsNone(current_trace())
+        self.assertEqual(len(trace.round_trips), 3)
+        self.assertEqual(trace.commands(), {"EVALSHA": 2, "GET": 2})
+        data = trace.serialize()
+        self.assertEqual(data["round_trips"], 3)
+        self.assertEqual([len(trip["commands"]) for trip in data["trace"]], [1, 1, 2])
+        self.assertTrue(trace.server_timing().startswith('redis;desc="round trips: 3, commands: 4";dur='))
+
+    def test_start_and_stop(self):
+        """It should Only trace between start and stop"""
+        Counter.create("foo")
+        trace = start_trace()
+        Counter.find("foo")
+        self.assertIs(stop_trace(), trace)
+        Counter.find("foo")
+        self.assertIsNone(stop_trace())
+        self.assertEqual(len(trace.round_trips), 1)
+        self.assertEqual(RedisTrace().server_timing(), 'redis;desc="round trips: 0, commands: 0";dur=0.000')
+
+    def test_trace_across_shards(self):
+        """It should Trace the commands that shards send on threads of their own"""
+        uris = [urlparse(DATABASE_URI)._replace(path=f"/{number}").geturl() for number in range(1, 4)]
+        Counter.connect(",".join(uris))
+        try:
+            Counter.remove_all()
+            for i in range(10):
+                Counter.create(f"foo{i}")
+            with trace_redis() as trace:
+                Counter.all()
+            self.assertGreaterEqual(len(trace.round_trips), 3)
+        finally:
+            Counter.remove_all()
+            Counter.connect(DATABASE_URI)
+
+
+class AsyncRedisTraceTests(IsolatedAsyncioTestCase):
+    """Asynchronous Redis Tracing Tests"""
+
+    async def asyncSetUp(self):
+        """This runs before each test"""
+        await AsyncCounter.connect(DATABASE_URI)
+        await AsyncCounter.remove_all()
+
+    async def asyncTearDown(self):
+        """This runs after each test"""
+        await AsyncCounter.disconnect()
+
+    async def test_trace_round_trips(self):
+        """It should Trace the commands of a task"""
+        await AsyncCounter.create("foo")
+        with trace_redis() as trace:
+            await AsyncCounter.find("foo")
+            await AsyncCounter.increment_existing("foo")
+        self.assertEqual(len(trace.round_trips), 2)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Write-Behind Buffer
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import time
+import logging
+import threading
+from unittest import TestCase
+from service.common import write_behind
+from service.common.write_behind import WriteBehindBuffer
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class WriteBehindBufferTests(TestCase):
+    """Write-Behind Buffer Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.flushed = []
+        self.fail = False
+        self.buffer = WriteBehindBuffer(self.flush_fn, interval=60, max_pending=5)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.fail = False
+        self.buffer.stop()
+
+    def flush_fn(self, pending):
+        """Records the flushed increments in place of a database"""
+        if self.fail:
+            raise ConnectionError("database is down")
+        self.flushed.append(dict(pending))
+        return {name: 100 + amount for name, amount in pending.items()}
+
+    def test_coalesce_increments(self):
+        """It should add up increments by name"""
+        self.assertEqual(self.buffer.add("foo"), 1)
+        self.assertEqual(self.buffer.add("foo", 2), 3)
+        self.assertEqual(self.buffer.add("bar"), 1)
+        self.assertEqual(self.buffer.pending("foo"), 3)
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.flushed, [{"foo": 3, "bar": 1}])
+        self.assertEqual(self.buffer.pending("foo"), 0)
+        self.assertEqual(self.buffer.value("foo"), 103)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_flush_when_full(self):
+        """It should flush before taking more than max_pending increments"""
+        for _ in range(5):
+            self.buffer.add("foo")
+        self.assertEqual(self.flushed, [])
+        self.buffer.add("foo")
+        self.assertEqual(self.flushed, [{"foo": 5}])
+        self.assertEqual(self.buffer.pending("foo"), 1)
+
+    def test_bound_concurrent_increments(self):
+        """It should never hold more than max_pending increments when threads add at once"""
+
+        def add():
+            for _ in range(50):
+                self.buffer.add("foo")
+
+        threads = [threading.Thread(target=add) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.buffer.flush()
+        self.assertTrue(all(sum(batch.values()) <= 5 for batch in self.flushed))
+        self.assertEqual(sum(sum(batch.values()) for batch in self.flushed), 400)
+
+    def test_reject_when_full_and_down(self):
+        """It should reject increments when full and the flush fails"""
+        for _ in range(5):
+            self.buffer.add("foo")
+        self.fail = True
+        self.assertRaises(ConnectionError, self.buffer.add, "foo")
+        self.assertEqual(self.buffer.pending("foo"), 5)
+        self.fail = False
+        self.buffer.add("foo")
+        self.assertEqual(self.flushed, [{"foo": 5}])
+
+    def test_discard_and_remember(self):
+        """It should forget removed names and remember read values"""
+        self.buffer.remember("foo", 7)
+        self.buffer.add("foo")
+        self.assertEqual(self.buffer.value("foo"), 7)
+        self.buffer.discard("foo")
+        self.assertEqual(self.buffer.pending("foo"), 0)
+        self.assertIsNone(self.buffer.value("foo"))
+
+    def test_background_flush(self):
+        """It should flush on its interval and when it is stopped"""
+        self.buffer.interval = 0.01
+        self.buffer.start()
+        self.buffer.add("foo")
+        for _ in range(100):
+            if self.flushed:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.flushed, [{"foo": 1}])
+        self.fail = True
+        self.buffer.add("bar")
+        time.sleep(0.05)
+        self.fail = False
+        self.buffer.stop()
+        self.assertEqual(self.flushed[-1], {"bar": 1})
+
+    def test_stop_when_down(self):
+        """It should log the increments it loses when it cannot flush"""
+        self.buffer.add("foo")
+        self.fail = True
+        self.buffer.stop()
+        self.assertEqual(self.buffer.pending("foo"), 1)
+
+    def test_after_fork(self):
+        """It should give a forked child an empty buffer"""
+        self.buffer.start()
+        self.buffer.add("foo")
+        write_behind._after_fork()
+        self.assertEqual(self.buffer.pending("foo"), 0)
+        self.assertTrue(self.buffer._thread.is_alive())